@@ -0,0 +1,524 @@
+"""
+Chart rendering for the CTO/CEO analytics packages.
+
+Lives outside main.py so ProcessPoolExecutor workers can import it: functions
+defined in the Streamlit script itself can't be pickled into another process.
+Each chart is rendered on its own from the DataFrames it needs and comes back
+as bytes (PNG, PDF) or str (HTML); nothing here touches the database or Streamlit.
+"""
+
+import hashlib
+import importlib
+import io
+
+import matplotlib
+matplotlib.use('Agg')
+import numpy as np
+import pandas as pd
+
+
+def init_worker():
+    """Pay the plotting imports once per worker instead of on its first chart."""
+    for name in ('matplotlib.pyplot', 'seaborn', 'plotly.express'):
+        importlib.import_module(name)
+
+
+def chart_digest(frames, date_str, title_prefix):
+    """Stable hash of a chart's inputs; equal data renders to equal output."""
+    h = hashlib.sha256(f'{date_str}\x00{title_prefix}'.encode('utf-8'))
+    for key in sorted(frames):
+        df = frames[key]
+        h.update(f'\x00{key}\x00{list(df.columns)}\x00{list(map(str, df.dtypes))}'.encode('utf-8'))
+        h.update(pd.util.hash_pandas_object(df, index=True).values.tobytes())
+    return h.hexdigest()
+
+
+def render(kind, filename, frames, date_str, title_prefix):
+    """Render one chart spec; this is what runs in the pool."""
+    _, build = CHARTS[kind][filename]
+    return build(frames, date_str, title_prefix)
+
+
+def chart_specs(kind, charts_data):
+    """(filename, frames) for every chart of `kind` whose inputs are available, in package order."""
+    specs = []
+    for filename, (inputs, _) in CHARTS[kind].items():
+        frames = {k: charts_data[k] for k in inputs if k in charts_data and not charts_data[k].empty}
+        if filename in ALWAYS_RENDERED or len(frames) == len(inputs) or (frames and filename in PARTIAL_OK):
+            specs.append((filename, frames))
+    return specs
+
+
+# ----------------- Static PNGs (matplotlib) -----------------
+def _figure_bytes(fig):
+    import matplotlib.pyplot as plt
+    buf = io.BytesIO()
+    fig.savefig(buf, format='png', dpi=150, bbox_inches='tight')
+    plt.close(fig)
+    return buf.getvalue()
+
+
+def _pyplot():
+    import matplotlib.pyplot as plt
+    plt.style.use('seaborn-v0_8')
+    return plt
+
+
+def _heatmap_pivot(heat_data):
+    heat_data = heat_data.copy()
+    # Normalize columns
+    if 'day_of_week' not in heat_data.columns or 'hour' not in heat_data.columns:
+        dt_col = None
+        for candidate in ['timestamp', 'created_at', 'uploaded_at', 'archived_at', 'date']:
+            if candidate in heat_data.columns:
+                dt_col = candidate
+                break
+        if dt_col is not None:
+            heat_data[dt_col] = pd.to_datetime(heat_data[dt_col], errors='coerce')
+            heat_data['day_of_week'] = heat_data[dt_col].dt.day_name()
+            heat_data['hour'] = heat_data[dt_col].dt.hour
+        else:
+            heat_data['day_of_week'] = 'Unknown'
+            heat_data['hour'] = 0
+    if 'count' not in heat_data.columns:
+        heat_data['count'] = 1
+    return heat_data.pivot_table(index='hour', columns='day_of_week', values='count', fill_value=0)
+
+
+def _png_summary(frames, date_str, title_prefix):
+    plt = _pyplot()
+    fig = plt.figure(figsize=(16, 10))
+    fig.suptitle(f"{title_prefix} — Summary Dashboard ({date_str})", fontsize=18, fontweight='bold')
+    gs = fig.add_gridspec(2, 2, hspace=0.35, wspace=0.25)
+
+    if 'daily_leads' in frames:
+        ax = fig.add_subplot(gs[0, 0])
+        daily_data = frames['daily_leads']
+        ax.plot(daily_data['date'], daily_data['count'], marker='o')
+        ax.set_title('Daily Leads Trend')
+        ax.set_xlabel('Date')
+        ax.set_ylabel('Leads')
+        ax.grid(True, alpha=0.3)
+
+    if 'agent_breakdown' in frames:
+        ax = fig.add_subplot(gs[0, 1])
+        agent_data = frames['agent_breakdown']
+        ax.bar(agent_data['sales_agent'], agent_data['count'])
+        ax.set_title('Agent Performance')
+        ax.set_xlabel('Agent')
+        ax.set_ylabel('Leads')
+        plt.setp(ax.xaxis.get_majorticklabels(), rotation=45)
+
+    if 'status_breakdown' in frames:
+        ax = fig.add_subplot(gs[1, 0])
+        status_data = frames['status_breakdown']
+        ax.pie(status_data['count'], labels=status_data['status'], autopct='%1.1f%%', startangle=90)
+        ax.set_title('Status Distribution')
+
+    if 'contact_methods' in frames:
+        ax = fig.add_subplot(gs[1, 1])
+        contact_data = frames['contact_methods']
+        ax.bar(contact_data['contact'], contact_data['count'])
+        ax.set_title('Contact Methods')
+        ax.set_xlabel('Method')
+        ax.set_ylabel('Leads')
+        plt.setp(ax.xaxis.get_majorticklabels(), rotation=45)
+
+    return _figure_bytes(fig)
+
+
+def _png_daily_leads(frames, date_str, title_prefix):
+    plt = _pyplot()
+    fig, ax = plt.subplots(figsize=(12, 8))
+    daily_data = frames['daily_leads']
+    ax.plot(daily_data['date'], daily_data['count'], marker='o')
+    ax.set_title(f'{title_prefix} — Daily Leads Trend ({date_str})', fontsize=16, fontweight='bold')
+    ax.set_xlabel('Date')
+    ax.set_ylabel('Number of Leads')
+    ax.grid(True, alpha=0.3)
+    return _figure_bytes(fig)
+
+
+def _png_agent_performance(frames, date_str, title_prefix):
+    plt = _pyplot()
+    fig, ax = plt.subplots(figsize=(12, 8))
+    agent_data = frames['agent_breakdown']
+    bars = ax.bar(agent_data['sales_agent'], agent_data['count'], color=plt.cm.Set3(np.linspace(0, 1, len(agent_data))))
+    ax.set_title(f'{title_prefix} — Agent Performance Breakdown ({date_str})', fontsize=16, fontweight='bold')
+    ax.set_xlabel('Sales Agent')
+    ax.set_ylabel('Number of Leads')
+    ax.grid(True, alpha=0.3, axis='y')
+    for bar in bars:
+        h = bar.get_height()
+        ax.text(bar.get_x() + bar.get_width()/2, h + 0.01, f'{int(h)}', ha='center', va='bottom')
+    plt.setp(ax.xaxis.get_majorticklabels(), rotation=45)
+    return _figure_bytes(fig)
+
+
+def _png_status_distribution(frames, date_str, title_prefix):
+    plt = _pyplot()
+    fig, ax = plt.subplots(figsize=(10, 10))
+    status_data = frames['status_breakdown']
+    ax.pie(status_data['count'], labels=status_data['status'], autopct='%1.1f%%', startangle=90)
+    ax.set_title(f'{title_prefix} — Lead Status Distribution ({date_str})', fontsize=16, fontweight='bold')
+    return _figure_bytes(fig)
+
+
+def _draw_funnel(plt, ax, funnel_data):
+    stage_col = 'stage' if 'stage' in funnel_data.columns else ('status' if 'status' in funnel_data.columns else None)
+    if stage_col is None or 'count' not in funnel_data.columns:
+        ax.text(0.5, 0.5, 'No funnel data', ha='center', va='center')
+        return False
+    stages = funnel_data[stage_col]
+    counts = funnel_data['count']
+    y_pos = np.arange(len(stages))
+    bars = ax.barh(y_pos, counts, color=plt.cm.viridis(np.linspace(0, 1, len(stages))))
+    ax.set_yticks(y_pos)
+    ax.set_yticklabels(stages)
+    ax.set_xlabel('Number of Leads')
+    ax.grid(True, alpha=0.3, axis='x')
+    for bar, count in zip(bars, counts):
+        ax.text(bar.get_width() + 0.01, bar.get_y() + bar.get_height()/2, f'{int(count)}', va='center')
+    return True
+
+
+def _png_sales_funnel(frames, date_str, title_prefix):
+    plt = _pyplot()
+    fig, ax = plt.subplots(figsize=(12, 8))
+    if _draw_funnel(plt, ax, frames['sales_funnel']):
+        ax.set_title(f'{title_prefix} — Sales Funnel ({date_str})', fontsize=16, fontweight='bold')
+    return _figure_bytes(fig)
+
+
+def _png_contact_methods(frames, date_str, title_prefix):
+    plt = _pyplot()
+    fig, ax = plt.subplots(figsize=(12, 8))
+    contact_data = frames['contact_methods']
+    bars = ax.bar(contact_data['contact'], contact_data['count'], color=plt.cm.Pastel1(np.linspace(0, 1, len(contact_data))))
+    ax.set_title(f'{title_prefix} — Contact Methods Analysis ({date_str})', fontsize=16, fontweight='bold')
+    ax.set_xlabel('Contact Method')
+    ax.set_ylabel('Number of Leads')
+    ax.grid(True, alpha=0.3, axis='y')
+    for bar in bars:
+        h = bar.get_height()
+        ax.text(bar.get_x() + bar.get_width()/2, h + 0.01, f'{int(h)}', ha='center', va='bottom')
+    plt.setp(ax.xaxis.get_majorticklabels(), rotation=45)
+    return _figure_bytes(fig)
+
+
+def _png_activity_heatmap(frames, date_str, title_prefix):
+    import seaborn as sns
+    plt = _pyplot()
+    fig, ax = plt.subplots(figsize=(12, 8))
+    sns.heatmap(_heatmap_pivot(frames['activity_heatmap']), annot=True, fmt='.0f', cmap='YlOrRd', ax=ax)
+    ax.set_title(f'{title_prefix} — Activity Heatmap ({date_str})', fontsize=16, fontweight='bold')
+    ax.set_xlabel('Day of Week')
+    ax.set_ylabel('Hour of Day')
+    return _figure_bytes(fig)
+
+
+def _png_trends(frames, date_str, title_prefix):
+    plt = _pyplot()
+    fig, ax = plt.subplots(figsize=(12, 8))
+    t = frames['trends']
+    ax.plot(t['date'], t['count'], label='Daily Count', marker='o')
+    if 'rolling_avg' in t.columns:
+        ax.plot(t['date'], t['rolling_avg'], label='7-Day Rolling Average', color='red')
+    ax.legend()
+    ax.set_title(f'{title_prefix} — Trends Analysis ({date_str})', fontsize=16, fontweight='bold')
+    ax.set_xlabel('Date')
+    ax.set_ylabel('Number of Leads')
+    ax.grid(True, alpha=0.3)
+    return _figure_bytes(fig)
+
+
+# ----------------- PDF report (matplotlib) -----------------
+def _pdf_report(frames, date_str, title_prefix):
+    """Multi-page PDF; the funnel and heatmap pages are drawn with matplotlib like the PNGs."""
+    import seaborn as sns
+    from matplotlib.backends.backend_pdf import PdfPages
+    plt = _pyplot()
+    fig_width, fig_height = 12, 8
+    pdf_buffer = io.BytesIO()
+
+    def page(fig):
+        plt.tight_layout()
+        pdf.savefig(fig)
+        plt.close(fig)
+
+    with PdfPages(pdf_buffer) as pdf:
+        # 1. Daily Leads Trend
+        if 'daily_leads' in frames:
+            fig, ax = plt.subplots(figsize=(fig_width, fig_height))
+            daily_data = frames['daily_leads']
+            ax.plot(daily_data['date'], daily_data['count'], marker='o', linewidth=2, markersize=6)
+            ax.set_title(f'{title_prefix} - Daily Leads Trend', fontsize=16, fontweight='bold')
+            ax.set_xlabel('Date', fontsize=12)
+            ax.set_ylabel('Number of Leads', fontsize=12)
+            ax.grid(True, alpha=0.3)
+            plt.xticks(rotation=45)
+            page(fig)
+
+        # 2. Agent Performance Breakdown
+        if 'agent_breakdown' in frames:
+            fig, ax = plt.subplots(figsize=(fig_width, fig_height))
+            agent_data = frames['agent_breakdown']
+            bars = ax.bar(agent_data['sales_agent'], agent_data['count'],
+                          color=plt.cm.Set3(np.linspace(0, 1, len(agent_data))))
+            ax.set_title(f'{title_prefix} - Agent Performance Breakdown', fontsize=16, fontweight='bold')
+            ax.set_xlabel('Sales Agent', fontsize=12)
+            ax.set_ylabel('Number of Leads', fontsize=12)
+            ax.grid(True, alpha=0.3, axis='y')
+            for bar in bars:
+                height = bar.get_height()
+                ax.text(bar.get_x() + bar.get_width()/2., height + 0.01,
+                        f'{int(height)}', ha='center', va='bottom', fontweight='bold')
+            plt.xticks(rotation=45)
+            page(fig)
+
+        # 3. Lead Status Distribution
+        if 'status_breakdown' in frames:
+            fig, ax = plt.subplots(figsize=(fig_width, fig_height))
+            status_data = frames['status_breakdown']
+            colors = ['#2E8B57', '#FF6B6B', '#4ECDC4', '#45B7D1', '#96CEB4']
+            wedges, texts, autotexts = ax.pie(status_data['count'], labels=status_data['status'],
+                                              autopct='%1.1f%%', colors=colors, startangle=90)
+            ax.set_title(f'{title_prefix} - Lead Status Distribution', fontsize=16, fontweight='bold')
+            for autotext in autotexts:
+                autotext.set_color('white')
+                autotext.set_fontweight('bold')
+            page(fig)
+
+        # 4. Sales Funnel
+        if 'sales_funnel' in frames:
+            fig, ax = plt.subplots(figsize=(fig_width, fig_height))
+            if _draw_funnel(plt, ax, frames['sales_funnel']):
+                ax.set_title(f'{title_prefix} - Sales Funnel', fontsize=16, fontweight='bold')
+            page(fig)
+
+        # 5. Contact Methods Analysis
+        if 'contact_methods' in frames:
+            fig, ax = plt.subplots(figsize=(fig_width, fig_height))
+            contact_data = frames['contact_methods']
+            bars = ax.bar(contact_data['contact'], contact_data['count'],
+                          color=plt.cm.Pastel1(np.linspace(0, 1, len(contact_data))))
+            ax.set_title(f'{title_prefix} - Contact Methods Analysis', fontsize=16, fontweight='bold')
+            ax.set_xlabel('Contact Method', fontsize=12)
+            ax.set_ylabel('Number of Leads', fontsize=12)
+            ax.grid(True, alpha=0.3, axis='y')
+            for bar in bars:
+                height = bar.get_height()
+                ax.text(bar.get_x() + bar.get_width()/2., height + 0.01,
+                        f'{int(height)}', ha='center', va='bottom', fontweight='bold')
+            plt.xticks(rotation=45)
+            page(fig)
+
+        # 6. Activity Heatmap
+        if 'activity_heatmap' in frames:
+            fig, ax = plt.subplots(figsize=(fig_width, fig_height))
+            sns.heatmap(_heatmap_pivot(frames['activity_heatmap']), annot=True, fmt='.0f', cmap='YlOrRd', ax=ax)
+            ax.set_title(f'{title_prefix} - Activity Heatmap', fontsize=16, fontweight='bold')
+            ax.set_xlabel('Day of Week', fontsize=12)
+            ax.set_ylabel('Hour of Day', fontsize=12)
+            page(fig)
+
+        # 7. Trends Analysis (if available)
+        if 'trends' in frames:
+            fig, ax = plt.subplots(figsize=(fig_width, fig_height))
+            trends_data = frames['trends']
+            ax.plot(trends_data['date'], trends_data['count'], label='Daily Count', marker='o')
+            if 'rolling_avg' in trends_data.columns:
+                ax.plot(trends_data['date'], trends_data['rolling_avg'],
+                        label='7-Day Rolling Average', linewidth=2, color='red')
+            ax.set_title(f'{title_prefix} - Trends Analysis', fontsize=16, fontweight='bold')
+            ax.set_xlabel('Date', fontsize=12)
+            ax.set_ylabel('Number of Leads', fontsize=12)
+            ax.legend()
+            ax.grid(True, alpha=0.3)
+            plt.xticks(rotation=45)
+            page(fig)
+
+        # 8. Summary Dashboard (Combined view)
+        fig = plt.figure(figsize=(16, 12))
+        fig.suptitle(f'{title_prefix} - Summary Dashboard', fontsize=20, fontweight='bold')
+        gs = fig.add_gridspec(3, 3, hspace=0.3, wspace=0.3)
+
+        ax1 = fig.add_subplot(gs[0, :])
+        ax1.axis('off')
+        summary_lines = [f'{title_prefix} Summary Report - Generated on {date_str}', '']
+        if 'summary' in frames:
+            summary_lines += [f'{row.Metric}: {row.Value}' for row in frames['summary'].itertuples()]
+        ax1.text(0.1, 0.5, '\n'.join(summary_lines), fontsize=14, verticalalignment='center',
+                 bbox=dict(boxstyle="round,pad=0.3", facecolor="lightblue", alpha=0.5))
+
+        if 'status_breakdown' in frames:
+            ax2 = fig.add_subplot(gs[1, 0])
+            status_data = frames['status_breakdown']
+            ax2.pie(status_data['count'], labels=status_data['status'], autopct='%1.1f%%', startangle=90)
+            ax2.set_title('Status Distribution')
+
+        if 'agent_breakdown' in frames:
+            ax3 = fig.add_subplot(gs[1, 1])
+            agent_data = frames['agent_breakdown'].head(5)  # Top 5 agents
+            ax3.bar(agent_data['sales_agent'], agent_data['count'])
+            ax3.set_title('Top 5 Agents')
+            plt.setp(ax3.xaxis.get_majorticklabels(), rotation=45)
+
+        if 'daily_leads' in frames:
+            ax4 = fig.add_subplot(gs[1, 2])
+            daily_data = frames['daily_leads']
+            ax4.plot(daily_data['date'], daily_data['count'], marker='o')
+            ax4.set_title('Daily Trend')
+            plt.setp(ax4.xaxis.get_majorticklabels(), rotation=45)
+
+        if 'contact_methods' in frames:
+            ax5 = fig.add_subplot(gs[2, :])
+            contact_data = frames['contact_methods']
+            ax5.barh(contact_data['contact'], contact_data['count'])
+            ax5.set_title('Contact Methods')
+            ax5.set_xlabel('Number of Leads')
+
+        # Spacing comes from the gridspec; tight_layout can't handle the mixed axes
+        pdf.savefig(fig)
+        plt.close(fig)
+
+    return pdf_buffer.getvalue()
+
+
+# ----------------- Interactive HTML (plotly) -----------------
+def _html_daily_leads(frames, date_str, title_prefix):
+    import plotly.express as px
+    fig = px.line(frames['daily_leads'], x='date', y='count',
+                  title=f'{title_prefix} - Daily Leads Trend',
+                  markers=True)
+    fig.update_layout(
+        xaxis_title="Date",
+        yaxis_title="Number of Leads",
+        template="plotly_white"
+    )
+    return fig.to_html(include_plotlyjs='cdn')
+
+
+def _html_agent_performance(frames, date_str, title_prefix):
+    import plotly.express as px
+    fig = px.bar(frames['agent_breakdown'], x='sales_agent', y='count',
+                 title=f'{title_prefix} - Agent Performance Breakdown',
+                 color='count', color_continuous_scale='viridis')
+    fig.update_layout(
+        xaxis_title="Sales Agent",
+        yaxis_title="Number of Leads",
+        template="plotly_white"
+    )
+    return fig.to_html(include_plotlyjs='cdn')
+
+
+def _html_status_distribution(frames, date_str, title_prefix):
+    import plotly.express as px
+    fig = px.pie(frames['status_breakdown'], values='count', names='status',
+                 title=f'{title_prefix} - Lead Status Distribution')
+    fig.update_layout(template="plotly_white")
+    return fig.to_html(include_plotlyjs='cdn')
+
+
+def _html_sales_funnel(frames, date_str, title_prefix):
+    import plotly.graph_objects as go
+    funnel_data = frames['sales_funnel']
+    stage_col = 'stage' if 'stage' in funnel_data.columns else ('status' if 'status' in funnel_data.columns else None)
+    if stage_col is None or 'count' not in funnel_data.columns:
+        return None
+    fig = go.Figure(go.Funnel(
+        y=funnel_data[stage_col],
+        x=funnel_data['count'],
+        textinfo="value+percent initial"
+    ))
+    fig.update_layout(
+        title=f'{title_prefix} - Sales Funnel',
+        template="plotly_white"
+    )
+    return fig.to_html(include_plotlyjs='cdn')
+
+
+def _html_contact_methods(frames, date_str, title_prefix):
+    import plotly.express as px
+    fig = px.bar(frames['contact_methods'], x='contact', y='count',
+                 title=f'{title_prefix} - Contact Methods Analysis',
+                 color='count', color_continuous_scale='plasma')
+    fig.update_layout(
+        xaxis_title="Contact Method",
+        yaxis_title="Number of Leads",
+        template="plotly_white"
+    )
+    return fig.to_html(include_plotlyjs='cdn')
+
+
+def _html_activity_heatmap(frames, date_str, title_prefix):
+    import plotly.express as px
+    pivot_data = frames['activity_heatmap'].pivot_table(index='hour', columns='day_of_week', values='count', fill_value=0)
+    fig = px.imshow(pivot_data.values,
+                    x=pivot_data.columns,
+                    y=pivot_data.index,
+                    title=f'{title_prefix} - Activity Heatmap',
+                    color_continuous_scale='YlOrRd',
+                    aspect="auto")
+    fig.update_layout(
+        xaxis_title="Day of Week",
+        yaxis_title="Hour of Day",
+        template="plotly_white"
+    )
+    return fig.to_html(include_plotlyjs='cdn')
+
+
+def _html_dashboard(frames, date_str, title_prefix):
+    import plotly.graph_objects as go
+    from plotly.subplots import make_subplots
+    fig = make_subplots(
+        rows=2, cols=2,
+        subplot_titles=('Daily Trend', 'Agent Performance', 'Status Distribution', 'Contact Methods'),
+        specs=[[{"type": "scatter"}, {"type": "bar"}],
+               [{"type": "pie"}, {"type": "bar"}]]
+    )
+    if 'daily_leads' in frames:
+        daily_data = frames['daily_leads']
+        fig.add_trace(go.Scatter(x=daily_data['date'], y=daily_data['count'], mode='lines+markers'), row=1, col=1)
+    if 'agent_breakdown' in frames:
+        agent_data = frames['agent_breakdown']
+        fig.add_trace(go.Bar(x=agent_data['sales_agent'], y=agent_data['count']), row=1, col=2)
+    if 'status_breakdown' in frames:
+        status_data = frames['status_breakdown']
+        fig.add_trace(go.Pie(values=status_data['count'], labels=status_data['status']), row=2, col=1)
+    if 'contact_methods' in frames:
+        contact_data = frames['contact_methods']
+        fig.add_trace(go.Bar(x=contact_data['contact'], y=contact_data['count']), row=2, col=2)
+    fig.update_layout(height=800, title_text=f"{title_prefix} - Interactive Dashboard")
+    return fig.to_html(include_plotlyjs='cdn')
+
+
+# kind -> filename -> (input frames, renderer), in the order files go into the package
+SUMMARY_INPUTS = ('daily_leads', 'agent_breakdown', 'status_breakdown', 'contact_methods')
+CHARTS = {
+    'png': {
+        '00_summary_dashboard.png': (SUMMARY_INPUTS, _png_summary),
+        '01_daily_leads_trend.png': (('daily_leads',), _png_daily_leads),
+        '02_agent_performance.png': (('agent_breakdown',), _png_agent_performance),
+        '03_status_distribution.png': (('status_breakdown',), _png_status_distribution),
+        '04_sales_funnel.png': (('sales_funnel',), _png_sales_funnel),
+        '05_contact_methods.png': (('contact_methods',), _png_contact_methods),
+        '06_activity_heatmap.png': (('activity_heatmap',), _png_activity_heatmap),
+        '07_trends.png': (('trends',), _png_trends),
+    },
+    'pdf': {
+        'analytics_report.pdf': (SUMMARY_INPUTS + ('sales_funnel', 'activity_heatmap', 'trends', 'summary'), _pdf_report),
+    },
+    'html': {
+        'daily_leads_trend.html': (('daily_leads',), _html_daily_leads),
+        'agent_performance.html': (('agent_breakdown',), _html_agent_performance),
+        'status_distribution.html': (('status_breakdown',), _html_status_distribution),
+        'sales_funnel.html': (('sales_funnel',), _html_sales_funnel),
+        'contact_methods.html': (('contact_methods',), _html_contact_methods),
+        'activity_heatmap.html': (('activity_heatmap',), _html_activity_heatmap),
+        'interactive_dashboard.html': (SUMMARY_INPUTS, _html_dashboard),
+    },
+}
+# Combined views that are drawn from whatever inputs are present
+PARTIAL_OK = {'interactive_dashboard.html', 'analytics_report.pdf'}
+ALWAYS_RENDERED = {'00_summary_dashboard.png', 'analytics_report.pdf'}
@@ -23,20 +23,46 @@ Security note: This example uses an in-app user management for demo only.
 For production use central auth (OAuth2 / SSO) and secure DB credentials.
 """
 
+# Spawned processes (the chart workers, see get_chart_pool) start by re-running the parent's
+# __main__ unless its spec names it '__main__'. Under `streamlit run`, __main__ is this script,
+# executed as a fresh spec-less module on every run; giving each run's module this spec keeps
+# the workers from re-running the app without swapping sys.modules['__main__'] process-wide.
+from importlib.machinery import ModuleSpec
+__spec__ = ModuleSpec('__main__', None)
+
 import streamlit as st
 import pandas as pd
 import sqlalchemy as sa
-from sqlalchemy.orm import declarative_base, sessionmaker, relationship
+from sqlalchemy.orm import declarative_base, sessionmaker, relationship, deferred
 from sqlalchemy import Column, Integer, String, DateTime, Text, ForeignKey, LargeBinary, func
 from datetime import datetime, date
 import io
 import plotly.express as px
 from passlib.context import CryptContext
 import os
-import math
+import json
+import base64
+import hashlib
+import hmac
+import secrets
+import re
 import zipfile
 import random
-import numpy as np
+import queue
+import heapq
+import threading
+import time
+import atexit
+import tempfile
+import shutil
+import functools
+import sys
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+import multiprocessing
+import logging
+import chart_render
 
 # ----------------- Requirements (put in requirements.txt) -----------------
 # streamlit
@@ -46,14 +72,85 @@ import numpy as np
 # plotly
 # passlib
 # python-dateutil
+# Pillow
 # --------------------------------------------------------------------------
 
 BASE_DIR = os.path.dirname(__file__) if '__file__' in globals() else '.'
 DB_FILE = os.path.join(BASE_DIR, 'crm_full.db')
 DATABASE_URL = f"sqlite:///{DB_FILE}"
+# Demo accounts are seeded on startup; set CRM_SEED_DEMO_USERS=0 in production
+SEED_DEMO_USERS = os.environ.get('CRM_SEED_DEMO_USERS', '1').strip().lower() in ('1', 'true', 'yes', 'on')
+# PRAGMA profile applied to every SQLite connection (see SQLITE_PROFILES)
+SQLITE_PROFILE = os.environ.get('CRM_SQLITE_PROFILE', 'default').strip().lower()
+# Seconds between background writes of login events; 0 writes them inline
+WRITE_BEHIND_SECONDS = float(os.environ.get('CRM_WRITE_BEHIND_SECONDS', '2'))
+# Memory budget of the per-process query result cache (see QueryCache)
+QUERY_CACHE_MB = float(os.environ.get('CRM_QUERY_CACHE_MB', '128'))
+# Directory of the content-addressed deal screenshot store (see LocalBlobStore)
+BLOB_DIR = os.environ.get('CRM_BLOB_DIR') or os.path.join(BASE_DIR, 'deal_blobs')
+# Deal image exports: longest side of embedded screenshots (px) and total image budget (MB)
+EXPORT_IMAGE_PX = int(os.environ.get('CRM_EXPORT_IMAGE_PX', '800'))
+EXPORT_MAX_MB = float(os.environ.get('CRM_EXPORT_MAX_MB', '200'))
+# Finished analytics packages kept on disk for repeat downloads (see PackageCache)
+PACKAGE_CACHE_DIR = os.environ.get('CRM_PACKAGE_CACHE_DIR') or os.path.join(BASE_DIR, 'package_cache')
+PACKAGE_CACHE_MB = float(os.environ.get('CRM_PACKAGE_CACHE_MB', '512'))
+# Background jobs (see JobRunner): worker threads, where results are kept, and for how many days
+JOB_WORKERS = int(os.environ.get('CRM_JOB_WORKERS', '2'))
+JOB_DIR = os.environ.get('CRM_JOB_DIR') or os.path.join(BASE_DIR, 'job_results')
+JOB_RESULT_DAYS = float(os.environ.get('CRM_JOB_RESULT_DAYS', '7'))
+# Processes rendering analytics package charts (see get_chart_pool); 1 renders in the job thread.
+# A package has at most 8 charts of a kind, so more workers than that would sit idle.
+CHART_WORKERS = int(os.environ.get('CRM_CHART_WORKERS') or min(8, os.cpu_count() or 1))
 
 # ----------------- DB setup -----------------
-engine = sa.create_engine(DATABASE_URL, connect_args={"check_same_thread": False})
+# WAL lets readers (dashboards, exports) run alongside a writer, and
+# busy_timeout makes a blocked writer wait instead of failing with
+# "database is locked". 'durable' fsyncs every commit; 'compat' keeps the
+# rollback journal for filesystems without shared memory (e.g. NFS).
+SQLITE_PROFILES = {
+    'default': {
+        'journal_mode': 'WAL',
+        'synchronous': 'NORMAL',
+        'busy_timeout': 10000,
+        'cache_size': -65536,  # KiB, i.e. 64 MB
+        'mmap_size': 268435456,
+        'temp_store': 'MEMORY',
+        'foreign_keys': 'ON',
+    },
+    'durable': {
+        'journal_mode': 'WAL',
+        'synchronous': 'FULL',
+        'busy_timeout': 30000,
+        'cache_size': -16384,
+        'temp_store': 'MEMORY',
+        'foreign_keys': 'ON',
+    },
+    'compat': {
+        'journal_mode': 'DELETE',
+        'synchronous': 'FULL',
+        'busy_timeout': 30000,
+        'foreign_keys': 'ON',
+    },
+}
+
+@st.cache_resource(show_spinner=False)
+def get_engine():
+    """One engine (and connection pool) per process, with the SQLITE_PROFILE pragmas on every connection."""
+    if SQLITE_PROFILE not in SQLITE_PROFILES:
+        raise ValueError(f"Unknown CRM_SQLITE_PROFILE {SQLITE_PROFILE!r}; expected one of {', '.join(SQLITE_PROFILES)}")
+    pragmas = SQLITE_PROFILES[SQLITE_PROFILE]
+    eng = sa.create_engine(DATABASE_URL, connect_args={"check_same_thread": False})
+
+    @sa.event.listens_for(eng, 'connect')
+    def apply_sqlite_profile(dbapi_conn, connection_record):
+        cursor = dbapi_conn.cursor()
+        for name, value in pragmas.items():
+            cursor.execute(f"PRAGMA {name} = {value}")
+        cursor.close()
+
+    return eng
+
+engine = get_engine()
 SessionLocal = sessionmaker(bind=engine)
 Base = declarative_base()
 
@@ -134,7 +231,10 @@ class Deal(Base):
     id = Column(Integer, primary_key=True)
     customer_name = Column(String, nullable=False)
     phone = Column(String, nullable=False)
-    payment_screenshot = Column(LargeBinary, nullable=False)
+    # Legacy inline image (see migrate_deal_screenshots); deferred so listing deals never loads it
+    payment_screenshot = deferred(Column(LargeBinary))
+    screenshot_ref = Column(String)                  # blob store key (SHA-256 of the image)
+    thumbnail_ref = Column(String)                   # blob store key of the small preview
     uploaded_by = Column(String)                     # username (readable)
     uploaded_by_id = Column(Integer, ForeignKey('users.id'))  # FK
     created_at = Column(DateTime, default=datetime.utcnow)
@@ -152,7 +252,81 @@ class Setting(Base):
     key = Column(String, primary_key=True)
     value = Column(String)
 
-Base.metadata.create_all(bind=engine)
+class Job(Base):
+    __tablename__ = 'jobs'
+    id = Column(Integer, primary_key=True)
+    kind = Column(String, nullable=False)            # key of JOB_HANDLERS
+    label = Column(String)                           # what the sidebar calls it
+    params = Column(Text)                            # JSON, for the record (long lists as their length)
+    status = Column(String, nullable=False, default='queued')  # queued, running, done, failed, cancelled
+    progress = Column(sa.Float, default=0.0)         # 0-1
+    message = Column(Text)                           # latest status line from the handler
+    error = Column(Text)
+    cancel_requested = Column(Integer, default=0)
+    created_by = Column(String, index=True)          # username
+    created_at = Column(DateTime, default=datetime.utcnow)
+    started_at = Column(DateTime)
+    finished_at = Column(DateTime)
+    result_path = Column(String)                     # file under JOB_DIR
+    result_name = Column(String)
+    result_mime = Column(String)
+
+# ----------------- Indexes -----------------
+# Active/archived leads are spelled with literal 'no'/'yes' (not bound
+# parameters) so SQLite can match queries against the partial indexes below.
+ACTIVE_LEADS_WHERE = "is_archived IS NULL OR is_archived = 'no'"
+ARCHIVED_LEADS_WHERE = "is_archived = 'yes'"
+LEAD_IS_ACTIVE = sa.or_(Lead.is_archived.is_(None), Lead.is_archived == sa.literal_column("'no'"))
+LEAD_IS_ARCHIVED = Lead.is_archived == sa.literal_column("'yes'")
+# No sales agent yet (null, blank or 'unassigned'), or nobody it is assigned to
+LEAD_IS_UNASSIGNED = sa.or_(
+    Lead.sales_agent.is_(None),
+    func.trim(Lead.sales_agent) == '',
+    func.lower(func.trim(Lead.sales_agent)) == 'unassigned',
+    Lead.assigned_to.is_(None)
+)
+
+# name -> (table, columns, partial-index WHERE or None)
+INDEXES = {
+    'ix_leads_active_uploaded': ('leads', 'uploaded_at, id', ACTIVE_LEADS_WHERE),
+    'ix_leads_active_agent': ('leads', 'sales_agent, uploaded_at, id', ACTIVE_LEADS_WHERE),
+    'ix_leads_active_status': ('leads', 'status, uploaded_at, id', ACTIVE_LEADS_WHERE),
+    'ix_leads_assigned_to': ('leads', 'assigned_to', None),
+    'ix_leads_assigned_uploaded': ('leads', 'uploaded_at', 'assigned_to IS NOT NULL'),
+    'ix_leads_archived_at': ('leads', 'archived_at', ARCHIVED_LEADS_WHERE),
+    'ix_leads_archived_reason': ('leads', 'archive_reason, archived_at', ARCHIVED_LEADS_WHERE),
+    'ix_leads_archived_by': ('leads', 'archived_by', ARCHIVED_LEADS_WHERE),
+    'ix_activities_lead_id': ('activities', 'lead_id', None),
+    'ix_activities_timestamp': ('activities', 'timestamp', None),
+    'ix_comments_lead_id': ('comments', 'lead_id, created_at', None),
+    'ix_deals_uploaded_by': ('deals', 'uploaded_by, created_at, id', None),
+    'ix_deals_created_at': ('deals', 'created_at, id', None),
+}
+
+def index_ddl(name):
+    table, columns, where = INDEXES[name]
+    ddl = f"CREATE INDEX {name} ON {table} ({columns})"
+    return f"{ddl} WHERE {where}" if where else ddl
+
+def ensure_indexes(conn):
+    """Create missing INDEXES and rebuild any whose definition drifted.
+    Returns the names of the indexes (re)created.
+    """
+    existing = dict(conn.exec_driver_sql(
+        "SELECT name, sql FROM sqlite_master WHERE type = 'index' AND sql IS NOT NULL"
+    ).fetchall())
+    created = []
+    for name in INDEXES:
+        ddl = index_ddl(name)
+        if existing.get(name) == ddl:
+            continue
+        conn.exec_driver_sql(f"DROP INDEX IF EXISTS {name}")
+        conn.exec_driver_sql(ddl)
+        created.append(name)
+    if created:
+        # Fresh statistics so the planner weighs the new indexes correctly
+        conn.exec_driver_sql("ANALYZE")
+    return created
 
 # Ensure DB schema matches current models (adds new columns if missing)
 def ensure_schema():
@@ -160,9 +334,8 @@ def ensure_schema():
     Adds missing columns on existing tables to avoid OperationalError when models evolve.
     """
     with engine.begin() as conn:
-        # Configure SQLite for Unicode support
+        # Configure SQLite for Unicode support (per-connection pragmas come from get_engine())
         conn.execute(sa.text("PRAGMA encoding = 'UTF-8'"))
-        conn.execute(sa.text("PRAGMA foreign_keys = ON"))
         # Leads table columns
         try:
             rows = conn.exec_driver_sql("PRAGMA table_info('leads')").fetchall()
@@ -194,20 +367,21 @@ def ensure_schema():
         if 'archive_date' not in existing_columns:
             conn.exec_driver_sql("ALTER TABLE leads ADD COLUMN archive_date DATETIME")
 
-        # Optional: ensure indexes exist (SQLite auto-creates pk index; skip others for simplicity)
-
         # Deals table columns (create table if not exists then add new columns if missing)
         conn.exec_driver_sql("""
         CREATE TABLE IF NOT EXISTS deals (
             id INTEGER PRIMARY KEY,
             customer_name VARCHAR NOT NULL,
             phone VARCHAR NOT NULL,
-            payment_screenshot BLOB NOT NULL,
+            payment_screenshot BLOB,
+            screenshot_ref VARCHAR,
+            thumbnail_ref VARCHAR,
             uploaded_by VARCHAR,
             uploaded_by_id INTEGER,
             created_at DATETIME
         )
         """)
+        rows_deals = []
         try:
             rows_deals = conn.exec_driver_sql("PRAGMA table_info('deals')").fetchall()
             existing_deals_cols = {row[1] for row in rows_deals}
@@ -219,6 +393,20 @@ def ensure_schema():
             conn.exec_driver_sql("ALTER TABLE deals ADD COLUMN uploaded_by_id INTEGER")
         if 'created_at' not in existing_deals_cols:
             conn.exec_driver_sql("ALTER TABLE deals ADD COLUMN created_at DATETIME")
+        if 'screenshot_ref' not in existing_deals_cols:
+            conn.exec_driver_sql("ALTER TABLE deals ADD COLUMN screenshot_ref VARCHAR")
+        if 'thumbnail_ref' not in existing_deals_cols:
+            conn.exec_driver_sql("ALTER TABLE deals ADD COLUMN thumbnail_ref VARCHAR")
+        # payment_screenshot used to be NOT NULL. SQLite cannot relax a constraint
+        # in place, so rebuild the table from the model (its triggers and indexes
+        # go with the old table and are recreated by ensure_indexes/ensure_rollups/
+        # ensure_data_versions).
+        if any(row[1] == 'payment_screenshot' and row[3] for row in rows_deals):
+            conn.exec_driver_sql("ALTER TABLE deals RENAME TO deals_old")
+            Deal.__table__.create(conn)
+            cols = ', '.join(c.name for c in Deal.__table__.columns)
+            conn.exec_driver_sql(f"INSERT INTO deals ({cols}) SELECT {cols} FROM deals_old")
+            conn.exec_driver_sql("DROP TABLE deals_old")
 
         # Login events table
         conn.exec_driver_sql("""
@@ -238,7 +426,7 @@ def ensure_schema():
         )
         """)
 
-ensure_schema()
+        ensure_indexes(conn)
 
 def normalize_arabic_text(text):
     """Normalize Arabic text for proper storage and display"""
@@ -273,113 +461,814 @@ def create_user(db, username, password, role='salesman', name=None):
     return user
 
 def update_or_create_user(db, username, password, role='salesman', name=None):
-    """Update existing user or create new one"""
+    """Update existing user or create new one. Only writes when something changed."""
     user = get_user_by_username(db, username)
     if user:
-        # Update existing user
-        user.password_hash = User.hash_password(password)
-        user.name = name or user.name
-        user.role = role
-        db.commit()
-        db.refresh(user)
+        changed = False
+        try:
+            password_ok = user.verify_password(password) and not pwd_context.needs_update(user.password_hash)
+        except ValueError:
+            # Unrecognised or corrupt hash: reset it below
+            password_ok = False
+        if not password_ok:
+            user.password_hash = User.hash_password(password)
+            changed = True
+        if (name or user.name) != user.name or user.role != role:
+            user.name = name or user.name
+            user.role = role
+            changed = True
+        if changed:
+            db.commit()
+            db.refresh(user)
         return user
     else:
         # Create new user
         return create_user(db, username, password, role, name)
 
+# Demo accounts: (username, password, role, name)
+DEMO_USERS = [
+    # Management roles
+    ('head', 'IQstats@iq-2024', 'head_of_sales', 'Mohamed Akmal'),
+    ('cto', 'IQstats@iq-2025', 'cto', 'Omar Samy'),
+    ('ceo', 'IQstats@iq-2026', 'ceo', 'ENG Ahmed Essam'),
+    # Sales team
+    ('toqa', 'IQstats@iq-2027', 'salesman', 'Toqa Amin'),
+    ('mahmoud', 'IQstats@iq-2028', 'salesman', 'Mahmoud Fathalla'),
+    ('mazen', 'IQstats@iq-2029', 'salesman', 'Mazen Ashraf'),
+    ('ahmed_malek', 'IQstats@iq-2030', 'salesman', 'Ahmed Malek'),
+    ('youssry', 'IQstats@iq-2031', 'salesman', 'Youssry Hassan'),
+]
+
+def _seed_secret(db):
+    """Random key for the seed fingerprints, created on first use and kept in settings."""
+    db.execute(sa.text(
+        "INSERT INTO settings (key, value) VALUES ('seed_secret', :v) ON CONFLICT(key) DO NOTHING"
+    ), {'v': secrets.token_hex(32)})
+    return db.get(Setting, 'seed_secret').value
+
+def _seed_fingerprint(secret, username, password, role, name, password_hash):
+    # Keyed with a server secret, so the password can't be brute-forced from the digest
+    # with a fast hash. The stored hash is part of it, so an account edited from the
+    # admin screen no longer matches.
+    raw = '\x1f'.join([username, password, role, name or '', password_hash or ''])
+    return hmac.new(secret.encode('utf-8'), raw.encode('utf-8'), hashlib.sha256).hexdigest()
+
 def ensure_demo_users():
+    """Seed DEMO_USERS. Accounts whose seed fingerprint is unchanged are skipped
+    without running bcrypt; the rest go through update_or_create_user, which only
+    writes on a real change. Set CRM_SEED_DEMO_USERS=0 to disable seeding.
+    """
+    if not SEED_DEMO_USERS:
+        return
     db = get_session()
     try:
-        # Management roles
-        update_or_create_user(db, 'head', 'IQstats@iq-2024', role='head_of_sales', name='Mohamed Akmal')
-        update_or_create_user(db, 'cto', 'IQstats@iq-2025', role='cto', name='Omar Samy')
-        update_or_create_user(db, 'ceo', 'IQstats@iq-2026', role='ceo', name='ENG Ahmed Essam')
-        # Sales team
-        update_or_create_user(db, 'toqa', 'IQstats@iq-2027', role='salesman', name='Toqa Amin')
-        update_or_create_user(db, 'mahmoud', 'IQstats@iq-2028', role='salesman', name='Mahmoud Fathalla')
-        update_or_create_user(db, 'mazen', 'IQstats@iq-2029', role='salesman', name='Mazen Ashraf')
-        update_or_create_user(db, 'ahmed_malek', 'IQstats@iq-2030', role='salesman', name='Ahmed Malek')
-        update_or_create_user(db, 'youssry', 'IQstats@iq-2031', role='salesman', name='Youssry Hassan')
+        secret = _seed_secret(db)
+        stored = {
+            row.key: row.value
+            for row in db.query(Setting).filter(Setting.key.like('seed_fingerprint:%')).all()
+        }
+        users = {u.username: u for u in db.query(User).filter(User.username.in_([u[0] for u in DEMO_USERS])).all()}
+        for username, password, role, name in DEMO_USERS:
+            key = f'seed_fingerprint:{username}'
+            user = users.get(username)
+            if user is not None and stored.get(key) == _seed_fingerprint(secret, username, password, role, name,
+                                                                         user.password_hash):
+                continue
+            user = update_or_create_user(db, username, password, role=role, name=name)
+            fingerprint = _seed_fingerprint(secret, username, password, role, name, user.password_hash)
+            row = db.get(Setting, key)
+            if row is None:
+                db.add(Setting(key=key, value=fingerprint))
+            else:
+                row.value = fingerprint
+            db.commit()
     finally:
         db.close()
 
-ensure_demo_users()
+# ----------------- Blob store -----------------
+# Deal screenshots live outside SQLite, addressed by the SHA-256 of their
+# content: identical uploads share one file and deals keep only the key.
+# BlobStore is the interface; an object-storage backend would implement the
+# same four methods.
+class BlobStore:
+    """Content-addressed byte store. Keys are SHA-256 hex digests."""
+
+    def put(self, data):
+        """Store data and return its key; storing the same bytes twice is a no-op."""
+        raise NotImplementedError
+
+    def get(self, key):
+        """Bytes stored under key. Raises KeyError if missing."""
+        raise NotImplementedError
+
+    def exists(self, key):
+        raise NotImplementedError
+
+    def delete(self, key):
+        raise NotImplementedError
+
+    @staticmethod
+    def key_for(data):
+        return hashlib.sha256(data).hexdigest()
+
+class LocalBlobStore(BlobStore):
+    """Files under root/ab/cd/<sha256>, written atomically via a temp file and rename."""
+
+    def __init__(self, root):
+        self.root = root
+
+    def _path(self, key):
+        if not re.fullmatch(r'[0-9a-f]{64}', key or ''):
+            raise KeyError(key)
+        return os.path.join(self.root, key[:2], key[2:4], key)
+
+    def put(self, data):
+        key = self.key_for(data)
+        path = self._path(key)
+        if os.path.exists(path):
+            return key
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+        with open(tmp, 'wb') as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, path)
+        return key
+
+    def get(self, key):
+        try:
+            with open(self._path(key), 'rb') as f:
+                return f.read()
+        except FileNotFoundError:
+            raise KeyError(key) from None
+
+    def exists(self, key):
+        return os.path.exists(self._path(key))
+
+    def delete(self, key):
+        try:
+            os.remove(self._path(key))
+        except FileNotFoundError:
+            pass
+
+@st.cache_resource(show_spinner=False)
+def get_blob_store():
+    return LocalBlobStore(BLOB_DIR)
+
+def deal_screenshot(deal):
+    """Screenshot bytes of a deal, from the blob store or (not yet migrated) the inline column.
+    None if the deal has none or its blob is missing.
+    """
+    if deal.screenshot_ref:
+        try:
+            return get_blob_store().get(deal.screenshot_ref)
+        except KeyError:
+            logging.getLogger(__name__).warning('Screenshot blob %s of deal %s is missing', deal.screenshot_ref, deal.id)
+            return None
+    return deal.payment_screenshot
+
+# Longest side of deal screenshot previews, in pixels
+THUMBNAIL_PX = 320
+# Deals per page in the salesman's My Deals list
+DEALS_PAGE_SIZE = 10
+
+def make_thumbnail(data, max_px=THUMBNAIL_PX, image_format='WEBP'):
+    """Downscaled copy of an image, at most max_px on its longest side, as WebP
+    (or image_format; JPEG where Pillow cannot write that format).
+    Returns None if Pillow is not installed or data is not a readable image.
+    """
+    try:
+        from PIL import Image, ImageOps
+    except ImportError:
+        return None
+    try:
+        img = ImageOps.exif_transpose(Image.open(io.BytesIO(data)))
+        img.thumbnail((max_px, max_px))
+        out = io.BytesIO()
+        try:
+            img.save(out, format=image_format, quality=70)
+        except (KeyError, OSError):
+            out = io.BytesIO()
+            img.convert('RGB').save(out, format='JPEG', quality=75, optimize=True)
+        return out.getvalue()
+    except Exception:
+        return None
+
+def deal_thumbnails(deal_ids):
+    """Preview bytes per deal id. Deals saved before previews existed get theirs
+    generated (from the full image) and stored on first request.
+    """
+    store = get_blob_store()
+    thumbs = {}
+    with get_session() as db:
+        for deal in db.query(Deal).filter(Deal.id.in_([int(i) for i in deal_ids])):
+            if not deal.thumbnail_ref:
+                content = deal_screenshot(deal)
+                thumb = make_thumbnail(content) if content else None
+                if thumb is None:
+                    continue
+                deal.thumbnail_ref = store.put(thumb)
+            try:
+                thumbs[deal.id] = store.get(deal.thumbnail_ref)
+            except KeyError:
+                pass
+        db.commit()
+    return thumbs
+
+def load_deal_screenshot(deal_id):
+    """Full screenshot bytes of one deal, or None."""
+    with get_session() as db:
+        deal = db.get(Deal, int(deal_id))
+        return deal_screenshot(deal) if deal else None
+
+def migrate_deal_screenshots(batch_size=50, vacuum=False):
+    """Move inline payment_screenshot BLOBs into the blob store, batch by batch.
+    Each batch commits, so an interrupted run resumes where it stopped. VACUUM
+    afterwards returns the freed pages to the filesystem. Returns the number moved.
+    """
+    store = get_blob_store()
+    moved = 0
+    while True:
+        with engine.begin() as conn:
+            rows = conn.exec_driver_sql(
+                "SELECT id, payment_screenshot FROM deals "
+                "WHERE payment_screenshot IS NOT NULL AND screenshot_ref IS NULL LIMIT ?",
+                (batch_size,)
+            ).fetchall()
+            if not rows:
+                break
+            conn.exec_driver_sql(
+                "UPDATE deals SET screenshot_ref = ?, payment_screenshot = NULL WHERE id = ?",
+                [(store.put(bytes(content)), deal_id) for deal_id, content in rows]
+            )
+        moved += len(rows)
+    if vacuum and moved:
+        with engine.connect() as conn:
+            conn.exec_driver_sql("VACUUM")
+            # In WAL mode the file only shrinks once the log is checkpointed
+            conn.exec_driver_sql("PRAGMA wal_checkpoint(TRUNCATE)")
+    return moved
+
+# ----------------- Lead search index -----------------
+# leads_fts is an FTS5 table (rowid = leads.id) holding a search-folded copy of
+# the text columns, kept in sync by triggers. Folding runs in SQL (nested
+# replace()) so the triggers also work for writes made outside this app.
+
+LEAD_SEARCH_COLUMNS = ('name', 'number', 'contact', 'case_desc', 'feedback')
+# Character folds applied to both indexed text and search terms
+ARABIC_SEARCH_FOLDS = (
+    [(chr(c), '') for c in range(0x064B, 0x0653)]  # tashkeel
+    + [('\u0670', ''), ('\u0640', '')]  # superscript alef, tatweel
+    + [(c, '\u0627') for c in '\u0623\u0625\u0622\u0671']  # alef forms
+    + [('\u0649', '\u064A'), ('\u0629', '\u0647')]  # alef maqsura, teh marbuta
+    + [(chr(0x0660 + i), str(i)) for i in range(10)]  # Arabic-Indic digits
+    + [(chr(0x06F0 + i), str(i)) for i in range(10)]  # Eastern Arabic-Indic digits
+)
+_ARABIC_SEARCH_TABLE = str.maketrans({a: b for a, b in ARABIC_SEARCH_FOLDS})
+
+def fold_search_text(text):
+    """normalize_arabic_text() plus the ARABIC_SEARCH_FOLDS used by leads_fts."""
+    text = normalize_arabic_text(text)
+    return text.translate(_ARABIC_SEARCH_TABLE) if text else text
+
+# SQLite's parser overflows at ~30 nested calls, so folds run a few per subquery
+_SQL_FOLDS_PER_STAGE = 12
+
+def _sql_search_fold_select(id_expr, prefix='', source=''):
+    """SELECT yielding (id, folded LEAD_SEARCH_COLUMNS...) for leads_fts."""
+    exprs = {c: f'{prefix}{c}' for c in LEAD_SEARCH_COLUMNS}
+    sql = None
+    for i in range(0, len(ARABIC_SEARCH_FOLDS), _SQL_FOLDS_PER_STAGE):
+        for c in LEAD_SEARCH_COLUMNS:
+            for a, b in ARABIC_SEARCH_FOLDS[i:i + _SQL_FOLDS_PER_STAGE]:
+                exprs[c] = f"replace({exprs[c]}, '{a}', '{b}')"
+        cols = ', '.join(f'{e} AS {c}' for c, e in exprs.items())
+        sql = f"SELECT {id_expr} AS id, {cols} " + (f"FROM ({sql})" if sql else source)
+        id_expr, exprs = 'id', {c: c for c in LEAD_SEARCH_COLUMNS}
+    return sql
+
+def _lead_search_ddl():
+    cols = ', '.join(LEAD_SEARCH_COLUMNS)
+    insert_new = f"INSERT INTO leads_fts (rowid, {cols}) {_sql_search_fold_select('new.id', 'new.')}"
+    return [
+        f"CREATE VIRTUAL TABLE leads_fts USING fts5({cols}, "
+        "tokenize = \"unicode61 remove_diacritics 2 categories 'L* N* Co M*'\")",
+        f"CREATE TRIGGER leads_fts_ai AFTER INSERT ON leads BEGIN {insert_new}; END",
+        "CREATE TRIGGER leads_fts_ad AFTER DELETE ON leads BEGIN "
+        "DELETE FROM leads_fts WHERE rowid = old.id; END",
+        f"CREATE TRIGGER leads_fts_au AFTER UPDATE OF {cols} ON leads BEGIN "
+        f"DELETE FROM leads_fts WHERE rowid = old.id; {insert_new}; END",
+        f"INSERT INTO leads_fts (rowid, {cols}) {_sql_search_fold_select('id', source='FROM leads')}",
+    ]
+
+def ensure_lead_search_index():
+    """(Re)build leads_fts and its triggers when their definition changed.
+    Returns False if this SQLite build has no FTS5; search then falls back to LIKE.
+    """
+    ddl = _lead_search_ddl()
+    version = hashlib.sha256('\n'.join(ddl).encode('utf-8')).hexdigest()
+    with engine.begin() as conn:
+        current = conn.exec_driver_sql("SELECT value FROM settings WHERE key = 'lead_search_version'").scalar()
+        exists = conn.exec_driver_sql("SELECT 1 FROM sqlite_master WHERE name = 'leads_fts'").scalar()
+        if current == version and exists:
+            return True
+        for trigger in ('leads_fts_ai', 'leads_fts_ad', 'leads_fts_au'):
+            conn.exec_driver_sql(f"DROP TRIGGER IF EXISTS {trigger}")
+        conn.exec_driver_sql("DROP TABLE IF EXISTS leads_fts")
+        try:
+            for stmt in ddl:
+                conn.exec_driver_sql(stmt)
+        except sa.exc.OperationalError:
+            # No FTS5 in this SQLite build
+            return False
+        conn.exec_driver_sql(
+            "INSERT INTO settings (key, value) VALUES ('lead_search_version', ?) "
+            "ON CONFLICT(key) DO UPDATE SET value = excluded.value",
+            (version,)
+        )
+    return True
+
+LEADS_FTS = sa.table('leads_fts', sa.column('rowid', Integer), sa.column('rank'))
+
+def lead_search_query(search):
+    """FTS5 MATCH expression for a search box value: every term must match, as a prefix.
+    None when there is nothing to search for or leads_fts is unavailable.
+    """
+    if not search or not bootstrap_database()['lead_search']:
+        return None
+    terms = [t for t in re.split(r'[\W_]+', fold_search_text(search)) if t]
+    if not terms:
+        return None
+    return ' '.join(f'"{t}"*' for t in terms)
+
+# ----------------- Rollup tables -----------------
+# Per-day counts of active leads (by agent, status and contact method) and of
+# deals (by uploader), kept current by triggers on every write path. NULL
+# dimensions are stored as '' so they can be part of the primary key.
+# Each rollup: source table, dimension -> expression over row {r}, which rows
+# count, and the source columns whose updates move a row between buckets.
+ROLLUPS = {
+    'lead_daily_stats': dict(
+        source='leads',
+        dims={
+            'day': "ifnull(date({r}.uploaded_at), '')",
+            'sales_agent': "ifnull({r}.sales_agent, '')",
+            'status': "ifnull({r}.status, '')",
+            'contact': "ifnull({r}.contact, '')",
+        },
+        counted="ifnull({r}.is_archived, 'no') = 'no'",
+        watched=('uploaded_at', 'sales_agent', 'status', 'contact', 'is_archived'),
+    ),
+    'deal_daily_stats': dict(
+        source='deals',
+        dims={'day': "ifnull(date({r}.created_at), '')", 'uploaded_by': "ifnull({r}.uploaded_by, '')"},
+        counted='1',
+        watched=('created_at', 'uploaded_by'),
+    ),
+}
+
+def _missing_triggers(conn, names):
+    existing = {name for name, in conn.exec_driver_sql("SELECT name FROM sqlite_master WHERE type = 'trigger'")}
+    return [name for name in names if name not in existing]
+
+def _rollup_ddl(table, source, dims, counted, watched):
+    """CREATE TABLE plus insert/delete/update triggers that keep `table` equal to
+    SELECT dims, count(*) FROM source WHERE counted GROUP BY dims.
+    """
+    cols = ', '.join(dims)
+    def add(r):
+        values = ', '.join(expr.format(r=r) for expr in dims.values())
+        return (f"INSERT INTO {table} ({cols}, count) SELECT {values}, 1 WHERE {counted.format(r=r)} "
+                f"ON CONFLICT({cols}) DO UPDATE SET count = count + 1;")
+    def remove(r):
+        where = ' AND '.join(f"{d} = {expr.format(r=r)}" for d, expr in dims.items())
+        return (f"UPDATE {table} SET count = count - 1 WHERE {counted.format(r=r)} AND {where}; "
+                f"DELETE FROM {table} WHERE {where} AND count <= 0;")
+    changed = ' OR '.join(f'old.{c} IS NOT new.{c}' for c in watched)
+    return [
+        f"CREATE TABLE {table} ({', '.join(f'{d} TEXT NOT NULL' for d in dims)}, "
+        f"count INTEGER NOT NULL, PRIMARY KEY ({cols})) WITHOUT ROWID",
+        f"CREATE TRIGGER {table}_ai AFTER INSERT ON {source} BEGIN {add('new')} END",
+        f"CREATE TRIGGER {table}_ad AFTER DELETE ON {source} BEGIN {remove('old')} END",
+        f"CREATE TRIGGER {table}_au AFTER UPDATE OF {', '.join(watched)} ON {source} WHEN {changed} "
+        f"BEGIN {remove('old')} {add('new')} END",
+    ]
+
+def rebuild_rollups(conn=None):
+    """Recount every rollup table from its source table (backfill / repair)."""
+    if conn is None:
+        with engine.begin() as conn:
+            return rebuild_rollups(conn)
+    for table, spec in ROLLUPS.items():
+        source = spec['source']
+        key = ', '.join(expr.format(r=source) for expr in spec['dims'].values())
+        conn.exec_driver_sql(f"DELETE FROM {table}")
+        conn.exec_driver_sql(
+            f"INSERT INTO {table} ({', '.join(spec['dims'])}, count) "
+            f"SELECT {key}, count(*) FROM {source} WHERE {spec['counted'].format(r=source)} GROUP BY {key}"
+        )
+
+def ensure_rollups():
+    """(Re)create the rollup tables and triggers when their definition changed, then backfill."""
+    ddl = [stmt for table, spec in ROLLUPS.items() for stmt in _rollup_ddl(table, **spec)]
+    version = hashlib.sha256('\n'.join(ddl).encode('utf-8')).hexdigest()
+    with engine.begin() as conn:
+        current = conn.exec_driver_sql("SELECT value FROM settings WHERE key = 'rollup_version'").scalar()
+        triggers = [f'{table}_{suffix}' for table in ROLLUPS for suffix in ('ai', 'ad', 'au')]
+        if current == version and not _missing_triggers(conn, triggers):
+            return
+        for table in ROLLUPS:
+            for suffix in ('ai', 'ad', 'au'):
+                conn.exec_driver_sql(f"DROP TRIGGER IF EXISTS {table}_{suffix}")
+            conn.exec_driver_sql(f"DROP TABLE IF EXISTS {table}")
+        for stmt in ddl:
+            conn.exec_driver_sql(stmt)
+        rebuild_rollups(conn)
+        conn.exec_driver_sql(
+            "INSERT INTO settings (key, value) VALUES ('rollup_version', ?) "
+            "ON CONFLICT(key) DO UPDATE SET value = excluded.value",
+            (version,)
+        )
+
+LEAD_DAILY_STATS = sa.table(
+    'lead_daily_stats', sa.column('day'), sa.column('sales_agent'), sa.column('status'),
+    sa.column('contact'), sa.column('count', Integer),
+)
+DEAL_DAILY_STATS = sa.table('deal_daily_stats', sa.column('day'), sa.column('uploaded_by'), sa.column('count', Integer))
+
+# ----------------- Query cache -----------------
+# Read helpers decorated with @cached_query keep their results in a per-process
+# LRU cache. Keys include the data_versions counter of every table they read;
+# triggers bump it on each write, so a cached result is never served after the
+# data underneath it changed. The counters restart at 0 whenever the table is
+# rebuilt (or the database replaced), so keys also carry a random per-build epoch.
+VERSIONED_TABLES = ('leads', 'deals', 'comments', 'activities', 'users')
+QUERY_CACHE_MAX_ENTRIES = 512
+DATA_EPOCH_ROW = '_epoch'
+
+def _data_versions_ddl():
+    ddl = [
+        "CREATE TABLE data_versions (table_name TEXT PRIMARY KEY, version INTEGER NOT NULL) WITHOUT ROWID",
+        f"INSERT INTO data_versions (table_name, version) VALUES ('{DATA_EPOCH_ROW}', abs(random()))",
+    ]
+    for table in VERSIONED_TABLES:
+        ddl.append(f"INSERT INTO data_versions (table_name, version) VALUES ('{table}', 0)")
+        bump = f"UPDATE data_versions SET version = version + 1 WHERE table_name = '{table}';"
+        for suffix, event in (('ai', 'INSERT'), ('ad', 'DELETE'), ('au', 'UPDATE')):
+            ddl.append(f"CREATE TRIGGER {table}_version_{suffix} AFTER {event} ON {table} BEGIN {bump} END")
+    return ddl
+
+def ensure_data_versions():
+    """(Re)create data_versions and its bump triggers when their definition changed."""
+    ddl = _data_versions_ddl()
+    version = hashlib.sha256('\n'.join(ddl).encode('utf-8')).hexdigest()
+    with engine.begin() as conn:
+        current = conn.exec_driver_sql("SELECT value FROM settings WHERE key = 'data_versions_version'").scalar()
+        triggers = [f'{table}_version_{suffix}' for table in VERSIONED_TABLES for suffix in ('ai', 'ad', 'au')]
+        if current == version and not _missing_triggers(conn, triggers):
+            return
+        for table in VERSIONED_TABLES:
+            for suffix in ('ai', 'ad', 'au'):
+                conn.exec_driver_sql(f"DROP TRIGGER IF EXISTS {table}_version_{suffix}")
+        conn.exec_driver_sql("DROP TABLE IF EXISTS data_versions")
+        for stmt in ddl:
+            conn.exec_driver_sql(stmt)
+        conn.exec_driver_sql(
+            "INSERT INTO settings (key, value) VALUES ('data_versions_version', ?) "
+            "ON CONFLICT(key) DO UPDATE SET value = excluded.value",
+            (version,)
+        )
+    get_query_cache().clear()
+
+def data_versions(tables):
+    """The data epoch followed by the current write counters of the given tables, in order."""
+    names = (DATA_EPOCH_ROW,) + tuple(tables)
+    with engine.connect() as conn:
+        versions = dict(conn.exec_driver_sql(
+            f"SELECT table_name, version FROM data_versions WHERE table_name IN ({', '.join('?' * len(names))})",
+            names
+        ).fetchall())
+    return tuple(versions.get(t) for t in names)
+
+def _result_size(value):
+    """Approximate memory footprint of a cached result in bytes."""
+    if isinstance(value, pd.DataFrame):
+        return int(value.memory_usage(index=True, deep=True).sum())
+    if isinstance(value, (list, tuple)):
+        return sum(_result_size(v) for v in value)
+    if isinstance(value, dict):
+        return sum(_result_size(v) for v in value.values())
+    return sys.getsizeof(value)
+
+def _result_copy(value):
+    """Hand callers their own frames so edits don't leak into the cache. The copies are deep:
+    a shallow one shares its data unless pandas copy-on-write is on, which pandas 2 leaves off.
+    """
+    if isinstance(value, pd.DataFrame):
+        return value.copy(deep=True)
+    if isinstance(value, tuple):
+        return tuple(_result_copy(v) for v in value)
+    if isinstance(value, list):
+        return [_result_copy(v) for v in value]
+    if isinstance(value, dict):
+        return {k: _result_copy(v) for k, v in value.items()}
+    return value
+
+class QueryCache:
+    """Thread-safe LRU map bounded by entry count and approximate bytes, with hit/miss counters."""
+
+    def __init__(self, max_entries, max_bytes):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()  # key -> (value, size)
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = self.misses = self.evictions = 0
+
+    def get(self, key):
+        """(True, value) on a hit, (False, None) on a miss."""
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return True, self._entries[key][0]
+            self.misses += 1
+            return False, None
+
+    def put(self, key, value):
+        size = _result_size(value)
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._entries:
+                self._bytes -= self._entries.pop(key)[1]
+            self._entries[key] = (value, size)
+            self._bytes += size
+            while len(self._entries) > self.max_entries or self._bytes > self.max_bytes:
+                _, (_, evicted) = self._entries.popitem(last=False)
+                self._bytes -= evicted
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'entries': len(self._entries), 'size_mb': round(self._bytes / 2**20, 2),
+                'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions,
+                'hit_rate': round(self.hits / lookups, 3) if lookups else None,
+            }
+
+@st.cache_resource(show_spinner=False)
+def get_query_cache():
+    return QueryCache(QUERY_CACHE_MAX_ENTRIES, int(QUERY_CACHE_MB * 2**20))
+
+def cached_query(*tables):
+    """Cache a read helper's result until one of `tables` is written to.
+    Arguments must be JSON-serializable (dates and other scalars go through str()).
+    """
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            cache = get_query_cache()
+            key = (fn.__qualname__, json.dumps([args, kwargs], sort_keys=True, default=str), data_versions(tables))
+            hit, value = cache.get(key)
+            if not hit:
+                value = fn(*args, **kwargs)
+                cache.put(key, value)
+            return _result_copy(value)
+        wrapper.uncached = fn
+        return wrapper
+    return decorator
+
+# ----------------- Bootstrap -----------------
+# Streamlit re-executes this script on every widget interaction, so one-time
+# startup work lives behind st.cache_resource (once per process) and the
+# schema_version marker in settings (once per database).
+# Bump SCHEMA_VERSION whenever the models or ensure_schema() change.
+SCHEMA_VERSION = '5'
+
+def get_schema_version():
+    try:
+        with engine.connect() as conn:
+            return conn.exec_driver_sql("SELECT value FROM settings WHERE key = 'schema_version'").scalar()
+    except sa.exc.OperationalError:
+        # Fresh database: the settings table does not exist yet
+        return None
+
+def migrate_database():
+    """Create tables and run ensure_schema() unless the database is already at SCHEMA_VERSION.
+    Returns True if migrations were applied.
+    """
+    if get_schema_version() == SCHEMA_VERSION:
+        return False
+    Base.metadata.create_all(bind=engine)
+    ensure_schema()
+    with engine.begin() as conn:
+        conn.exec_driver_sql(
+            "INSERT INTO settings (key, value) VALUES ('schema_version', ?) "
+            "ON CONFLICT(key) DO UPDATE SET value = excluded.value",
+            (SCHEMA_VERSION,)
+        )
+    return True
+
+@st.cache_resource(show_spinner=False)
+def bootstrap_database():
+    """Run schema migration and demo-user seeding once per process."""
+    migrated = migrate_database()
+    lead_search = ensure_lead_search_index()
+    ensure_rollups()
+    ensure_data_versions()
+    ensure_demo_users()
+    return {'schema_version': SCHEMA_VERSION, 'migrated': migrated, 'lead_search': lead_search}
+
+bootstrap_database()
+
+# ----------------- Reference data -----------------
+# Users, roles and agent names feed dropdowns on most pages. They are cached per
+# process like any @cached_query reader; the users table's version triggers drop
+# them as soon as a user is created, changed or deleted.
+@cached_query('users')
+def user_directory():
+    """Every user as a dict of id, username, name, role and created_at (no password hash), by id."""
+    with engine.connect() as conn:
+        rows = conn.execute(
+            sa.select(User.id, User.username, User.name, User.role, User.created_at).order_by(User.id)
+        ).mappings().all()
+    return [dict(r) for r in rows]
+
+def usernames(role=None):
+    """Usernames in alphabetical order, optionally only those with `role`."""
+    return sorted(u['username'] for u in user_directory() if role is None or u['role'] == role)
 
 # ----------------- Activity logger -----------------
+# Audit entries are buffered on the session and written with one executemany
+# when it commits, so logging inside loops costs no extra round trips or
+# commits. A rollback discards them along with the rest of the unit of work.
+
+PENDING_ACTIVITIES = 'pending_activities'
+
+def log_activities(db, rows, actor, action):
+    """Queue (lead_id, detail) audit entries; they are written when db commits."""
+    now = datetime.utcnow()
+    db.info.setdefault(PENDING_ACTIVITIES, []).extend(
+        {'lead_id': lead_id, 'actor': actor, 'action': action, 'detail': detail, 'timestamp': now}
+        for lead_id, detail in rows
+    )
 
 def log_activity(db, lead_id, actor, action, detail=None):
-    act = Activity(lead_id=lead_id, actor=actor, action=action, detail=detail)
-    db.add(act)
-    db.commit()
+    """Queue one audit entry; it is written when db commits."""
+    log_activities(db, [(lead_id, detail)], actor, action)
+
+@sa.event.listens_for(SessionLocal, 'before_commit')
+def flush_activity_log(session):
+    pending = session.info.pop(PENDING_ACTIVITIES, None)
+    if pending:
+        session.execute(sa.insert(Activity.__table__), pending)
+
+@sa.event.listens_for(SessionLocal, 'after_soft_rollback')
+def discard_activity_log(session, previous_transaction):
+    session.info.pop(PENDING_ACTIVITIES, None)
+
+class WriteBehindBuffer:
+    """Queue for non-critical rows (login events) that a daemon thread inserts
+    every `interval` seconds, one executemany per table. Rows still queued at
+    exit are written by an atexit hook; a failed batch is logged and dropped.
+    """
+
+    def __init__(self, interval):
+        self.interval = interval
+        self.rows = queue.Queue()
+        self.lock = threading.Lock()
+        threading.Thread(target=self._run, name='crm-write-behind', daemon=True).start()
+        atexit.register(self.flush)
+
+    def submit(self, table, row):
+        self.rows.put((table, row))
+
+    def flush(self):
+        with self.lock:
+            batches = {}
+            while True:
+                try:
+                    table, row = self.rows.get_nowait()
+                except queue.Empty:
+                    break
+                batches.setdefault(table, []).append(row)
+            for table, rows in batches.items():
+                try:
+                    with engine.begin() as conn:
+                        conn.execute(sa.insert(table), rows)
+                except Exception:
+                    logging.getLogger(__name__).exception('Dropped %d queued %s rows', len(rows), table.name)
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            self.flush()
+
+@st.cache_resource(show_spinner=False)
+def get_write_behind_buffer():
+    return WriteBehindBuffer(WRITE_BEHIND_SECONDS)
+
+def record_login_event(user):
+    row = {'username': user.username, 'role': user.role, 'logged_in_at': datetime.utcnow()}
+    if WRITE_BEHIND_SECONDS > 0:
+        get_write_behind_buffer().submit(LoginEvent.__table__, row)
+    else:
+        with engine.begin() as conn:
+            conn.execute(sa.insert(LoginEvent.__table__), [row])
 
 # ----------------- Archiving helpers -----------------
 
+# Ids per IN (...) list; older SQLite builds cap a statement at 999 parameters
+LEAD_ID_CHUNK = 900
+
+def _id_chunks(lead_ids):
+    ids = list(dict.fromkeys(int(i) for i in lead_ids))
+    for start in range(0, len(ids), LEAD_ID_CHUNK):
+        yield ids[start:start + LEAD_ID_CHUNK]
+
+def _update_leads(db, lead_ids, values):
+    """UPDATE leads by id, chunk by chunk. Returns the ids that existed."""
+    table = Lead.__table__
+    updated = []
+    for chunk in _id_chunks(lead_ids):
+        updated += db.execute(
+            sa.update(table).where(table.c.id.in_(chunk)).values(**values).returning(table.c.id)
+        ).scalars().all()
+    return updated
+
+def bulk_archive_leads(db, lead_ids, archived_by, reason=None, archive_date=None):
+    """Archive leads and log one activity each in a single transaction. Returns the number archived."""
+    try:
+        archived = _update_leads(db, lead_ids, {
+            'is_archived': 'yes', 'archived_by': archived_by, 'archived_at': datetime.utcnow(),
+            'archive_reason': reason, 'archive_date': archive_date,
+        })
+        log_activities(db, [(i, f'Archived: {reason}') for i in archived], archived_by, 'archive')
+        db.commit()
+    except Exception:
+        db.rollback()
+        raise
+    return len(archived)
+
+def bulk_unarchive_leads(db, lead_ids, unarchived_by):
+    """Unarchive leads and log one activity each in a single transaction. Returns the number unarchived."""
+    try:
+        unarchived = _update_leads(db, lead_ids, {
+            'is_archived': 'no', 'archived_by': None, 'archived_at': None,
+            'archive_reason': None, 'archive_date': None,
+        })
+        log_activities(db, [(i, 'Lead unarchived') for i in unarchived], unarchived_by, 'unarchive')
+        db.commit()
+    except Exception:
+        db.rollback()
+        raise
+    return len(unarchived)
+
+def bulk_delete_leads_from_db(db, lead_ids, deleted_by, reason=None):
+    """Permanently delete leads with their activities and comments in a single transaction.
+    The audit rows keep the lead id in their detail, since lead_id can no longer point at the lead.
+    Returns the number deleted.
+    """
+    table = Lead.__table__
+    deleted = []
+    try:
+        for chunk in _id_chunks(lead_ids):
+            # Children first (foreign keys are enforced)
+            db.execute(sa.delete(Activity.__table__).where(Activity.__table__.c.lead_id.in_(chunk)))
+            db.execute(sa.delete(Comment.__table__).where(Comment.__table__.c.lead_id.in_(chunk)))
+            deleted += db.execute(
+                sa.delete(table).where(table.c.id.in_(chunk)).returning(table.c.id)
+            ).scalars().all()
+        log_activities(db, [(None, f'Lead {i} permanently deleted: {reason}') for i in deleted], deleted_by, 'delete')
+        db.commit()
+    except Exception:
+        db.rollback()
+        raise
+    return len(deleted)
+
 def archive_lead(db, lead_id, archived_by, reason=None, archive_date=None):
     """Archive a lead by CTO"""
-    lead = db.query(Lead).get(lead_id)
-    if lead:
-        lead.is_archived = 'yes'
-        lead.archived_by = archived_by
-        lead.archived_at = datetime.utcnow()
-        lead.archive_reason = reason
-        lead.archive_date = archive_date
-        db.add(lead)
-        db.commit()
-        log_activity(db, lead_id, archived_by, 'archive', detail=f'Archived: {reason}')
-        return True
-    return False
+    return bulk_archive_leads(db, [lead_id], archived_by, reason, archive_date) == 1
 
 def unarchive_lead(db, lead_id, unarchived_by):
     """Unarchive a lead by CTO"""
-    lead = db.query(Lead).get(lead_id)
-    if lead:
-        lead.is_archived = 'no'
-        lead.archived_by = None
-        lead.archived_at = None
-        lead.archive_reason = None
-        lead.archive_date = None
-        db.add(lead)
-        db.commit()
-        log_activity(db, lead_id, unarchived_by, 'unarchive', detail='Lead unarchived')
-        return True
-    return False
+    return bulk_unarchive_leads(db, [lead_id], unarchived_by) == 1
 
 def delete_lead_from_db(db, lead_id, deleted_by, reason=None):
     """Permanently delete a lead from database"""
-    lead = db.query(Lead).get(lead_id)
-    if lead:
-        # Log the deletion before removing
-        log_activity(db, lead_id, deleted_by, 'delete', detail=f'Lead permanently deleted: {reason}')
-        
-        # Delete related activities and comments first (due to foreign key constraints)
-        db.query(Activity).filter(Activity.lead_id == lead_id).delete()
-        db.query(Comment).filter(Comment.lead_id == lead_id).delete()
-        
-        # Delete the lead
-        db.delete(lead)
-        db.commit()
-        return True
-    return False
-
-def bulk_delete_leads_from_db(db, lead_ids, deleted_by, reason=None):
-    """Bulk delete multiple leads from database"""
-    deleted_count = 0
-    for lead_id in lead_ids:
-        if delete_lead_from_db(db, lead_id, deleted_by, reason):
-            deleted_count += 1
-    return deleted_count
-
-def bulk_archive_leads(db, lead_ids, archived_by, reason=None, archive_date=None):
-    """Bulk archive multiple leads"""
-    archived_count = 0
-    for lead_id in lead_ids:
-        if archive_lead(db, lead_id, archived_by, reason, archive_date):
-            archived_count += 1
-    return archived_count
+    return bulk_delete_leads_from_db(db, [lead_id], deleted_by, reason) == 1
 
 def get_archived_leads_by_date(db, date_filter=None):
     """Get archived leads filtered by date"""
-    q = db.query(Lead).filter(Lead.is_archived == 'yes')
+    q = db.query(Lead).filter(LEAD_IS_ARCHIVED)
     
     if date_filter:
         if isinstance(date_filter, (list, tuple)) and len(date_filter) == 2:
@@ -468,7 +1357,7 @@ def generate_archived_leads_analytics(df):
 
 def export_archived_leads_report(db, date_range=None, format='excel', include_graphs=False):
     """Export archived leads report with date information and optional graphs"""
-    q = db.query(Lead).filter(Lead.is_archived == 'yes')
+    q = db.query(Lead).filter(LEAD_IS_ARCHIVED)
     
     if date_range:
         if isinstance(date_range, (list, tuple)) and len(date_range) == 2:
@@ -543,6 +1432,1270 @@ def export_archived_leads_report(db, date_range=None, format='excel', include_gr
     else:
         return df.to_csv(index=False)
 
+# ----------------- Lead distribution -----------------
+# Distribution runs as a handful of set-based statements: per-agent quotas are
+# worked out from counts, then a single UPDATE ... FROM numbers the picked
+# leads with row_number() over a random order and maps each number to an agent.
+DISTRIBUTION_STRATEGIES = {
+    'equal': 'Equal (round-robin)',
+    'weighted': 'Weighted',
+    'capacity': 'Capacity-aware (cap open leads per salesman)',
+    'least_loaded': 'Least-loaded first',
+}
+# A lead still being worked: not archived, not won or lost
+LEAD_IS_OPEN = sa.and_(LEAD_IS_ACTIVE, sa.func.coalesce(Lead.status, 'new').notin_(('won', 'lost')))
+
+def agent_open_loads(db, agents):
+    """{agent: open leads assigned to it} for the given agents."""
+    rows = (db.query(Lead.assigned_to, func.count(Lead.id))
+            .filter(LEAD_IS_OPEN, Lead.assigned_to.in_(agents))
+            .group_by(Lead.assigned_to).all())
+    loads = dict.fromkeys(agents, 0)
+    loads.update(rows)
+    return loads
+
+def _weighted_quotas(agents, weights, n):
+    """Split n in proportion to weights (largest remainder)."""
+    w = [max(0.0, float(weights.get(a, 0) or 0)) for a in agents]
+    total = sum(w)
+    if total <= 0:
+        raise ValueError('Give at least one salesman a weight above zero.')
+    exact = [n * x / total for x in w]
+    quotas = [int(x) for x in exact]
+    by_remainder = sorted(range(len(agents)), key=lambda i: exact[i] - quotas[i], reverse=True)
+    for i in by_remainder[:n - sum(quotas)]:
+        quotas[i] += 1
+    return dict(zip(agents, quotas))
+
+def _fill_quotas(loads, n, capacity=None):
+    """Give n leads one at a time to whoever has the fewest open leads, never
+    taking anyone past capacity. Stops early once everyone is full.
+    """
+    heap = [(load, a) for a, load in loads.items() if capacity is None or load < capacity]
+    heapq.heapify(heap)
+    quotas = dict.fromkeys(loads, 0)
+    for _ in range(n):
+        if not heap:
+            break
+        load, a = heapq.heappop(heap)
+        quotas[a] += 1
+        if capacity is None or load + 1 < capacity:
+            heapq.heappush(heap, (load + 1, a))
+    return quotas
+
+def distribute_unassigned_leads(db, agents, actor, limit=0, strategy='equal', weights=None, capacity=None):
+    """Assign the oldest unassigned leads (all, or the first `limit`) to agents, in
+    random order, by strategy (see DISTRIBUTION_STRATEGIES):
+    equal shares, shares in proportion to `weights`, least-loaded first without
+    taking anyone past `capacity` open leads, or least-loaded first.
+    Returns {agent: leads assigned}.
+
+    Concurrent distributions are serialized on a settings row, so quotas are
+    always worked out from the loads the previous distribution left behind.
+    """
+    agents = list(dict.fromkeys(agents))
+    if strategy not in DISTRIBUTION_STRATEGIES:
+        raise ValueError(f'Unknown distribution strategy: {strategy}')
+    assigned_count = dict.fromkeys(agents, 0)
+    try:
+        # Take the write lock first; a second CTO waits here until this commits
+        db.execute(sa.text(
+            "INSERT INTO settings (key, value) VALUES ('lead_distribution', :v) "
+            "ON CONFLICT(key) DO UPDATE SET value = excluded.value"
+        ), {'v': f'{actor} {datetime.utcnow().isoformat(timespec="seconds")}'})
+
+        n = db.query(func.count(Lead.id)).filter(LEAD_IS_UNASSIGNED).scalar()
+        if limit and limit > 0:
+            n = min(n, int(limit))
+        if strategy == 'weighted':
+            quotas = _weighted_quotas(agents, weights or {}, n)
+        elif strategy in ('capacity', 'least_loaded'):
+            loads = agent_open_loads(db, agents)
+            quotas = _fill_quotas(loads, n, capacity if strategy == 'capacity' else None)
+        else:
+            quotas = None
+        if quotas is not None:
+            n = sum(quotas.values())
+        if not n or not agents:
+            db.rollback()
+            return assigned_count
+
+        leads = Lead.__table__
+        oldest = (sa.select(leads.c.id).where(LEAD_IS_UNASSIGNED)
+                  .order_by(leads.c.uploaded_at.asc(), leads.c.id.asc()).limit(n).subquery())
+        picked = sa.select(
+            oldest.c.id, (sa.func.row_number().over(order_by=sa.func.random()) - 1).label('rn')
+        ).subquery()
+        if quotas is None:
+            # Equal shares: row number modulo the agent count
+            agent = sa.case(*[(picked.c.rn % len(agents) == i, a) for i, a in enumerate(agents)])
+        else:
+            # Quotas: consecutive runs of row numbers
+            bounds, upto = [], 0
+            for a in agents:
+                if quotas[a]:
+                    upto += quotas[a]
+                    bounds.append((picked.c.rn < upto, a))
+            agent = sa.case(*bounds)
+        assigned = db.execute(
+            sa.update(leads).where(leads.c.id == picked.c.id)
+            .values(sales_agent=agent, assigned_to=agent)
+            .returning(leads.c.id, leads.c.assigned_to)
+        ).all()
+        log_activities(db, [(lead_id, f'Assigned to {a} by CTO') for lead_id, a in assigned], actor, 'assign')
+        db.commit()
+    except Exception:
+        db.rollback()
+        raise
+    for _, a in assigned:
+        assigned_count[a] += 1
+    return assigned_count
+
+# ----------------- Query helpers -----------------
+
+def encode_cursor(sort_value, row_id):
+    """Opaque keyset cursor for the row a page ended on: (sort value, id)."""
+    if sort_value is not None and pd.isna(sort_value):
+        sort_value = None
+    elif isinstance(sort_value, (datetime, pd.Timestamp)):
+        sort_value = {'dt': pd.Timestamp(sort_value).isoformat()}
+    payload = json.dumps([sort_value, int(row_id)], default=str)
+    return base64.urlsafe_b64encode(payload.encode('utf-8')).decode('ascii')
+
+def decode_cursor(cursor):
+    """Inverse of encode_cursor(). Returns (sort value, id), or None for a missing/garbled cursor."""
+    if not cursor:
+        return None
+    try:
+        sort_value, row_id = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')))
+    except (ValueError, TypeError):
+        return None
+    if isinstance(sort_value, dict) and 'dt' in sort_value:
+        sort_value = pd.Timestamp(sort_value['dt']).to_pydatetime()
+    return sort_value, int(row_id)
+
+def apply_keyset(q, col, id_col, cursor, desc=True):
+    """Order q by (col, id) and keep only rows after cursor.
+    SQLite sorts NULL first ascending and last descending; the filter follows that.
+    """
+    q = q.order_by(col.desc(), id_col.desc()) if desc else q.order_by(col.asc(), id_col.asc())
+    decoded = decode_cursor(cursor)
+    if decoded is None:
+        return q
+    value, last_id = decoded
+    if desc:
+        if value is None:
+            return q.filter(col.is_(None), id_col < last_id)
+        return q.filter(sa.or_(col < value, sa.and_(col == value, id_col < last_id), col.is_(None)))
+    if value is None:
+        return q.filter(sa.or_(sa.and_(col.is_(None), id_col > last_id), col.isnot(None)))
+    return q.filter(sa.or_(col > value, sa.and_(col == value, id_col > last_id)))
+
+def next_cursor(df, order_by, limit):
+    """Cursor for the page after df, or None on the last page (or an unlimited read)."""
+    if df.empty or limit is None or len(df) < limit or order_by not in df.columns:
+        return None
+    last = df.iloc[-1]
+    return encode_cursor(last[order_by], last['id'])
+
+def _lead_query(db, filters=None, search=None, include_archived=False):
+    q = db.query(Lead)
+
+    # Default filter: exclude archived leads unless specifically requested
+    if not include_archived:
+        q = q.filter(LEAD_IS_ACTIVE)
+
+    if filters:
+        for k, v in filters.items():
+            if k == 'sales_agent' and v != 'All':
+                q = q.filter(Lead.sales_agent == v)
+            if k == 'status' and v != 'All':
+                q = q.filter(Lead.status == v)
+            if k == 'is_archived' and v != 'All':
+                q = q.filter(LEAD_IS_ARCHIVED if v == 'yes' else Lead.is_archived == v)
+            if k == 'archived_by' and v != 'All':
+                q = q.filter(Lead.archived_by == v)
+
+    fts_query = lead_search_query(search)
+    if fts_query:
+        q = q.join(LEADS_FTS, LEADS_FTS.c.rowid == Lead.id).filter(sa.literal_column('leads_fts').op('MATCH')(fts_query))
+    elif search:
+        like = f"%{search}%"
+        q = q.filter(sa.or_(Lead.name.ilike(like), Lead.number.ilike(like), Lead.contact.ilike(like)))
+    return q
+
+@cached_query('leads')
+def count_leads(filters=None, search=None, include_archived=False):
+    with get_session() as db:
+        return _lead_query(db, filters, search, include_archived).count()
+
+# Column sets for read_leads_df(columns=...). Views that don't show the long text
+# columns (case_desc, feedback, archive_reason) leave them in SQLite.
+LEAD_VIEWS = {
+    'summary': ['id', 'number', 'name', 'sales_agent', 'contact', 'status', 'assigned_to', 'uploaded_at'],
+    'list': ['id', 'number', 'name', 'sales_agent', 'contact', 'case_desc', 'feedback', 'status', 'assigned_to',
+             'uploaded_at'],
+    'archived': ['id', 'number', 'name', 'sales_agent', 'status', 'archived_by', 'archived_at', 'archive_reason',
+                 'uploaded_at'],
+}
+
+def lead_columns(columns=None, required=()):
+    """Lead columns for a LEAD_VIEWS name or a list of column names (None: every
+    column), plus any `required` names not already in it.
+    """
+    if columns is None:
+        return list(Lead.__table__.columns)
+    names = list(LEAD_VIEWS[columns] if isinstance(columns, str) else columns)
+    names += [name for name in required if name not in names]
+    return [Lead.__table__.c[name] for name in names]
+
+@cached_query('leads')
+def read_leads_df(filters=None, search=None, order_by='uploaded_at', desc=True, limit=100, offset=0,
+                  include_archived=False, cursor=None, count='exact', columns=None):
+    """Read one page of leads. Pass cursor (from df.attrs['next_cursor']) for keyset
+    paging on (order_by, id) instead of offset. count: 'exact' runs COUNT(*),
+    'cached' takes the total from count_leads() (cached until leads change), None skips it.
+    order_by='relevance' ranks full-text search matches best first (newest first without a search).
+    limit=None reads every match. columns picks what is selected (see lead_columns()); id and the sort column are always included.
+    """
+    db = get_session()
+    q = _lead_query(db, filters, search, include_archived)
+    if columns is not None:
+        sort_name = order_by if order_by in Lead.__table__.c else 'uploaded_at'
+        q = q.with_entities(*lead_columns(columns, required=('id', sort_name)))
+    sort_col = None
+    if order_by == 'relevance':
+        if lead_search_query(search):
+            # bm25 rank: lower is better
+            sort_col, desc = LEADS_FTS.c.rank, False
+            q = q.add_columns(sort_col.label('relevance'))
+        else:
+            order_by = 'uploaded_at'
+    if order_by and sort_col is None:
+        sort_col = getattr(Lead, order_by)
+
+    if count == 'cached':
+        total = count_leads(filters, search, include_archived)
+    elif count:
+        total = q.count()
+    else:
+        total = None
+    if order_by:
+        q = apply_keyset(q, sort_col, Lead.id, cursor, desc)
+    if not cursor:
+        q = q.offset(offset)
+    q = q.limit(limit)
+    df = pd.read_sql(q.statement, q.session.bind)
+    db.close()
+    df.attrs['next_cursor'] = next_cursor(df, order_by, limit)
+    return df, total
+
+def _deal_query(db, filters=None, search=None):
+    q = db.query(Deal)
+    if filters:
+        for k, v in filters.items():
+            if k == 'uploaded_by' and v != 'All':
+                q = q.filter(Deal.uploaded_by == v)
+    if search:
+        like = f"%{search}%"
+        q = q.filter(sa.or_(Deal.customer_name.ilike(like), Deal.phone.ilike(like)))
+    return q
+
+@cached_query('deals')
+def count_deals(filters=None, search=None):
+    with get_session() as db:
+        return _deal_query(db, filters, search).count()
+
+@cached_query('deals')
+def read_deals_df(filters=None, search=None, order_by='created_at', desc=True, limit=1000, offset=0,
+                  cursor=None, count='exact'):
+    """Read one page of deal metadata (no screenshots); paging, count and limit=None work
+    as in read_leads_df(). Filters and search are applied in SQL before paging.
+    """
+    db = get_session()
+    q = _deal_query(db, filters, search)
+    if count == 'cached':
+        total = count_deals(filters, search)
+    elif count:
+        total = q.count()
+    else:
+        total = None
+    if order_by:
+        q = apply_keyset(q, getattr(Deal, order_by), Deal.id, cursor, desc)
+    if not cursor:
+        q = q.offset(offset)
+    q = q.limit(limit)
+    # Exclude large binary column when reading to DataFrame
+    q = q.with_entities(Deal.id, Deal.customer_name, Deal.phone, Deal.uploaded_by, Deal.uploaded_by_id, Deal.created_at)
+    df = pd.read_sql(q.statement, q.session.bind)
+    db.close()
+    df.attrs['next_cursor'] = next_cursor(df, order_by, limit)
+    return df, total
+
+def explain_query_plan(conn, stmt):
+    """SQLite EXPLAIN QUERY PLAN detail lines for a SQLAlchemy statement."""
+    compiled = stmt.compile(dialect=engine.dialect, compile_kwargs={'render_postcompile': True})
+    params = compiled.construct_params()
+    args = tuple(params[k].isoformat(' ') if isinstance(params[k], datetime) else params[k]
+                 for k in compiled.positiontup)
+    return [row[-1] for row in conn.exec_driver_sql(f"EXPLAIN QUERY PLAN {compiled}", args)]
+
+def index_usage_report():
+    """Which index each of the app's main query shapes uses, per EXPLAIN QUERY PLAN."""
+    since = datetime.utcnow() - pd.Timedelta(days=30)
+    with get_session() as db:
+        shapes = {
+            'Active leads, newest first': apply_keyset(_lead_query(db), Lead.uploaded_at, Lead.id, None).limit(25),
+            "Agent's leads (My Leads)": apply_keyset(
+                _lead_query(db, {'sales_agent': 'agent'}), Lead.uploaded_at, Lead.id, None).limit(25),
+            'Active leads by status': apply_keyset(
+                _lead_query(db, {'status': 'new'}), Lead.uploaded_at, Lead.id, None).limit(25),
+            'Recently assigned leads': db.query(Lead).filter(Lead.assigned_to.isnot(None))
+                .order_by(Lead.uploaded_at.desc()).limit(50),
+            'Archived leads since date': db.query(Lead).filter(LEAD_IS_ARCHIVED, Lead.archived_at >= since)
+                .order_by(Lead.archived_at.desc()),
+            'Archives per day': db.query(func.date(Lead.archived_at), func.count(Lead.id))
+                .filter(LEAD_IS_ARCHIVED, Lead.archived_at >= since).group_by(func.date(Lead.archived_at)),
+            'Archives by reason': db.query(Lead.archive_reason, func.count(Lead.id))
+                .filter(LEAD_IS_ARCHIVED).group_by(Lead.archive_reason),
+            'Archives by agent': db.query(Lead.archived_by, func.count(Lead.id))
+                .filter(LEAD_IS_ARCHIVED).group_by(Lead.archived_by),
+            'Lead history': db.query(Activity).filter(Activity.lead_id == 1),
+            'Recent activity': db.query(Activity).order_by(Activity.timestamp.desc()).limit(20),
+            'Lead comments': db.query(Comment).filter(Comment.lead_id == 1).order_by(Comment.created_at),
+            "Salesman's deals": apply_keyset(
+                _deal_query(db, {'uploaded_by': 'agent'}), Deal.created_at, Deal.id, None).limit(25),
+        }
+        conn = db.connection()
+        rows = []
+        for name, q in shapes.items():
+            plan = explain_query_plan(conn, q.statement)
+            indexes = sorted({m for line in plan for m in re.findall(r'INDEX (\w+)', line)})
+            rows.append({
+                'Query': name,
+                'Indexes': ', '.join(indexes) or '-',
+                'Full scan': any(line.startswith('SCAN') and 'INDEX' not in line for line in plan),
+                'Plan': ' / '.join(plan),
+            })
+    return pd.DataFrame(rows)
+
+# ----------------- Dashboard aggregations -----------------
+# The CTO and CEO dashboards group in SQL and pull back only small frames, so
+# charts cover every active lead. Both views render the same LEAD_CHARTS.
+
+FUNNEL_STATUSES = ['new', 'contacted', 'qualified', 'won', 'lost']
+# strftime('%w') order
+WEEKDAY_NAMES = ['Sunday', 'Monday', 'Tuesday', 'Wednesday', 'Thursday', 'Friday', 'Saturday']
+# Category values treated as blank in the top-categories charts
+PLACEHOLDER_VALUES = ('', 'na', 'n/a', 'none', 'null', '-')
+
+def dashboard_conditions(filters=None):
+    """WHERE terms for active leads matching dashboard filters: start/end dates, agents, statuses."""
+    filters = filters or {}
+    conds = [LEAD_IS_ACTIVE]
+    if filters.get('start'):
+        conds.append(Lead.uploaded_at >= pd.Timestamp(filters['start']).to_pydatetime())
+    if filters.get('end'):
+        conds.append(Lead.uploaded_at < (pd.Timestamp(filters['end']) + pd.Timedelta(days=1)).to_pydatetime())
+    if filters.get('agents'):
+        conds.append(Lead.sales_agent.in_(list(filters['agents'])))
+    if filters.get('statuses'):
+        conds.append(Lead.status.in_(list(filters['statuses'])))
+    return conds
+
+def rollup_conditions(filters=None):
+    """dashboard_conditions() for lead_daily_stats; day is already restricted to active leads."""
+    filters = filters or {}
+    stats = LEAD_DAILY_STATS.c
+    conds = []
+    if filters.get('start'):
+        conds.append(stats.day >= pd.Timestamp(filters['start']).strftime('%Y-%m-%d'))
+    if filters.get('end'):
+        conds.append(stats.day <= pd.Timestamp(filters['end']).strftime('%Y-%m-%d'))
+    if filters.get('agents'):
+        conds.append(stats.sales_agent.in_(list(filters['agents'])))
+    if filters.get('statuses'):
+        conds.append(stats.status.in_(list(filters['statuses'])))
+    return conds
+
+def _read_aggregate(stmt):
+    with engine.connect() as conn:
+        return pd.read_sql(stmt, conn)
+
+@cached_query('leads')
+def lead_filter_options():
+    """First/last upload date and agent names of active leads, for the dashboard filter widgets."""
+    with engine.connect() as conn:
+        first, last = conn.execute(
+            sa.select(func.min(func.date(Lead.uploaded_at)), func.max(func.date(Lead.uploaded_at))).where(LEAD_IS_ACTIVE)
+        ).one()
+        agents = conn.execute(
+            sa.select(Lead.sales_agent).where(LEAD_IS_ACTIVE, Lead.sales_agent.isnot(None))
+            .distinct().order_by(Lead.sales_agent)
+        ).scalars().all()
+    to_date = lambda v: pd.Timestamp(v).date() if v else None
+    return {'first_date': to_date(first), 'last_date': to_date(last), 'agents': agents}
+
+@cached_query('leads')
+def lead_kpis(filters=None):
+    """Total leads, distinct contacts and top agent for the filtered active leads."""
+    conds = dashboard_conditions(filters)
+    with engine.connect() as conn:
+        total, contacts = conn.execute(
+            sa.select(func.count(), func.count(Lead.contact.distinct())).where(*conds)
+        ).one()
+        top_agent = conn.execute(
+            sa.select(Lead.sales_agent).where(*conds, Lead.sales_agent.isnot(None))
+            .group_by(Lead.sales_agent).order_by(func.count().desc()).limit(1)
+        ).scalar()
+    return {'total': total, 'unique_contacts': contacts, 'top_agent': top_agent or '—'}
+
+@cached_query('leads')
+def lead_agent_summary(filters=None):
+    """Leads and distinct contacts per agent."""
+    return _read_aggregate(
+        sa.select(Lead.sales_agent, func.count(Lead.id).label('leads'),
+                  func.count(Lead.contact.distinct()).label('unique_contacts'))
+        .where(*dashboard_conditions(filters), Lead.sales_agent.isnot(None)).group_by(Lead.sales_agent)
+    )
+
+def top_categories(column, filters=None, top_n=20):
+    """Most common normalized (trimmed, lower-cased) values of a lead text column."""
+    value = func.lower(func.trim(getattr(Lead, column)))
+    return _read_aggregate(
+        sa.select(value.label(column), func.count().label('count'))
+        .where(*dashboard_conditions(filters), value.notin_(PLACEHOLDER_VALUES))
+        .group_by(value).order_by(sa.literal_column('count').desc()).limit(top_n)
+    )
+
+def feedback_top_words(filters=None, top_n=30):
+    """Most common feedback words longer than 3 characters. Grouping identical
+    feedback texts in SQL first keeps the Python side small.
+    """
+    texts = _read_aggregate(
+        sa.select(Lead.feedback, func.count().label('n'))
+        .where(*dashboard_conditions(filters), Lead.feedback.isnot(None)).group_by(Lead.feedback)
+    )
+    words = {}
+    for text, n in zip(texts['feedback'], texts['n']):
+        for w in str(text).lower().split():
+            w = w.strip('.,!?:;()"\'')
+            if len(w) > 3:
+                words[w] = words.get(w, 0) + n
+    wc = pd.Series(words, dtype='int64').sort_values(ascending=False).head(top_n).reset_index()
+    wc.columns = ['word', 'count']
+    return wc
+
+@cached_query('leads')
+def lead_dashboard_frames(filters=None):
+    """All lead chart frames for the filtered active leads, keyed like LEAD_CHARTS.
+    Day, agent, status and contact counts come from lead_daily_stats; only the
+    hour-of-day heatmap and the text columns read the leads table.
+    """
+    conds = dashboard_conditions(filters)
+    stats = LEAD_DAILY_STATS.c
+    stats_conds = rollup_conditions(filters)
+    total = func.sum(stats['count']).label('count')
+    agent, status, contact = (func.nullif(c, '').label(c.name) for c in (stats.sales_agent, stats.status, stats.contact))
+    daily = _read_aggregate(
+        sa.select(stats.day.label('date'), total).where(*stats_conds, stats.day != '')
+        .group_by(stats.day).order_by(stats.day)
+    )
+    agent_cube = _read_aggregate(
+        sa.select(agent, status, total).where(*stats_conds).group_by(stats.sales_agent, stats.status)
+    )
+    weekday = func.strftime('%w', Lead.uploaded_at)
+    hour = func.strftime('%H', Lead.uploaded_at)
+    time_cube = _read_aggregate(
+        sa.select(weekday.label('weekday'), hour.label('hour'), func.count().label('count'))
+        .where(*conds, Lead.uploaded_at.isnot(None)).group_by(weekday, hour)
+    )
+    frames = {}
+
+    daily['date'] = pd.to_datetime(daily['date']).dt.date
+    frames['daily_leads'] = daily
+    trends = daily.copy()
+    trends['rolling_7d'] = trends['count'].rolling(window=7, min_periods=1).mean()
+    frames['trends'] = trends
+    heat = time_cube.assign(
+        day_of_week=time_cube['weekday'].astype(int).map(dict(enumerate(WEEKDAY_NAMES))),
+        hour=time_cube['hour'].astype(int),
+    )[['day_of_week', 'hour', 'count']]
+    frames['activity_heatmap'] = heat
+
+    frames['agent_breakdown'] = (
+        agent_cube.groupby('sales_agent', as_index=False)['count'].sum().sort_values('count', ascending=False)
+    )
+    status_counts = agent_cube.groupby('status', as_index=False)['count'].sum().sort_values('count', ascending=False)
+    frames['status_breakdown'] = status_counts
+    frames['status_per_agent'] = agent_cube.dropna(subset=['sales_agent', 'status'])
+    by_status = dict(zip(status_counts['status'], status_counts['count']))
+    frames['sales_funnel'] = pd.DataFrame({
+        'status': FUNNEL_STATUSES, 'count': [int(by_status.get(s, 0)) for s in FUNNEL_STATUSES]
+    })
+
+    frames['contact_methods'] = _read_aggregate(
+        sa.select(agent, contact, total)
+        .where(*stats_conds, stats.sales_agent != '', stats.contact != '')
+        .group_by(stats.sales_agent, stats.contact)
+    )
+    for column in ('contact', 'case_desc', 'feedback'):
+        frames[f'top_{column}'] = top_categories(column, filters)
+    frames['feedback_words'] = feedback_top_words(filters)
+    return frames
+
+def read_dashboard_leads_df(filters=None):
+    """Full rows of the filtered active leads, for exports; only call on demand."""
+    return _read_aggregate(
+        sa.select(Lead.__table__).where(*dashboard_conditions(filters)).order_by(Lead.uploaded_at.desc(), Lead.id.desc())
+    )
+
+def read_dashboard_comments_df(filters=None):
+    """Comments on the filtered active leads, for exports. The leads are matched by a
+    subquery, so no id list (and no bound parameter per lead) is built.
+    """
+    leads = sa.select(Lead.id).where(*dashboard_conditions(filters))
+    return _read_aggregate(
+        sa.select(Comment.lead_id, Comment.author.label('comment_author'), Comment.text.label('comment_text'),
+                  Comment.created_at.label('comment_created_at'))
+        .where(Comment.lead_id.in_(leads)).order_by(Comment.id)
+    )
+
+def read_dashboard_activities_df(filters=None):
+    """Activity log entries of the filtered active leads, for exports; see read_dashboard_comments_df."""
+    leads = sa.select(Lead.id).where(*dashboard_conditions(filters))
+    return _read_aggregate(
+        sa.select(Activity.lead_id, Activity.actor.label('activity_actor'), Activity.action.label('activity_action'),
+                  Activity.detail.label('activity_detail'), Activity.timestamp.label('activity_timestamp'))
+        .where(Activity.lead_id.in_(leads)).order_by(Activity.id)
+    )
+
+@cached_query('deals')
+def deal_dashboard_frames():
+    """Deals per day and per salesman (from deal_daily_stats), plus headline counts."""
+    stats = DEAL_DAILY_STATS.c
+    deals = func.sum(stats['count']).label('deals')
+    by_day = _read_aggregate(
+        sa.select(stats.day.label('date'), deals).where(stats.day != '').group_by(stats.day).order_by(stats.day)
+    )
+    by_day['date'] = pd.to_datetime(by_day['date']).dt.date
+    by_salesman = _read_aggregate(
+        sa.select(stats.uploaded_by.label('salesman'), deals)
+        .where(stats.uploaded_by != '').group_by(stats.uploaded_by).order_by(sa.literal_column('deals').desc())
+    )
+    with engine.connect() as conn:
+        total = conn.execute(sa.select(func.coalesce(func.sum(stats['count']), 0))).scalar()
+        customers = conn.execute(sa.select(func.count(Deal.customer_name.distinct()))).scalar()
+    return {'by_day': by_day, 'by_salesman': by_salesman,
+            'total': total, 'unique_customers': customers, 'salesmen': len(by_salesman)}
+
+def _top_category_chart(column, title):
+    return lambda d: px.bar(d, x=column, y='count', title=title)
+
+# frame key -> (section heading, figure builder)
+LEAD_CHARTS = {
+    'daily_leads': ('Leads over time', lambda d: px.line(d, x='date', y='count', title='Leads per day')),
+    'agent_breakdown': ('Leads by agent', lambda d: px.bar(d, x='sales_agent', y='count', title='Leads by Agent')),
+    'status_breakdown': ('Status breakdown', lambda d: px.pie(d, names='status', values='count', title='Leads by Status')),
+    'status_per_agent': ('Leads by Status per Salesman', lambda d: px.bar(
+        d, x='sales_agent', y='count', color='status', barmode='stack', title='Leads by Status per Salesman')),
+    'feedback_words': ('Feedback word cloud-ish (top words)', lambda d: px.bar(d, x='word', y='count', title='Top feedback words')),
+    'top_contact': ('HOW TO CONTACT — top categories', _top_category_chart('contact', 'Contact method — top categories')),
+    'top_case_desc': ('CASE — top categories', _top_category_chart('case_desc', 'Case — top categories')),
+    'top_feedback': ('FEED BACK — top categories', _top_category_chart('feedback', 'Feedback — top categories')),
+    'sales_funnel': ('Sales Pipeline — Funnel', lambda d: px.funnel(d, x='count', y='status', title='Lead Funnel')),
+    'contact_methods': ('Contact method by agent', lambda d: px.bar(
+        d, x='sales_agent', y='count', color='contact', barmode='stack', title='Contact methods by agent')),
+    'activity_heatmap': ('Lead uploads heatmap (weekday x hour)', lambda d: px.density_heatmap(
+        d, x='hour', y='day_of_week', z='count', histfunc='avg', title='Uploads heatmap')),
+    'trends': ('Leads per day (7-day rolling avg)', lambda d: px.line(
+        d, x='date', y=['count', 'rolling_7d'], labels={'value': 'leads', 'variable': 'series'}, title='Daily leads and 7d avg')),
+}
+# Frames included in the analytics packages (Excel sheets and graphs)
+PACKAGE_CHARTS = ['daily_leads', 'agent_breakdown', 'status_breakdown', 'sales_funnel',
+                  'contact_methods', 'activity_heatmap', 'trends']
+
+def show_lead_chart(frames, key):
+    heading, build = LEAD_CHARTS[key]
+    st.subheader(heading)
+    frame = frames.get(key)
+    if frame is None or frame.empty:
+        st.info('No data for this chart yet.')
+    else:
+        st.plotly_chart(build(frame), use_container_width=True)
+
+# ----------------- Lead import helpers -----------------
+
+LEAD_IMPORT_COLUMNS = ['number', 'name', 'sales agent', 'contact', 'case', 'feed back']
+LEAD_IMPORT_ALIASES = {
+    'sales_agent': 'sales agent', 'salesagent': 'sales agent',
+    'feedback': 'feed back', 'case_desc': 'case',
+    'contact_number': 'contact', 'phone': 'contact',
+    'how to contact': 'contact', 'how_to_contact': 'contact', 'contact method': 'contact'
+}
+# Rows per executemany round trip, within the transaction of one import chunk
+LEAD_INSERT_BATCH = 5000
+# Rows read from an uploaded file at a time; each chunk is committed on its own
+LEAD_IMPORT_CHUNK_ROWS = 5000
+LEAD_PREVIEW_ROWS = 5
+
+def map_lead_columns(df):
+    """Rename uploaded headers to LEAD_IMPORT_COLUMNS; missing columns are added empty."""
+    col_map = {str(c).lower().strip(): c for c in df.columns}
+    mapping = {}
+    for k in LEAD_IMPORT_COLUMNS:
+        if k in col_map:
+            mapping[col_map[k]] = k
+    for k, v in LEAD_IMPORT_ALIASES.items():
+        if k in col_map and v not in mapping.values():
+            mapping[col_map[k]] = v
+    df_ren = df.rename(columns=mapping)
+    for tgt in LEAD_IMPORT_COLUMNS:
+        if tgt not in df_ren.columns:
+            df_ren[tgt] = None
+    return df_ren
+
+def _clean_text_column(series):
+    """Vectorized str/strip/NFC for one uploaded column. Blanks and NaN become None."""
+    if pd.api.types.is_float_dtype(series):
+        # Excel hands whole numbers (phone numbers) over as floats: 1012345678.0
+        non_null = series.dropna()
+        if not non_null.empty and (non_null % 1 == 0).all():
+            series = series.astype('Int64')
+    cleaned = series.astype('string').str.strip().str.normalize('NFC')
+    cleaned = cleaned.mask(cleaned == '')
+    return cleaned.astype(object).where(cleaned.notna(), None)
+
+def prepare_lead_records(df, default_agent=None, assign=False):
+    """Map, normalize and coerce an uploaded DataFrame into Lead column dicts.
+    Empty sales agents fall back to default_agent; assign=True also fills assigned_to.
+    """
+    df = map_lead_columns(df)
+    frame = pd.DataFrame({
+        'number': _clean_text_column(df['number']),
+        'name': _clean_text_column(df['name']),
+        'sales_agent': _clean_text_column(df['sales agent']),
+        'contact': _clean_text_column(df['contact']),
+        'case_desc': _clean_text_column(df['case']),
+        'feedback': _clean_text_column(df['feed back']),
+    })
+    # Skip spreadsheet rows with nothing in any lead column
+    frame = frame[frame.notna().any(axis=1)]
+    if default_agent:
+        frame['sales_agent'] = frame['sales_agent'].where(frame['sales_agent'].notna(), default_agent)
+    if assign:
+        frame['assigned_to'] = frame['sales_agent']
+    return frame.to_dict('records')
+
+def bulk_insert_leads(db, records, actor, detail='Bulk upload', uploaded_by_id=None):
+    """Insert lead dicts using executemany and queue one 'upload' activity each.
+    Does not commit, so callers decide the transaction boundary. Returns the row count.
+    """
+    if not records:
+        return 0
+    now = datetime.utcnow()
+    inserted = 0
+    for start in range(0, len(records), LEAD_INSERT_BATCH):
+        batch = [
+            {**r, 'uploaded_by': actor, 'uploaded_by_id': uploaded_by_id, 'uploaded_at': now}
+            for r in records[start:start + LEAD_INSERT_BATCH]
+        ]
+        # Core table insert: the ORM bulk path with RETURNING falls back to one row per statement.
+        # Every activity row is identical apart from lead_id, so RETURNING order does not matter.
+        lead_ids = db.execute(
+            sa.insert(Lead.__table__).returning(Lead.__table__.c.id), batch
+        ).scalars().all()
+        log_activities(db, [(lead_id, detail) for lead_id in lead_ids], actor, 'upload')
+        inserted += len(lead_ids)
+    return inserted
+
+def import_leads_df(db, df, actor, uploaded_by_id=None, default_agent=None, assign=False, detail='Bulk upload'):
+    """Import an uploaded DataFrame in a single transaction. Returns the number of leads saved."""
+    records = prepare_lead_records(df, default_agent=default_agent, assign=assign)
+    try:
+        saved = bulk_insert_leads(db, records, actor, detail=detail, uploaded_by_id=uploaded_by_id)
+        db.commit()
+    except Exception:
+        db.rollback()
+        raise
+    return saved
+
+def iter_lead_file_chunks(uploaded_file, chunk_rows=LEAD_IMPORT_CHUNK_ROWS):
+    """Yield DataFrames of at most chunk_rows rows from an uploaded CSV/XLSX
+    without materializing the whole file. CSV goes through pandas' chunked reader,
+    XLSX through openpyxl read-only mode. Legacy .xls has no streaming reader and
+    is read whole.
+    """
+    name = (getattr(uploaded_file, 'name', '') or '').lower()
+    if hasattr(uploaded_file, 'seek'):
+        uploaded_file.seek(0)
+    if name.endswith('.csv'):
+        with pd.read_csv(uploaded_file, chunksize=chunk_rows) as reader:
+            for chunk in reader:
+                yield chunk
+        return
+    if not name.endswith('.xlsx'):
+        yield pd.read_excel(uploaded_file)
+        return
+
+    from openpyxl import load_workbook
+    wb = load_workbook(uploaded_file, read_only=True, data_only=True)
+    try:
+        rows = wb.worksheets[0].iter_rows(values_only=True)
+        header = next(rows, None)
+        if header is None:
+            return
+        columns = [str(c) if c is not None else f'Unnamed: {i}' for i, c in enumerate(header)]
+        width = len(columns)
+        buf = []
+        for row in rows:
+            if all(v is None for v in row):
+                continue
+            # Read-only rows are as long as the cells actually written
+            row = tuple(row[:width]) + (None,) * (width - len(row))
+            buf.append(row)
+            if len(buf) >= chunk_rows:
+                yield pd.DataFrame(buf, columns=columns)
+                buf = []
+        if buf:
+            yield pd.DataFrame(buf, columns=columns)
+    finally:
+        wb.close()
+
+def read_lead_file_preview(uploaded_file, rows=LEAD_PREVIEW_ROWS):
+    """Return the first rows of an uploaded lead file, reading only the first chunk."""
+    chunks = iter_lead_file_chunks(uploaded_file, chunk_rows=rows)
+    try:
+        return next(chunks, pd.DataFrame())
+    finally:
+        chunks.close()
+
+class LeadImportError(Exception):
+    """A file import that failed part-way. The chunks before the failure stay committed:
+    `saved` leads from the file's first `rows_done` data rows (blank lines aren't counted).
+    """
+
+    def __init__(self, saved, rows_done, cause):
+        self.saved, self.rows_done, self.cause = saved, rows_done, cause
+        if rows_done:
+            kept = (f'The first {rows_done} data rows, not counting blank lines, were saved as {saved} leads; '
+                    'remove them from the file before uploading it again.')
+        else:
+            kept = 'Nothing was saved.'
+        super().__init__(f'Import stopped after {rows_done} data rows: {cause}. {kept}')
+
+def import_lead_file(db, uploaded_file, actor, uploaded_by_id=None, default_agent=None, assign=False,
+                     detail='Bulk upload', on_progress=None):
+    """Stream an uploaded file into the leads table chunk by chunk.
+    Each chunk is one transaction, so memory and the SQLite write lock stay bounded.
+    on_progress(saved_so_far) is called after every chunk. Returns the number of leads saved;
+    raises LeadImportError, saying what was already saved, if a chunk fails.
+    """
+    saved = rows_done = 0
+    try:
+        for chunk in iter_lead_file_chunks(uploaded_file):
+            saved += import_leads_df(db, chunk, actor, uploaded_by_id=uploaded_by_id,
+                                     default_agent=default_agent, assign=assign, detail=detail)
+            rows_done += len(chunk)
+            if on_progress:
+                on_progress(saved)
+    except Exception as e:
+        raise LeadImportError(saved, rows_done, e) from e
+    return saved
+
+# ----------------- Lead table edits -----------------
+# Columns the salesman lead table can change
+LEAD_EDIT_COLUMNS = ['number', 'name', 'sales_agent', 'contact', 'case_desc', 'feedback', 'status', 'assigned_to']
+
+def _editor_values(frame):
+    """Editor cells as they would be stored: NFC text, with blanks and NaN as None."""
+    out = {}
+    for col in frame.columns:
+        cleaned = frame[col].astype('string').str.normalize('NFC')
+        cleaned = cleaned.mask(cleaned == '')
+        out[col] = cleaned.astype(object).where(cleaned.notna(), None)
+    return pd.DataFrame(out, index=frame.index)
+
+def save_lead_edits(db, shown, edited, actor, actor_id=None, stored=None):
+    """Save a data_editor change set in one transaction.
+
+    shown is the frame the editor was given and edited what it returned, both with an
+    'id' column (new rows have none) and an optional 'comment_text' column. Changed
+    leads get one executemany UPDATE per set of changed columns, new rows one insert,
+    comments one insert, and the audit entries one insert at commit.
+
+    Each UPDATE only applies while the columns it changes still hold their stored
+    values (default: shown's), so an edit made by someone else since the page was
+    loaded is never overwritten; those leads are skipped and reported instead.
+    Returns {'updated', 'created', 'comments', 'conflicts': [lead ids]}.
+    """
+    cols = [c for c in LEAD_EDIT_COLUMNS if c in edited.columns and c in shown.columns]
+    stored = shown if stored is None else stored
+    leads = Lead.__table__
+    now = datetime.utcnow()
+    result = {'updated': 0, 'created': 0, 'comments': 0, 'conflicts': []}
+    comment_text = (edited['comment_text'] if 'comment_text' in edited.columns
+                    else pd.Series(None, index=edited.index, dtype=object))
+    comment_text = comment_text.astype('string').str.strip().str.normalize('NFC')
+    comment_text = comment_text.mask(comment_text == '')
+    is_new = edited['id'].isna()
+
+    # Vectorized diff of the existing rows
+    cur = edited[~is_new].set_index(edited.loc[~is_new, 'id'].astype(int))
+    orig = shown.set_index(shown['id'].astype(int))
+    cur = cur[cur.index.isin(orig.index)]
+    new_vals = _editor_values(cur[cols])
+    old_vals = _editor_values(orig.loc[cur.index, cols])
+    changed = ~((new_vals == old_vals) | (new_vals.isna() & old_vals.isna()))
+    changed = changed[changed.any(axis=1)]
+    guard = stored.set_index(stored['id'].astype(int))
+
+    try:
+        edited_ids = []
+        # One executemany per combination of changed columns
+        for mask, group in changed.groupby(list(changed.columns)):
+            set_cols = [c for c, on in zip(cols, mask) if on]
+            ids = group.index.tolist()
+            stmt = sa.update(leads).where(
+                leads.c.id == sa.bindparam('b_id'),
+                *[leads.c[c].is_(sa.bindparam(f'b_old_{c}')) for c in set_cols]
+            ).values({c: sa.bindparam(f'b_new_{c}') for c in set_cols})
+            params = [
+                {'b_id': i,
+                 **{f'b_new_{c}': new_vals.at[i, c] for c in set_cols},
+                 **{f'b_old_{c}': (None if pd.isna(guard.at[i, c]) else guard.at[i, c]) for c in set_cols}}
+                for i in ids
+            ]
+            applied = db.execute(stmt, params).rowcount
+            if applied < len(ids):
+                # This transaction now holds the write lock: whatever doesn't carry
+                # our values was changed by someone else first
+                current = pd.DataFrame(
+                    db.execute(sa.select(leads.c.id, *[leads.c[c] for c in set_cols]).where(leads.c.id.in_(ids))).all(),
+                    columns=['id'] + set_cols
+                ).set_index('id')
+                mine = new_vals.loc[ids, set_cols]
+                current = current.reindex(ids)
+                same = ((current == mine) | (current.isna() & mine.isna())).all(axis=1)
+                result['conflicts'] += same.index[~same].tolist()
+                ids = same.index[same].tolist()
+            edited_ids += ids
+        result['updated'] = len(edited_ids)
+        log_activities(db, [(i, 'Edited via table') for i in edited_ids], actor, 'edit')
+
+        # New rows (skipping blank ones)
+        new_id_of = {}
+        fresh = _editor_values(edited.loc[is_new, cols])
+        fresh = fresh[fresh.notna().any(axis=1)]
+        if not fresh.empty:
+            records = fresh.to_dict('records')
+            for r in records:
+                r['sales_agent'] = r.get('sales_agent') or actor
+                r['status'] = r.get('status') or 'new'
+                r.update(uploaded_by=actor, uploaded_by_id=actor_id, uploaded_at=now)
+            new_ids = db.execute(
+                sa.insert(leads).returning(leads.c.id, sort_by_parameter_order=True), records
+            ).scalars().all()
+            new_id_of = dict(zip(fresh.index, new_ids))
+            log_activities(db, [(i, 'Added via table') for i in new_ids], actor, 'create')
+        result['created'] = len(new_id_of)
+
+        # Comments go on their row's lead, unless its edit was refused
+        row_lead = {ix: i for ix, i in edited.loc[~is_new, 'id'].astype(int).items() if i in orig.index}
+        row_lead.update(new_id_of)
+        refused = set(result['conflicts'])
+        comments = [(row_lead[ix], t) for ix, t in comment_text.dropna().items()
+                    if ix in row_lead and row_lead[ix] not in refused]
+        if comments:
+            db.execute(sa.insert(Comment.__table__),
+                       [{'lead_id': i, 'author': actor, 'text': t, 'created_at': now} for i, t in comments])
+            log_activities(db, comments, actor, 'comment')
+        result['comments'] = len(comments)
+        db.commit()
+    except Exception:
+        db.rollback()
+        raise
+    return result
+
+# ----------------- File builders -----------------
+# ZIP archives are built in memory up to this size, then spill to a temporary file
+ZIP_SPOOL_BYTES = 16 * 2**20
+# Already-compressed formats are stored in ZIPs as-is instead of being deflated again
+ZIP_STORED_SUFFIXES = ('.png', '.jpg', '.jpeg', '.webp', '.gif', '.xlsx', '.zip')
+
+def write_zip(entries):
+    """Write (name, bytes or str) entries to a ZIP in a spooled temporary file and
+    return the file, rewound. Entries are consumed one at a time, so pass a
+    generator to keep only the current entry in memory.
+    """
+    out = tempfile.SpooledTemporaryFile(max_size=ZIP_SPOOL_BYTES)
+    with zipfile.ZipFile(out, 'w', zipfile.ZIP_DEFLATED) as zf:
+        for name, data in entries:
+            stored = name.lower().endswith(ZIP_STORED_SUFFIXES)
+            zf.writestr(name, data, compress_type=zipfile.ZIP_STORED if stored else zipfile.ZIP_DEFLATED)
+    out.seek(0)
+    return out
+
+# Data rows per worksheet: Excel's 1,048,576-row limit less the header row
+EXCEL_MAX_ROWS = 1_048_575
+
+def excel_bytes(sheets):
+    """One .xlsx file with a sheet per {sheet name: DataFrame} item. A frame longer than
+    a sheet can hold continues on '<name>_2', '<name>_3', ...
+    """
+    buf = io.BytesIO()
+    with pd.ExcelWriter(buf, engine='openpyxl') as writer:
+        for sheet_name, df in sheets.items():
+            for part, start in enumerate(range(0, max(len(df), 1), EXCEL_MAX_ROWS), 1):
+                name = sheet_name if part == 1 else f'{sheet_name}_{part}'
+                df.iloc[start:start + EXCEL_MAX_ROWS].to_excel(writer, sheet_name=name, index=False)
+    return buf.getvalue()
+
+@cached_query('deals')
+def done_deals_report_excel():
+    """The CEO's Done Deals workbook: every deal's metadata plus the per-salesman and per-day counts."""
+    frames = deal_dashboard_frames()
+    deals_df, _ = read_deals_df.uncached(limit=None, count=None)
+    return excel_bytes({'deals': deals_df, 'by_salesman': frames['by_salesman'], 'by_day': frames['by_day']})
+
+class PackageCache:
+    """Finished export files under root/<fingerprint>.zip, evicted least-recently-used
+    (by mtime, refreshed on every hit) once they add up to more than max_bytes.
+    """
+
+    def __init__(self, root, max_bytes):
+        self.root = root
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self.hits = self.misses = self.evictions = 0
+
+    def _path(self, key):
+        return os.path.join(self.root, f'{key}.zip')
+
+    def open(self, key):
+        """Open file of a cached package, or None. An open file stays readable even if evicted meanwhile."""
+        try:
+            f = open(self._path(key), 'rb')
+        except FileNotFoundError:
+            self.misses += 1
+            return None
+        os.utime(f.name)
+        self.hits += 1
+        return f
+
+    def put(self, key, fileobj):
+        """Copy fileobj (from its current position) into the cache, evict, and return the cached file opened."""
+        os.makedirs(self.root, exist_ok=True)
+        path = self._path(key)
+        tmp = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+        with open(tmp, 'wb') as out:
+            shutil.copyfileobj(fileobj, out)
+        os.replace(tmp, path)
+        f = open(path, 'rb')
+        self._evict()
+        return f
+
+    def _entries(self):
+        """(mtime, size, path) of every cached package, oldest first."""
+        entries = []
+        for entry in os.scandir(self.root) if os.path.isdir(self.root) else ():
+            if entry.name.endswith('.zip'):
+                try:
+                    info = entry.stat()
+                except FileNotFoundError:
+                    continue
+                entries.append((info.st_mtime, info.st_size, entry.path))
+        return sorted(entries)
+
+    def _evict(self):
+        with self._lock:
+            entries = self._entries()
+            total = sum(size for _, size, _ in entries)
+            # The newest package is kept even when it alone is over budget
+            for _, size, path in entries[:-1]:
+                if total <= self.max_bytes:
+                    break
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+                total -= size
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            for _, _, path in self._entries():
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+
+    def stats(self):
+        entries = self._entries()
+        lookups = self.hits + self.misses
+        return {
+            'entries': len(entries), 'size_mb': round(sum(size for _, size, _ in entries) / 2**20, 2),
+            'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions,
+            'hit_rate': round(self.hits / lookups, 3) if lookups else None,
+        }
+
+@st.cache_resource(show_spinner=False)
+def get_package_cache():
+    return PackageCache(PACKAGE_CACHE_DIR, int(PACKAGE_CACHE_MB * 2**20))
+
+def cached_package(kind, params, tables, build):
+    """Open file of the `kind` package for `params` at the current data versions of `tables`.
+    build() returns the package as a rewound file and only runs on a cache miss.
+    """
+    key = hashlib.sha256(
+        json.dumps([kind, params, data_versions(tables)], sort_keys=True, default=str).encode('utf-8')
+    ).hexdigest()
+    cache = get_package_cache()
+    cached = cache.open(key)
+    if cached is not None:
+        return cached
+    with build() as archive:
+        return cache.put(key, archive)
+
+# ----------------- Background jobs -----------------
+# Exports and bulk operations run on a small thread pool instead of in the
+# script thread, so a browser refresh doesn't kill them and the session stays
+# responsive. Job state lives in the jobs table: any rerun (or another tab) can
+# follow, cancel and download a job. Handlers are looked up when a job is
+# queued, in the script run that queues it, because a run can stop before the
+# whole script has been defined.
+JOB_HANDLERS = {}
+JOB_STATUS_ICONS = {'queued': '⏳', 'running': '⚙️', 'done': '✅', 'failed': '❌', 'cancelled': '🚫'}
+# Bulk lead operations on up to this many leads run inline; larger ones become jobs
+BULK_INLINE_LEADS = 1000
+# Leads per transaction inside a bulk job; progress and cancellation are checked in between
+BULK_JOB_BATCH = 2000
+# Jobs listed in the sidebar
+JOBS_SHOWN = 5
+
+class JobCancelled(Exception):
+    """Raised inside a handler once its job has been cancelled."""
+
+def job_handler(kind, label):
+    """Register fn(job, **params) as the handler of `kind` jobs. It may return
+    (filename, bytes / str / file object, mime) to keep a downloadable result;
+    a returned file object is closed once copied.
+    """
+    def decorator(fn):
+        JOB_HANDLERS[kind] = (label, fn)
+        return fn
+    return decorator
+
+class JobContext:
+    """A running handler's handle on its job row."""
+
+    def __init__(self, job_id):
+        self.id = job_id
+
+    def progress(self, fraction, message=None):
+        """Record progress (0-1) and a status line. Raises JobCancelled if the job was cancelled."""
+        jobs = Job.__table__
+        values = {'progress': max(0.0, min(1.0, fraction))}
+        if message is not None:
+            values['message'] = message
+        with engine.begin() as conn:
+            cancelled = conn.execute(
+                sa.update(jobs).where(jobs.c.id == self.id).values(**values).returning(jobs.c.cancel_requested)
+            ).scalar()
+        if cancelled:
+            raise JobCancelled()
+
+def _job_params_json(params):
+    return json.dumps(
+        {k: (f'<{len(v)} items>' if isinstance(v, (list, tuple)) and len(v) > 20 else v) for k, v in params.items()},
+        default=str
+    )
+
+def _store_job_result(job_id, filename, data, mime):
+    folder = os.path.join(JOB_DIR, str(job_id))
+    os.makedirs(folder, exist_ok=True)
+    filename = os.path.basename(filename)
+    path = os.path.join(folder, filename)
+    if isinstance(data, str):
+        data = data.encode('utf-8')
+    with open(path, 'wb') as out:
+        if isinstance(data, bytes):
+            out.write(data)
+        else:
+            with data:
+                shutil.copyfileobj(data, out)
+    return {'result_path': path, 'result_name': filename, 'result_mime': mime}
+
+def prune_jobs(days=None):
+    """Delete jobs (and result files) that finished more than `days` (default JOB_RESULT_DAYS) ago."""
+    jobs = Job.__table__
+    cutoff = datetime.utcnow() - pd.Timedelta(days=JOB_RESULT_DAYS if days is None else days)
+    with engine.begin() as conn:
+        old = conn.execute(sa.delete(jobs).where(jobs.c.finished_at < cutoff).returning(jobs.c.id)).scalars().all()
+    for job_id in old:
+        shutil.rmtree(os.path.join(JOB_DIR, str(job_id)), ignore_errors=True)
+    return len(old)
+
+class JobRunner:
+    """Thread pool that runs queued jobs. Jobs a previous process left queued or
+    running can't be resumed (their parameters lived in memory) and are marked failed.
+    """
+
+    def __init__(self, workers):
+        self.pool = ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix='crm-job')
+        jobs = Job.__table__
+        with engine.begin() as conn:
+            conn.execute(
+                sa.update(jobs).where(jobs.c.status.in_(('queued', 'running')))
+                .values(status='failed', error='Interrupted by a server restart; please start it again',
+                        finished_at=datetime.utcnow())
+            )
+        prune_jobs()
+
+    def submit(self, job_id, fn, params):
+        self.pool.submit(self._run, job_id, fn, params)
+
+    def _run(self, job_id, fn, params):
+        jobs = Job.__table__
+        with engine.begin() as conn:
+            started = conn.execute(
+                sa.update(jobs).where(jobs.c.id == job_id, jobs.c.status == 'queued')
+                .values(status='running', started_at=datetime.utcnow(), message='Running')
+            ).rowcount
+        if not started:
+            return  # cancelled while queued
+        values = {}
+        try:
+            result = fn(JobContext(job_id), **params)
+            if result is not None:
+                values.update(_store_job_result(job_id, *result))
+            # Keep a closing message the handler reported at 100%, else replace its last step
+            values.update(status='done', progress=1.0,
+                          message=sa.case((jobs.c.progress < 1.0, 'Done'), else_=jobs.c.message))
+        except JobCancelled:
+            values.update(status='cancelled', message='Cancelled')
+        except Exception as e:
+            logging.getLogger(__name__).exception('Job %s (%s) failed', job_id, fn.__name__)
+            values.update(status='failed', error=str(e))
+        with engine.begin() as conn:
+            conn.execute(sa.update(jobs).where(jobs.c.id == job_id).values(finished_at=datetime.utcnow(), **values))
+
+@st.cache_resource(show_spinner=False)
+def get_job_runner():
+    return JobRunner(JOB_WORKERS)
+
+def submit_job(kind, created_by, **params):
+    """Queue a `kind` job with params and return its id."""
+    label, fn = JOB_HANDLERS[kind]
+    with engine.begin() as conn:
+        job_id = conn.execute(sa.insert(Job.__table__).values(
+            kind=kind, label=label, params=_job_params_json(params), status='queued', progress=0.0, message='Queued',
+            cancel_requested=0, created_by=created_by, created_at=datetime.utcnow(),
+        )).inserted_primary_key[0]
+    get_job_runner().submit(job_id, fn, params)
+    return job_id
+
+def cancel_job(job_id, username):
+    """Cancel one of username's jobs: at once if still queued, else at the handler's next progress report."""
+    jobs = Job.__table__
+    with engine.begin() as conn:
+        conn.execute(
+            sa.update(jobs).where(jobs.c.id == job_id, jobs.c.created_by == username,
+                                  jobs.c.status.in_(('queued', 'running')))
+            .values(cancel_requested=1,
+                    status=sa.case((jobs.c.status == 'queued', 'cancelled'), else_=jobs.c.status),
+                    finished_at=sa.case((jobs.c.status == 'queued', datetime.utcnow()), else_=None))
+        )
+
+def start_job(kind, created_by, **params):
+    """Queue a job from a button handler and point the user at the sidebar."""
+    job_id = submit_job(kind, created_by, **params)
+    st.info(f'⏳ {JOB_HANDLERS[kind][0]} started as job #{job_id}. Follow it under **Background jobs** in the '
+            'sidebar; it keeps running if you leave or refresh this page.')
+    return job_id
+
+BULK_LEAD_OPS = {
+    'archive': (bulk_archive_leads, 'Archived'),
+    'unarchive': (bulk_unarchive_leads, 'Unarchived'),
+    'delete': (bulk_delete_leads_from_db, 'Deleted'),
+}
+
+@job_handler('bulk_leads', 'Bulk lead update')
+def bulk_leads_job(job, op, lead_ids, actor, args=()):
+    """Apply a BULK_LEAD_OPS operation one BULK_JOB_BATCH-sized transaction at a time."""
+    fn, verb = BULK_LEAD_OPS[op]
+    total, done = len(lead_ids), 0
+    for start in range(0, total, BULK_JOB_BATCH):
+        with get_session() as db:
+            done += fn(db, lead_ids[start:start + BULK_JOB_BATCH], actor, *args)
+        job.progress(min(start + BULK_JOB_BATCH, total) / total, f'{verb} {done} of {total} leads')
+
+def run_bulk_leads(op, lead_ids, actor, *args):
+    """Archive / unarchive / delete leads (see BULK_LEAD_OPS). Up to BULK_INLINE_LEADS
+    run right away and the count is returned; larger batches become a background
+    job and None is returned.
+    """
+    lead_ids = list(lead_ids)
+    if len(lead_ids) <= BULK_INLINE_LEADS:
+        with get_session() as db:
+            return BULK_LEAD_OPS[op][0](db, lead_ids, actor, *args)
+    start_job('bulk_leads', actor, op=op, lead_ids=lead_ids, actor=actor, args=args)
+    return None
+
+@job_handler('distribute_leads', 'Lead distribution')
+def distribute_leads_job(job, agents, actor, **options):
+    job.progress(0.0, f'Distributing to {len(agents)} agents')
+    with get_session() as db:
+        assigned_count = distribute_unassigned_leads(db, agents, actor, **options)
+    job.progress(1.0, 'Distribution completed: ' + ', '.join(f'{a}: {n}' for a, n in assigned_count.items()))
+
+def run_distribution(agents, actor, expected=0, **options):
+    """distribute_unassigned_leads(agents, actor, **options) inline when it touches up
+    to BULK_INLINE_LEADS leads (`expected`, capped by limit), else as a background
+    job (returns None).
+    """
+    limit = options.get('limit')
+    count = min(expected, limit) if limit else expected
+    if count <= BULK_INLINE_LEADS:
+        with get_session() as db:
+            return distribute_unassigned_leads(db, agents, actor, **options)
+    start_job('distribute_leads', actor, agents=list(agents), actor=actor, **options)
+    return None
+
+def show_jobs_panel(username):
+    """Sidebar list of the user's latest jobs with progress, cancel and download."""
+    get_job_runner()  # starting the runner also retires jobs a previous process left behind
+    with get_session() as db:
+        recent = db.query(Job).filter(Job.created_by == username).order_by(Job.id.desc()).limit(JOBS_SHOWN).all()
+    if not recent:
+        return
+    st.sidebar.markdown('---')
+    st.sidebar.markdown('### Background jobs')
+    if st.sidebar.button('🔄 Refresh jobs', key='jobs_refresh'):
+        st.rerun()
+    for job in recent:
+        st.sidebar.markdown(f'{JOB_STATUS_ICONS.get(job.status, "")} **#{job.id} {job.label or job.kind}** — {job.status}')
+        if job.status == 'running':
+            st.sidebar.progress(job.progress or 0.0)
+        if job.status == 'failed':
+            st.sidebar.caption(f'Error: {job.error}')
+        elif job.message:
+            st.sidebar.caption(job.message)
+        if job.status in ('queued', 'running'):
+            if st.sidebar.button('Cancel', key=f'job_cancel_{job.id}'):
+                cancel_job(job.id, username)
+                st.rerun()
+        elif job.status == 'done' and job.result_path:
+            # Results can be large: read the file only when asked for
+            show_key = f'job_get_{job.id}'
+            if st.session_state.get(show_key) and os.path.exists(job.result_path):
+                with open(job.result_path, 'rb') as f:
+                    st.sidebar.download_button(f'📥 {job.result_name}', data=f.read(), file_name=job.result_name,
+                                               mime=job.result_mime, key=f'job_dl_{job.id}')
+            elif st.sidebar.button(f'Get {job.result_name}', key=f'{show_key}_btn'):
+                st.session_state[show_key] = True
+                st.rerun()
+
 # ----------------- Streamlit UI -----------------
 
 st.set_page_config(page_title='IQ Stats CRM — Full', layout='wide')
@@ -565,9 +2718,7 @@ if st.session_state['user'] is None:
                 st.session_state['role'] = user.role
                 # log login event
                 try:
-                    evt = LoginEvent(username=user.username, role=user.role, logged_in_at=datetime.utcnow())
-                    db.add(evt)
-                    db.commit()
+                    record_login_event(user)
                 except Exception:
                     pass
                 st.success(f'Welcome, {user.name} ({user.role})')
@@ -597,6 +2748,7 @@ if st.sidebar.button('Logout'):
     for k in list(st.session_state.keys()):
         del st.session_state[k]
     st.rerun()
+show_jobs_panel(current_user.username)
 
 # Admin: manage users
 if role == 'admin':
@@ -605,7 +2757,7 @@ if role == 'admin':
     # User Management Section
     st.subheader('👥 User Management')
     db = get_session()
-    users = db.query(User).all()
+    users = user_directory()
     
     # Display current users
     st.write('**Current Users:**')
@@ -616,10 +2768,10 @@ if role == 'admin':
     cols[3].write('Role')
     for u in users:
         c0, c1, c2, c3 = st.columns([1,2,2,1])
-        c0.write(u.id)
-        c1.write(u.username)
-        c2.write(u.name)
-        c3.write(u.role)
+        c0.write(u['id'])
+        c1.write(u['username'])
+        c2.write(u['name'])
+        c3.write(u['role'])
 
     # Create new user form
     st.markdown('---')
@@ -659,7 +2811,7 @@ if role == 'admin':
         st.write('**Delete User:**')
         if users:
             user_to_delete = st.selectbox('Select user to delete', 
-                                        options=[f"{u.username} ({u.name})" for u in users if u.username != 'admin'],
+                                        options=[f"{u['username']} ({u['name']})" for u in users if u['username'] != 'admin'],
                                         key='delete_user')
             if st.button('🗑️ Delete User', type='secondary'):
                 if user_to_delete:
@@ -675,7 +2827,7 @@ if role == 'admin':
         st.write('**Update User Password:**')
         if users:
             user_to_update = st.selectbox('Select user to update', 
-                                        options=[f"{u.username} ({u.name})" for u in users],
+                                        options=[f"{u['username']} ({u['name']})" for u in users],
                                         key='update_user')
             new_password = st.text_input('New Password', type='password', key='new_pwd')
             if st.button('🔐 Update Password', type='secondary'):
@@ -705,12 +2857,16 @@ if role == 'admin':
                     del st.session_state['user']
                 except Exception:
                     pass
-                if os.path.exists(DB_FILE):
-                    os.remove(DB_FILE)
-                # Recreate
-                Base.metadata.create_all(bind=engine)
-                ensure_schema()
-                ensure_demo_users()
+                engine.dispose()
+                for path in (DB_FILE, f'{DB_FILE}-wal', f'{DB_FILE}-shm'):
+                    if os.path.exists(path):
+                        os.remove(path)
+                # Recreate (the schema marker went away with the file)
+                bootstrap_database.clear()
+                bootstrap_database()
+                # Packages and job results were built from the old data (and job ids start over)
+                get_package_cache().clear()
+                shutil.rmtree(JOB_DIR, ignore_errors=True)
                 st.success('✅ Database reset successfully! Please reload the app.')
                 st.rerun()
             except Exception as e:
@@ -725,44 +2881,27 @@ if role == 'admin':
                 date_str = now.strftime('%Y-%m-%d_%H-%M')
                 zip_filename = f"Admin_Data_Export_{date_str}.zip"
                 
-                zip_buffer = io.BytesIO()
-                with zipfile.ZipFile(zip_buffer, 'w', zipfile.ZIP_DEFLATED) as zip_file:
+                def export_entries():
                     # Export users
-                    users_df = pd.DataFrame([{
-                        'id': u.id, 'username': u.username, 'name': u.name, 
-                        'role': u.role, 'created_at': u.created_at
-                    } for u in users])
-                    users_buffer = io.BytesIO()
-                    with pd.ExcelWriter(users_buffer, engine='openpyxl') as writer:
-                        users_df.to_excel(writer, sheet_name='Users', index=False)
-                    zip_file.writestr('Users.xlsx', users_buffer.getvalue())
+                    users_df = pd.DataFrame(users, columns=['id', 'username', 'name', 'role', 'created_at'])
+                    yield 'Users.xlsx', excel_bytes({'Users': users_df})
                     
-                    # Export leads
-                    leads_df, _ = read_leads_df(limit=100000)
+                    # Export leads (whole-table reads bypass the query cache)
+                    leads_df, _ = read_leads_df.uncached(limit=None, count=None)
                     if not leads_df.empty:
-                        leads_buffer = io.BytesIO()
-                        with pd.ExcelWriter(leads_buffer, engine='openpyxl') as writer:
-                            leads_df.to_excel(writer, sheet_name='Leads', index=False)
-                        zip_file.writestr('Leads.xlsx', leads_buffer.getvalue())
+                        yield 'Leads.xlsx', excel_bytes({'Leads': leads_df})
                     
                     # Export comments for all leads
                     with get_session() as db:
                         all_lead_ids = leads_df['id'].tolist() if not leads_df.empty else []
                         comments_df = get_comments_for_leads(db, all_lead_ids)
-                        
-                        if not comments_df.empty:
-                            comments_buffer = io.BytesIO()
-                            with pd.ExcelWriter(comments_buffer, engine='openpyxl') as writer:
-                                comments_df.to_excel(writer, sheet_name='Comments', index=False)
-                            zip_file.writestr('Comments.xlsx', comments_buffer.getvalue())
+                    if not comments_df.empty:
+                        yield 'Comments.xlsx', excel_bytes({'Comments': comments_df})
                     
                     # Export deals
-                    deals_df, _ = read_deals_df(limit=100000)
+                    deals_df, _ = read_deals_df.uncached(limit=None, count=None)
                     if not deals_df.empty:
-                        deals_buffer = io.BytesIO()
-                        with pd.ExcelWriter(deals_buffer, engine='openpyxl') as writer:
-                            deals_df.to_excel(writer, sheet_name='Deals', index=False)
-                        zip_file.writestr('Deals.xlsx', deals_buffer.getvalue())
+                        yield 'Deals.xlsx', excel_bytes({'Deals': deals_df})
                     
                     # README
                     readme_content = f"""Admin Data Export
@@ -777,14 +2916,15 @@ Contents:
 
 This is a complete system backup for administrative purposes.
 """
-                    zip_file.writestr('README.txt', readme_content)
+                    yield 'README.txt', readme_content
                 
-                st.download_button(
-                    label=f'📥 Download {zip_filename}',
-                    data=zip_buffer.getvalue(),
-                    file_name=zip_filename,
-                    mime='application/zip'
-                )
+                with write_zip(export_entries()) as archive:
+                    st.download_button(
+                        label=f'📥 Download {zip_filename}',
+                        data=archive.read(),
+                        file_name=zip_filename,
+                        mime='application/zip'
+                    )
                 st.success('✅ Data export ready!')
                 
             except Exception as e:
@@ -799,6 +2939,31 @@ This is a complete system backup for administrative purposes.
         **Last Modified:** {datetime.fromtimestamp(os.path.getmtime(DB_FILE)).strftime('%Y-%m-%d %H:%M')}
         """)
         
+        if st.button('🔍 Show Index Usage', type='secondary'):
+            st.dataframe(index_usage_report(), use_container_width=True)
+
+        if st.button('♻️ Rebuild Rollup Tables', type='secondary', help='Recount the daily lead/deal stats from the raw tables'):
+            rebuild_rollups()
+            st.success('Rollup tables rebuilt')
+
+        if st.button('📦 Move Deal Screenshots to Blob Store', type='secondary',
+                     help=f'Move screenshots stored inside the database to {BLOB_DIR} and compact the database'):
+            with st.spinner('Moving screenshots...'):
+                moved = migrate_deal_screenshots(vacuum=True)
+            st.success(f'Moved {moved} screenshot(s)')
+
+        st.write('**Query Cache:**')
+        st.json(get_query_cache().stats())
+        if st.button('🧹 Clear Query Cache', type='secondary'):
+            get_query_cache().clear()
+            st.success('Query cache cleared')
+
+        st.write('**Package Cache:**')
+        st.json(get_package_cache().stats())
+        if st.button('🧹 Clear Package Cache', type='secondary', help=f'Delete the cached analytics packages in {PACKAGE_CACHE_DIR}'):
+            get_package_cache().clear()
+            st.success('Package cache cleared')
+
         st.write('**Quick Actions:**')
         if st.button('🔄 Refresh Page', type='secondary'):
             st.rerun()
@@ -813,72 +2978,67 @@ Modified: {datetime.fromtimestamp(os.path.getmtime(DB_FILE)).strftime('%Y-%m-%d
     
     st.stop()
 
-# Common functions for leads
+# Keyset paging widgets: a stack of cursors per view lives in session_state
+
+def page_cursor(key, signature):
+    """Cursor for the current page of view `key`; paging restarts when signature (the filters) changes."""
+    if st.session_state.get(f'{key}_signature') != signature:
+        st.session_state[f'{key}_signature'] = signature
+        st.session_state[f'{key}_cursors'] = [None]
+    return st.session_state[f'{key}_cursors'][-1]
+
+def page_controls(key, df):
+    """Previous/next buttons under a page read with page_cursor()."""
+    cursors = st.session_state[f'{key}_cursors']
+    c_prev, c_page, c_next = st.columns([1, 2, 1])
+    if c_prev.button('◀ Previous', key=f'{key}_prev', disabled=len(cursors) == 1):
+        cursors.pop()
+        st.rerun()
+    c_page.write(f'Page {len(cursors)}')
+    if c_next.button('Next ▶', key=f'{key}_next', disabled=not df.attrs.get('next_cursor')):
+        cursors.append(df.attrs['next_cursor'])
+        st.rerun()
 
-def read_leads_df(filters=None, search=None, order_by='uploaded_at', desc=True, limit=100, offset=0, include_archived=False):
+# ----------------- Export helpers -----------------
+# Row height (points) of deal rows in image exports; images are shown scaled to fit
+EXPORT_IMAGE_ROW_PT = 120
+# Deals read from the database per batch by the export builders
+EXPORT_BATCH_ROWS = 20
+
+def iter_deals(uploaded_by=None, batch_size=EXPORT_BATCH_ROWS, progress=None):
+    """Yield deals newest first, reading batch_size rows (with their inline images, if any) at a time.
+    progress, if given, is called with the number of deals done after each batch.
+    """
     db = get_session()
-    q = db.query(Lead)
-    
-    # Default filter: exclude archived leads unless specifically requested
-    if not include_archived:
-        q = q.filter(sa.or_(Lead.is_archived.is_(None), Lead.is_archived == 'no'))
-    
-    if filters:
-        for k, v in filters.items():
-            if k == 'sales_agent' and v != 'All':
-                q = q.filter(Lead.sales_agent == v)
-            if k == 'status' and v != 'All':
-                q = q.filter(Lead.status == v)
-            if k == 'is_archived' and v != 'All':
-                q = q.filter(Lead.is_archived == v)
-            if k == 'archived_by' and v != 'All':
-                q = q.filter(Lead.archived_by == v)
-    
-    if search:
-        like = f"%{search}%"
-        q = q.filter(sa.or_(Lead.name.ilike(like), Lead.number.ilike(like), Lead.contact.ilike(like)))
-    
-    total = q.count()
-    if order_by:
-        col = getattr(Lead, order_by)
-        q = q.order_by(col.desc() if desc else col)
-    q = q.offset(offset).limit(limit)
-    df = pd.read_sql(q.statement, q.session.bind)
-    db.close()
-    return df, total
-
-def read_deals_df(filters=None, search=None, order_by='created_at', desc=True, limit=1000, offset=0):
-    db = get_session()
-    q = db.query(Deal)
-    if filters:
-        for k, v in filters.items():
-            if k == 'uploaded_by' and v != 'All':
-                q = q.filter(Deal.uploaded_by == v)
-    if search:
-        like = f"%{search}%"
-        q = q.filter(sa.or_(Deal.customer_name.ilike(like), Deal.phone.ilike(like)))
-    total = q.count()
-    if order_by:
-        col = getattr(Deal, order_by)
-        q = q.order_by(col.desc() if desc else col)
-    q = q.offset(offset).limit(limit)
-    # Exclude large binary column when reading to DataFrame
-    cols = [Deal.id, Deal.customer_name, Deal.phone, Deal.uploaded_by, Deal.uploaded_by_id, Deal.created_at]
-    q = db.query(*cols).filter(Deal.id.in_(db.query(Deal.id).subquery())) if True else q
-    df = pd.read_sql(q.statement, q.session.bind)
-    db.close()
-    return df, total
+    try:
+        q = db.query(Deal).options(sa.orm.undefer(Deal.payment_screenshot))
+        if uploaded_by:
+            q = q.filter(Deal.uploaded_by == uploaded_by)
+        for done, deal in enumerate(q.order_by(Deal.created_at.desc(), Deal.id.desc()).yield_per(batch_size), start=1):
+            yield deal
+            # Drop the batch's objects (and image bytes) once processed
+            db.expunge(deal)
+            if progress and done % batch_size == 0:
+                progress(done)
+    finally:
+        db.close()
 
-# ----------------- Export helpers -----------------
-def build_deals_excel_with_images(deals):
-    """Create an Excel workbook with deals and embedded screenshots if possible.
-    Returns bytes, or None if image embedding is unavailable.
+def build_deals_excel_with_images(uploaded_by=None, max_px=None, max_mb=None, progress=None):
+    """Excel workbook of deals (all, or one salesman's) with embedded screenshots,
+    written to a temporary file. Deals are read in batches and each screenshot is
+    downscaled to max_px (default EXPORT_IMAGE_PX) into a temp directory, so only
+    one image is in memory at a time. Once max_mb (default EXPORT_MAX_MB) of images
+    is embedded, later rows say so instead of carrying an image.
+    Returns the open file, rewound (closing it deletes it), or None if image
+    embedding is unavailable. progress is passed on to iter_deals().
     """
     try:
         from openpyxl import Workbook
         from openpyxl.drawing.image import Image as XLImage
     except Exception:
         return None
+    max_px = max_px or EXPORT_IMAGE_PX
+    budget = (max_mb or EXPORT_MAX_MB) * 2**20
 
     wb = Workbook()
     ws = wb.active
@@ -892,35 +3052,47 @@ def build_deals_excel_with_images(deals):
     except Exception:
         pass
 
-    for idx, d in enumerate(deals, start=2):
-        ws.cell(row=idx, column=1, value=d.id)
-        ws.cell(row=idx, column=2, value=d.customer_name)
-        ws.cell(row=idx, column=3, value=d.phone)
-        ws.cell(row=idx, column=4, value=d.uploaded_by)
-        ws.cell(row=idx, column=5, value=(d.created_at.strftime('%Y-%m-%d %H:%M') if d.created_at else None))
-        # Try embedding image
-        if getattr(d, 'payment_screenshot', None):
+    out = tempfile.TemporaryFile(suffix='.xlsx')
+    with tempfile.TemporaryDirectory(prefix='deal_export_') as image_dir:
+        embedded = 0
+        for idx, d in enumerate(iter_deals(uploaded_by, progress=progress), start=2):
+            ws.cell(row=idx, column=1, value=d.id)
+            ws.cell(row=idx, column=2, value=d.customer_name)
+            ws.cell(row=idx, column=3, value=d.phone)
+            ws.cell(row=idx, column=4, value=d.uploaded_by)
+            ws.cell(row=idx, column=5, value=(d.created_at.strftime('%Y-%m-%d %H:%M') if d.created_at else None))
+            content = deal_screenshot(d)
+            if not content:
+                ws.cell(row=idx, column=6, value='')
+                continue
+            image = make_thumbnail(content, max_px, image_format='JPEG')
+            if image is None:
+                ws.cell(row=idx, column=6, value='[image available]')
+                continue
+            if embedded + len(image) > budget:
+                ws.cell(row=idx, column=6, value='[image omitted: export size limit]')
+                continue
+            # openpyxl keeps only the path and reads the file when the workbook is saved
+            path = os.path.join(image_dir, f'{d.id}.jpg')
+            with open(path, 'wb') as f:
+                f.write(image)
+            embedded += len(image)
             try:
-                img_stream = io.BytesIO(d.payment_screenshot)
-                img = XLImage(img_stream)
-                cell = f'F{idx}'
-                ws.add_image(img, cell)
-                # Increase row height for visibility
-                try:
-                    ws.row_dimensions[idx].height = 120
-                except Exception:
-                    pass
+                img = XLImage(path)
+                scale = min(1.0, EXPORT_IMAGE_ROW_PT * 4 / 3 / img.height)
+                img.width, img.height = int(img.width * scale), int(img.height * scale)
+                ws.add_image(img, f'F{idx}')
+                ws.row_dimensions[idx].height = EXPORT_IMAGE_ROW_PT
             except Exception:
                 ws.cell(row=idx, column=6, value='[image available]')
-        else:
-            ws.cell(row=idx, column=6, value='')
-
-    buf = io.BytesIO()
-    wb.save(buf)
-    return buf.getvalue()
+        wb.save(out)
+    out.seek(0)
+    return out
 
-def build_deals_images_zip(deals):
-    """Create a zip containing deals' screenshots. Returns bytes."""
+def build_deals_images_zip(uploaded_by=None, progress=None):
+    """ZIP of deals' screenshots (all, or one salesman's) in a spooled temporary
+    file, reading deals a batch at a time. Returns the file, rewound.
+    """
     def _detect_ext(content: bytes) -> str:
         # PNG
         if content[:8] == b'\x89PNG\r\n\x1a\n':
@@ -932,248 +3104,95 @@ def build_deals_images_zip(deals):
         if len(content) >= 12 and content[:4] == b'RIFF' and content[8:12] == b'WEBP':
             return 'webp'
         return 'png'
-    buf = io.BytesIO()
-    with zipfile.ZipFile(buf, 'w', compression=zipfile.ZIP_DEFLATED) as zf:
-        for d in deals:
-            content = getattr(d, 'payment_screenshot', None)
+    def entries():
+        for d in iter_deals(uploaded_by, progress=progress):
+            content = deal_screenshot(d)
             if not content:
                 continue
-            ext = _detect_ext(content)
-            zf.writestr(f'deal_{d.id}_payment.{ext}', content)
-    return buf.getvalue()
+            yield f'deal_{d.id}_payment.{_detect_ext(content)}', content
+    return write_zip(entries())
+
+def _deal_progress(job, uploaded_by):
+    total = max(1, count_deals({'uploaded_by': uploaded_by} if uploaded_by else None))
+    return lambda done: job.progress(done / total, f'{done} of {total} deals')
+
+@job_handler('deals_excel_images', 'Deals Excel with images')
+def deals_excel_images_job(job, file_name, uploaded_by=None):
+    excel_file = build_deals_excel_with_images(uploaded_by, progress=_deal_progress(job, uploaded_by))
+    if excel_file is None:
+        raise RuntimeError('Embedding images needs openpyxl with image support')
+    return file_name, excel_file, 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
+
+@job_handler('deals_images_zip', 'Deal screenshots ZIP')
+def deals_images_zip_job(job, file_name, uploaded_by=None):
+    return file_name, build_deals_images_zip(uploaded_by, progress=_deal_progress(job, uploaded_by)), 'application/zip'
+
+@st.cache_resource(show_spinner=False)
+def get_chart_pool():
+    """Worker processes for chart rendering, or None when CHART_WORKERS <= 1. Created by the
+    first package job that renders charts, and each worker is only spawned once a chart needs it.
+    Spawned rather than forked so workers don't inherit the server's threads and SQLite handles.
+    """
+    if CHART_WORKERS <= 1:
+        return None
+    pool = ProcessPoolExecutor(
+        max_workers=CHART_WORKERS,
+        mp_context=multiprocessing.get_context('spawn'),
+        initializer=chart_render.init_worker,
+    )
+    atexit.register(pool.shutdown, wait=False, cancel_futures=True)
+    return pool
+
+def render_charts(kind, charts_data, date_str, title_prefix):
+    """Render every chart of `kind` ('png', 'pdf', 'html') in the chart pool; returns filename -> content in package order.
+    Results go into the query cache keyed by a hash of each chart's input frames, so
+    regenerating a package over unchanged data skips rendering altogether.
+    """
+    cache = get_query_cache()
+    pool = get_chart_pool()
+    specs = chart_render.chart_specs(kind, charts_data)
+    results, pending = {}, []
+    for filename, frames in specs:
+        key = ('chart', kind, filename, chart_render.chart_digest(frames, date_str, title_prefix))
+        hit, content = cache.get(key)
+        if hit:
+            results[filename] = content
+            continue
+        args = (kind, filename, frames, date_str, title_prefix)
+        pending.append((key, args, pool.submit(chart_render.render, *args) if pool else None))
+    for key, args, future in pending:
+        try:
+            content = future.result() if future else chart_render.render(*args)
+        except BrokenProcessPool:
+            # A worker died (OOM, killed); render this one here and start a fresh pool next time
+            get_chart_pool.clear()
+            content = chart_render.render(*args)
+        cache.put(key, content)
+        results[args[1]] = content
+    return {filename: results[filename] for filename, _ in specs if results[filename] is not None}
 
 def generate_analytics_graphs(df, charts_data, date_str, title_prefix="Analytics"):
-    """Generate comprehensive analytics graphs and return as bytes for zip inclusion."""
+    """Generate a multi-page PDF of the analytics graphs and return its bytes for zip inclusion."""
+    total = len(df)
+    uploaded = pd.to_datetime(df['uploaded_at'], errors='coerce').dropna() if 'uploaded_at' in df.columns else pd.Series()
+    summary = pd.DataFrame({
+        'Metric': ['Total Leads', 'Date Range', 'Active Agents', 'Conversion Rate'],
+        'Value': [
+            str(total),
+            f"{uploaded.min():%Y-%m-%d} to {uploaded.max():%Y-%m-%d}" if not uploaded.empty else 'N/A',
+            str(df['sales_agent'].nunique()) if total else '0',
+            f"{(df['status'] == 'won').sum() / total * 100:.1f}%" if total else '0%',
+        ],
+    })
     try:
-        import plotly.graph_objects as go
-        import plotly.express as px
-        from plotly.subplots import make_subplots
-        import matplotlib.pyplot as plt
-        import seaborn as sns
-        from matplotlib.backends.backend_pdf import PdfPages
-        # Removed local 'import io' to avoid shadowing the module-level import
-        
-        # Create a PDF with multiple graphs
-        pdf_buffer = io.BytesIO()
-        
-        with PdfPages(pdf_buffer) as pdf:
-            # Set style
-            plt.style.use('seaborn-v0_8')
-            fig_width, fig_height = 12, 8
-            
-            # 1. Daily Leads Trend
-            if 'daily_leads' in charts_data and not charts_data['daily_leads'].empty:
-                fig, ax = plt.subplots(figsize=(fig_width, fig_height))
-                daily_data = charts_data['daily_leads']
-                ax.plot(daily_data['date'], daily_data['count'], marker='o', linewidth=2, markersize=6)
-                ax.set_title(f'{title_prefix} - Daily Leads Trend', fontsize=16, fontweight='bold')
-                ax.set_xlabel('Date', fontsize=12)
-                ax.set_ylabel('Number of Leads', fontsize=12)
-                ax.grid(True, alpha=0.3)
-                plt.xticks(rotation=45)
-                plt.tight_layout()
-                pdf.savefig(fig)
-                plt.close()
-            
-            # 2. Agent Performance Breakdown
-            if 'agent_breakdown' in charts_data and not charts_data['agent_breakdown'].empty:
-                fig, ax = plt.subplots(figsize=(fig_width, fig_height))
-                agent_data = charts_data['agent_breakdown']
-                bars = ax.bar(agent_data['sales_agent'], agent_data['count'], 
-                             color=plt.cm.Set3(np.linspace(0, 1, len(agent_data))))
-                ax.set_title(f'{title_prefix} - Agent Performance Breakdown', fontsize=16, fontweight='bold')
-                ax.set_xlabel('Sales Agent', fontsize=12)
-                ax.set_ylabel('Number of Leads', fontsize=12)
-                ax.grid(True, alpha=0.3, axis='y')
-                
-                # Add value labels on bars
-                for bar in bars:
-                    height = bar.get_height()
-                    ax.text(bar.get_x() + bar.get_width()/2., height + 0.01,
-                           f'{int(height)}', ha='center', va='bottom', fontweight='bold')
-                
-                plt.xticks(rotation=45)
-                plt.tight_layout()
-                pdf.savefig(fig)
-                plt.close()
-            
-            # 3. Lead Status Distribution
-            if 'status_breakdown' in charts_data and not charts_data['status_breakdown'].empty:
-                fig, ax = plt.subplots(figsize=(fig_width, fig_height))
-                status_data = charts_data['status_breakdown']
-                colors = ['#2E8B57', '#FF6B6B', '#4ECDC4', '#45B7D1', '#96CEB4']
-                wedges, texts, autotexts = ax.pie(status_data['count'], labels=status_data['status'], 
-                                                 autopct='%1.1f%%', colors=colors, startangle=90)
-                ax.set_title(f'{title_prefix} - Lead Status Distribution', fontsize=16, fontweight='bold')
-                
-                # Make percentage labels bold
-                for autotext in autotexts:
-                    autotext.set_color('white')
-                    autotext.set_fontweight('bold')
-                
-                plt.tight_layout()
-                pdf.savefig(fig)
-                plt.close()
-            
-            # 4. Sales Funnel
-            if 'sales_funnel' in charts_data and not charts_data['sales_funnel'].empty:
-                funnel_data = charts_data['sales_funnel']
-                stage_col = 'stage' if 'stage' in funnel_data.columns else ('status' if 'status' in funnel_data.columns else None)
-                if stage_col is not None and 'count' in funnel_data.columns:
-                    fig = go.Figure(go.Funnel(
-                        y=funnel_data[stage_col],
-                        x=funnel_data['count'],
-                        textinfo="value+percent initial"
-                    ))
-                    fig.update_layout(
-                        title=f'{title_prefix} - Sales Funnel',
-                        template="plotly_white"
-                    )
-                    graphs['sales_funnel.html'] = fig.to_html(include_plotlyjs='cdn')
-            
-            # 5. Contact Methods Analysis
-            if 'contact_methods' in charts_data and not charts_data['contact_methods'].empty:
-                fig, ax = plt.subplots(figsize=(fig_width, fig_height))
-                contact_data = charts_data['contact_methods']
-                bars = ax.bar(contact_data['contact'], contact_data['count'], 
-                             color=plt.cm.Pastel1(np.linspace(0, 1, len(contact_data))))
-                ax.set_title(f'{title_prefix} - Contact Methods Analysis', fontsize=16, fontweight='bold')
-                ax.set_xlabel('Contact Method', fontsize=12)
-                ax.set_ylabel('Number of Leads', fontsize=12)
-                ax.grid(True, alpha=0.3, axis='y')
-                
-                # Add value labels
-                for bar in bars:
-                    height = bar.get_height()
-                    ax.text(bar.get_x() + bar.get_width()/2., height + 0.01,
-                           f'{int(height)}', ha='center', va='bottom', fontweight='bold')
-                
-                plt.xticks(rotation=45)
-                plt.tight_layout()
-                pdf.savefig(fig)
-                plt.close()
-            
-            # 6. Activity Heatmap
-            if 'activity_heatmap' in charts_data and not charts_data['activity_heatmap'].empty:
-                heat_data = charts_data['activity_heatmap'].copy()
-                # Normalize columns
-                if 'day_of_week' not in heat_data.columns or 'hour' not in heat_data.columns:
-                    dt_col = None
-                    for candidate in ['timestamp', 'created_at', 'uploaded_at', 'archived_at', 'date']:
-                        if candidate in heat_data.columns:
-                            dt_col = candidate
-                            break
-                    if dt_col is not None:
-                        heat_data[dt_col] = pd.to_datetime(heat_data[dt_col], errors='coerce')
-                        heat_data['day_of_week'] = heat_data[dt_col].dt.day_name()
-                        heat_data['hour'] = heat_data[dt_col].dt.hour
-                    else:
-                        heat_data['day_of_week'] = 'Unknown'
-                        heat_data['hour'] = 0
-                if 'count' not in heat_data.columns:
-                    heat_data['count'] = 1
-                pivot_data = heat_data.pivot_table(index='hour', columns='day_of_week', values='count', fill_value=0)
-                
-                fig = px.imshow(pivot_data.values,
-                               x=pivot_data.columns,
-                               y=pivot_data.index,
-                               title=f'{title_prefix} - Activity Heatmap',
-                               color_continuous_scale='YlOrRd',
-                               aspect="auto")
-                fig.update_layout(
-                    xaxis_title="Day of Week",
-                    yaxis_title="Hour of Day",
-                    template="plotly_white"
-                )
-                graphs['activity_heatmap.html'] = fig.to_html(include_plotlyjs='cdn')
-            
-            # 7. Trends Analysis (if available)
-            if 'trends' in charts_data and not charts_data['trends'].empty:
-                fig, ax = plt.subplots(figsize=(fig_width, fig_height))
-                trends_data = charts_data['trends']
-                ax.plot(trends_data['date'], trends_data['count'], label='Daily Count', marker='o')
-                if 'rolling_avg' in trends_data.columns:
-                    ax.plot(trends_data['date'], trends_data['rolling_avg'], 
-                           label='7-Day Rolling Average', linewidth=2, color='red')
-                ax.set_title(f'{title_prefix} - Trends Analysis', fontsize=16, fontweight='bold')
-                ax.set_xlabel('Date', fontsize=12)
-                ax.set_ylabel('Number of Leads', fontsize=12)
-                ax.legend()
-                ax.grid(True, alpha=0.3)
-                plt.xticks(rotation=45)
-                plt.tight_layout()
-                pdf.savefig(fig)
-                plt.close()
-            
-            # 8. Summary Dashboard (Combined view)
-            fig = plt.figure(figsize=(16, 12))
-            fig.suptitle(f'{title_prefix} - Summary Dashboard', fontsize=20, fontweight='bold')
-            
-            # Create subplots
-            gs = fig.add_gridspec(3, 3, hspace=0.3, wspace=0.3)
-            
-            # Key metrics
-            ax1 = fig.add_subplot(gs[0, :])
-            ax1.axis('off')
-            summary_text = f"""
-            {title_prefix} Summary Report - Generated on {date_str}
-            
-            Total Leads: {len(df)}
-            Date Range: {df['uploaded_at'].min().strftime('%Y-%m-%d') if not df.empty else 'N/A'} to {df['uploaded_at'].max().strftime('%Y-%m-%d') if not df.empty else 'N/A'}
-            Active Agents: {len(df['sales_agent'].unique()) if not df.empty else 0}
-            Conversion Rate: {((df['status'] == 'won').sum() / len(df) * 100):.1f}% if not df.empty else 0%
-            """
-            ax1.text(0.1, 0.5, summary_text, fontsize=14, verticalalignment='center',
-                    bbox=dict(boxstyle="round,pad=0.3", facecolor="lightblue", alpha=0.5))
-            
-            # Status distribution (pie chart)
-            if 'status_breakdown' in charts_data and not charts_data['status_breakdown'].empty:
-                ax2 = fig.add_subplot(gs[1, 0])
-                status_data = charts_data['status_breakdown']
-                ax2.pie(status_data['count'], labels=status_data['status'], autopct='%1.1f%%', startangle=90)
-                ax2.set_title('Status Distribution')
-            
-            # Agent performance (bar chart)
-            if 'agent_breakdown' in charts_data and not charts_data['agent_breakdown'].empty:
-                ax3 = fig.add_subplot(gs[1, 1])
-                agent_data = charts_data['agent_breakdown'].head(5)  # Top 5 agents
-                ax3.bar(agent_data['sales_agent'], agent_data['count'])
-                ax3.set_title('Top 5 Agents')
-                plt.setp(ax3.xaxis.get_majorticklabels(), rotation=45)
-            
-            # Daily trend (line chart)
-            if 'daily_leads' in charts_data and not charts_data['daily_leads'].empty:
-                ax4 = fig.add_subplot(gs[1, 2])
-                daily_data = charts_data['daily_leads']
-                ax4.plot(daily_data['date'], daily_data['count'], marker='o')
-                ax4.set_title('Daily Trend')
-                plt.setp(ax4.xaxis.get_majorticklabels(), rotation=45)
-            
-            # Contact methods (horizontal bar)
-            if 'contact_methods' in charts_data and not charts_data['contact_methods'].empty:
-                ax5 = fig.add_subplot(gs[2, :])
-                contact_data = charts_data['contact_methods']
-                ax5.barh(contact_data['contact'], contact_data['count'])
-                ax5.set_title('Contact Methods')
-                ax5.set_xlabel('Number of Leads')
-            
-            plt.tight_layout()
-            pdf.savefig(fig)
-            plt.close()
-        
-        return pdf_buffer.getvalue()
-        
-    except Exception as e:
+        return render_charts('pdf', {**charts_data, 'summary': summary}, date_str, title_prefix)['analytics_report.pdf']
+    except Exception:
         # Fallback: create simple text report
-        report_buffer = io.BytesIO()
         report_content = f"""
 {title_prefix} Report - Generated on {date_str}
 
 Summary Statistics:
-- Total Leads: {len(df)}
-- Date Range: {df['uploaded_at'].min().strftime('%Y-%m-%d') if not df.empty else 'N/A'} to {df['uploaded_at'].max().strftime('%Y-%m-%d') if not df.empty else 'N/A'}
-- Active Agents: {len(df['sales_agent'].unique()) if not df.empty else 0}
-- Conversion Rate: {((df['status'] == 'won').sum() / len(df) * 100):.1f}% if not df.empty else 0%
+{chr(10).join(f"- {row.Metric}: {row.Value}" for row in summary.itertuples())}
 
 Chart Data Available:
 {chr(10).join([f"- {chart_name}: {len(chart_df)} records" for chart_name, chart_df in charts_data.items() if isinstance(chart_df, pd.DataFrame)])}
@@ -1181,305 +3200,435 @@ Chart Data Available:
 Note: Graphs could not be generated due to missing dependencies.
 Please ensure matplotlib, seaborn, and plotly are installed for full graph functionality.
 """
-        report_buffer.write(report_content.encode('utf-8'))
-        return report_buffer.getvalue()
+        return report_content.encode('utf-8')
 
 def generate_plotly_graphs(df, charts_data, date_str, title_prefix="Analytics"):
     """Generate interactive Plotly graphs and return as HTML files for zip inclusion."""
     try:
-        import plotly.graph_objects as go
-        import plotly.express as px
-        from plotly.subplots import make_subplots
+        return render_charts('html', charts_data, date_str, title_prefix)
+    except Exception:
+        return {}
+
+def generate_analytics_pngs(df, charts_data, date_str, title_prefix="Analytics"):
+    """Generate static PNG charts and return as filename->bytes mapping."""
+    return render_charts('png', charts_data, date_str, title_prefix)
+
+@job_handler('cto_analytics_package', 'CTO analytics package')
+def cto_analytics_package_job(job, filters):
+    """ZIP of the CTO dashboard for `filters`: data and chart sheets, PNG and HTML graphs, deals and a README.
+    The same filters over unchanged data reuse the last build (see cached_package).
+    """
+    now = datetime.now()
+    day_name = now.strftime('%A')  # Full day name (e.g., 'Monday')
+    date_str = now.strftime('%Y-%m-%d')  # Date format (e.g., '2024-08-09')
+    frames = lead_dashboard_frames(filters)
+    date_range = (filters['start'], filters['end']) if 'start' in filters else None
+
+    def package_entries():
+        df_f = read_dashboard_leads_df(filters)
+        # Main filtered data plus all chart data as Excel sheets
+        sheets = {'Filtered_Leads': df_f}
+
+        # Get comments and activities for filtered leads
+        comments_df = read_dashboard_comments_df(filters)
+        activities_df = read_dashboard_activities_df(filters)
         
-        graphs = {}
+        # Comments and Activities data
+        if not comments_df.empty:
+            sheets['Lead_Comments'] = comments_df
+        if not activities_df.empty:
+            sheets['Lead_Activities'] = activities_df
         
-        # 1. Daily Leads Trend
-        if 'daily_leads' in charts_data and not charts_data['daily_leads'].empty:
-            daily_data = charts_data['daily_leads']
-            fig = px.line(daily_data, x='date', y='count', 
-                         title=f'{title_prefix} - Daily Leads Trend',
-                         markers=True)
-            fig.update_layout(
-                xaxis_title="Date",
-                yaxis_title="Number of Leads",
-                template="plotly_white"
-            )
-            graphs['daily_leads_trend.html'] = fig.to_html(include_plotlyjs='cdn')
+        # Chart data from all the charts above
+        charts_data = {}
+        for key, sheet in [('daily_leads', 'Daily_Leads'), ('agent_breakdown', 'Agent_Breakdown'),
+                           ('status_breakdown', 'Status_Breakdown'), ('sales_funnel', 'Sales_Funnel'),
+                           ('contact_methods', 'Contact_Methods'), ('activity_heatmap', 'Activity_Heatmap'),
+                           ('trends', 'Trends_Analysis')]:
+            if not frames[key].empty:
+                sheets[sheet] = frames[key]
+                charts_data[key] = frames[key]
         
-        # 2. Agent Performance Breakdown
-        if 'agent_breakdown' in charts_data and not charts_data['agent_breakdown'].empty:
-            agent_data = charts_data['agent_breakdown']
-            fig = px.bar(agent_data, x='sales_agent', y='count',
-                        title=f'{title_prefix} - Agent Performance Breakdown',
-                        color='count', color_continuous_scale='viridis')
-            fig.update_layout(
-                xaxis_title="Sales Agent",
-                yaxis_title="Number of Leads",
-                template="plotly_white"
-            )
-            graphs['agent_performance.html'] = fig.to_html(include_plotlyjs='cdn')
+        # Enhanced CTO Summary statistics
+        summary_data = {
+            'Metric': ['Total Leads', 'Filtered Leads', 'Active Agents', 'Date Range', 'Leads with Comments', 'Leads with Activities', 'Total Comments', 'Total Activities', 'Generated By'],
+            'Value': [
+                lead_kpis()['total'],
+                len(df_f),
+                len(frames['agent_breakdown']),
+                f"{date_range[0] if isinstance(date_range, (list, tuple)) else 'All'} to {date_range[1] if isinstance(date_range, (list, tuple)) else 'All'}",
+                len(comments_df['lead_id'].unique()) if not comments_df.empty else 0,
+                len(activities_df['lead_id'].unique()) if not activities_df.empty else 0,
+                len(comments_df) if not comments_df.empty else 0,
+                len(activities_df) if not activities_df.empty else 0,
+                'CTO Dashboard'
+            ]
+        }
+        sheets['CTO_Summary'] = pd.DataFrame(summary_data)
+        yield f'CTO_Analytics_{date_str}.xlsx', excel_bytes(sheets)
         
-        # 3. Lead Status Distribution
-        if 'status_breakdown' in charts_data and not charts_data['status_breakdown'].empty:
-            status_data = charts_data['status_breakdown']
-            fig = px.pie(status_data, values='count', names='status',
-                        title=f'{title_prefix} - Lead Status Distribution')
-            fig.update_layout(template="plotly_white")
-            graphs['status_distribution.html'] = fig.to_html(include_plotlyjs='cdn')
+        job.progress(0.3, 'Rendering charts')
+        # Generate and add PNG graphs (instead of PDF)
+        png_graphs = generate_analytics_pngs(df_f, charts_data, date_str, "CTO Analytics")
+        for filename, content in png_graphs.items():
+            yield f'graphs_png/{filename}', content
         
-        # 4. Sales Funnel
-        if 'sales_funnel' in charts_data and not charts_data['sales_funnel'].empty:
-            funnel_data = charts_data['sales_funnel']
-            stage_col = 'stage' if 'stage' in funnel_data.columns else ('status' if 'status' in funnel_data.columns else None)
-            if stage_col is not None and 'count' in funnel_data.columns:
-                fig = go.Figure(go.Funnel(
-                    y=funnel_data[stage_col],
-                    x=funnel_data['count'],
-                    textinfo="value+percent initial"
-                ))
-                fig.update_layout(
-                    title=f'{title_prefix} - Sales Funnel',
-                    template="plotly_white"
-                )
-                graphs['sales_funnel.html'] = fig.to_html(include_plotlyjs='cdn')
+        # Generate and add interactive HTML graphs
+        html_graphs = generate_plotly_graphs(df_f, charts_data, date_str, "CTO Analytics")
+        for filename, html_content in html_graphs.items():
+            yield f'graphs/{filename}', html_content
         
-        # 5. Contact Methods Analysis
-        if 'contact_methods' in charts_data and not charts_data['contact_methods'].empty:
-            contact_data = charts_data['contact_methods']
-            fig = px.bar(contact_data, x='contact', y='count',
-                        title=f'{title_prefix} - Contact Methods Analysis',
-                        color='count', color_continuous_scale='plasma')
-            fig.update_layout(
-                xaxis_title="Contact Method",
-                yaxis_title="Number of Leads",
-                template="plotly_white"
-            )
-            graphs['contact_methods.html'] = fig.to_html(include_plotlyjs='cdn')
+        job.progress(0.8, 'Adding deals')
+        # Add deals data if available
+        deals_df, _ = read_deals_df.uncached(limit=None, count=None)
+        if not deals_df.empty:
+            # Deals summary
+            deals_summary = deals_df.groupby('uploaded_by').size().reset_index(name='deals_count')
+            yield f'CTO_Deals_Report_{date_str}.xlsx', excel_bytes({'All_Deals': deals_df, 'Deals_by_Agent': deals_summary})
         
-        # 6. Activity Heatmap
-        if 'activity_heatmap' in charts_data and not charts_data['activity_heatmap'].empty:
-            heat_data = charts_data['activity_heatmap']
-            pivot_data = heat_data.pivot_table(index='hour', columns='day_of_week', values='count', fill_value=0)
-            
-            fig = px.imshow(pivot_data.values,
-                           x=pivot_data.columns,
-                           y=pivot_data.index,
-                           title=f'{title_prefix} - Activity Heatmap',
-                           color_continuous_scale='YlOrRd',
-                           aspect="auto")
-            fig.update_layout(
-                xaxis_title="Day of Week",
-                yaxis_title="Hour of Day",
-                template="plotly_white"
-            )
-            graphs['activity_heatmap.html'] = fig.to_html(include_plotlyjs='cdn')
+        # Add a README file
+        readme_content = f"""CTO Analytics Package
+Generated on: {now.strftime('%A, %B %d, %Y at %H:%M')}
+Generated for: CTO Dashboard
+
+Contents:
+- CTO_Analytics_{date_str}.xlsx: Complete analytics with all charts data
+- graphs_png/ folder: Static PNG graphs with headers (open on any device)
+- graphs/ folder: Interactive HTML graphs (open in browser)
+  * daily_leads_trend.html: Daily leads trend analysis
+  * agent_performance.html: Agent performance breakdown
+  * status_distribution.html: Lead status distribution
+  * sales_funnel.html: Sales funnel visualization
+  * contact_methods.html: Contact methods analysis
+  * activity_heatmap.html: Activity heatmap
+  * interactive_dashboard.html: Combined interactive dashboard
+- CTO_Deals_Report_{date_str}.xlsx: Deals tracking and performance data
+
+Chart Data Included:
+- Daily leads trends
+- Agent performance breakdown
+- Lead status distribution
+- Sales funnel analysis
+- Contact method analysis
+- Activity heatmaps
+- Rolling averages and trends
+- Filtered data based on current selections
+
+Graphs Available:
+- Static PNG graphs for printing and sharing
+- Interactive HTML graphs for detailed analysis
+- Combined dashboard view for executive overview
+
+CTO Summary:
+- Total Leads: {lead_kpis()['total']}
+- Filtered Leads: {len(df_f)}
+- Active Agents: {len(frames['agent_breakdown'])}
+
+This package contains comprehensive technical analytics for system management.
+"""
+        yield 'README.txt', readme_content
+
+    package = cached_package('cto_analytics', {'filters': filters, 'date': date_str},
+                             ('leads', 'deals', 'comments', 'activities'),
+                             lambda: write_zip(package_entries()))
+    return f"CTO_Analytics_{day_name}_{date_str}.zip", package, 'application/zip'
+
+@job_handler('ceo_analytics_package', 'Analytics package')
+def ceo_analytics_package_job(job):
+    """ZIP of the executive analytics over all active leads; unchanged data reuses the last build."""
+    now = datetime.now()
+    day_name = now.strftime('%A')
+    date_str = now.strftime('%Y-%m-%d')
+    kpis = lead_kpis()
+    total_leads, unique_contacts, top_agent = kpis['total'], kpis['unique_contacts'], kpis['top_agent']
+    frames = lead_dashboard_frames()
+    charts_data = {key: frames[key] for key in PACKAGE_CHARTS if not frames[key].empty}
+
+    def package_entries():
+        df_all = read_dashboard_leads_df()
+        status_counts = frames['status_breakdown'].set_index('status')['count']
+        # Main data plus all chart data as Excel sheets
+        sheets = {'All_Leads': df_all}
+        for chart_name, chart_df in charts_data.items():
+            if isinstance(chart_df, pd.DataFrame) and not chart_df.empty:
+                sheets[chart_name.replace('_', ' ').title()[:31]] = chart_df
         
-        # 7. Dashboard (Combined view)
-        if charts_data:
-            fig = make_subplots(
-                rows=2, cols=2,
-                subplot_titles=('Daily Trend', 'Agent Performance', 'Status Distribution', 'Contact Methods'),
-                specs=[[{"type": "scatter"}, {"type": "bar"}],
-                       [{"type": "pie"}, {"type": "bar"}]]
-            )
-            
-            # Add traces
-            if 'daily_leads' in charts_data and not charts_data['daily_leads'].empty:
-                daily_data = charts_data['daily_leads']
-                fig.add_trace(
-                    go.Scatter(x=daily_data['date'], y=daily_data['count'], mode='lines+markers'),
-                    row=1, col=1
-                )
-            
-            if 'agent_breakdown' in charts_data and not charts_data['agent_breakdown'].empty:
-                agent_data = charts_data['agent_breakdown']
-                fig.add_trace(
-                    go.Bar(x=agent_data['sales_agent'], y=agent_data['count']),
-                    row=1, col=2
-                )
-            
-            if 'status_breakdown' in charts_data and not charts_data['status_breakdown'].empty:
-                status_data = charts_data['status_breakdown']
-                fig.add_trace(
-                    go.Pie(values=status_data['count'], labels=status_data['status']),
-                    row=2, col=1
-                )
-            
-            if 'contact_methods' in charts_data and not charts_data['contact_methods'].empty:
-                contact_data = charts_data['contact_methods']
-                fig.add_trace(
-                    go.Bar(x=contact_data['contact'], y=contact_data['count']),
-                    row=2, col=2
-                )
-            
-            fig.update_layout(height=800, title_text=f"{title_prefix} - Interactive Dashboard")
-            graphs['interactive_dashboard.html'] = fig.to_html(include_plotlyjs='cdn')
+        # Summary statistics
+        summary_data = {
+            'Metric': ['Total Leads', 'Unique Contacts', 'Top Agent', 'Active Salesmen', 'Conversion Rate'],
+            'Value': [
+                total_leads,
+                unique_contacts,
+                top_agent,
+                len(frames['agent_breakdown']),
+                f"{status_counts.get('won', 0) / total_leads * 100:.1f}%" if total_leads else "0%"
+            ]
+        }
+        sheets['Executive_Summary'] = pd.DataFrame(summary_data)
+        yield f'CRM_Analytics_{date_str}.xlsx', excel_bytes(sheets)
         
-        return graphs
+        job.progress(0.3, 'Rendering charts')
+        # Generate and add PNG graphs (instead of PDF)
+        png_graphs = generate_analytics_pngs(df_all, charts_data, date_str, "CEO Analytics")
+        for filename, content in png_graphs.items():
+            yield f'graphs_png/{filename}', content
         
-    except Exception as e:
-        return {}
+        # Generate and add interactive HTML graphs
+        html_graphs = generate_plotly_graphs(df_all, charts_data, date_str, "CEO Analytics")
+        for filename, html_content in html_graphs.items():
+            yield f'graphs/{filename}', html_content
+        
+        job.progress(0.8, 'Adding deals')
+        # Add deals data if available
+        deals_df, _ = read_deals_df.uncached(limit=None, count=None)
+        if not deals_df.empty:
+            # Deals summary
+            deals_summary = deals_df.groupby('uploaded_by').size().reset_index(name='deals_count')
+            yield f'Deals_Report_{date_str}.xlsx', excel_bytes({'All_Deals': deals_df, 'Deals_by_Agent': deals_summary})
+        
+        # Add a README file
+        readme_content = f"""IQ Stats CRM Analytics Package
+Generated on: {now.strftime('%A, %B %d, %Y at %H:%M')}
+Generated for: CEO Dashboard
 
-def generate_analytics_pngs(df, charts_data, date_str, title_prefix="Analytics"):
-    """Generate static PNG charts and return as filename->bytes mapping."""
-    import matplotlib.pyplot as plt
-    import seaborn as sns
-    pngs: dict[str, bytes] = {}
-
-    plt.style.use('seaborn-v0_8')
-
-    def save_fig(fig, filename: str) -> None:
-        buf = io.BytesIO()
-        fig.savefig(buf, format='png', dpi=150, bbox_inches='tight')
-        plt.close(fig)
-        pngs[filename] = buf.getvalue()
-
-    # 0. Summary dashboard
-    fig = plt.figure(figsize=(16, 10))
-    fig.suptitle(f"{title_prefix} — Summary Dashboard ({date_str})", fontsize=18, fontweight='bold')
-    gs = fig.add_gridspec(2, 2, hspace=0.35, wspace=0.25)
-
-    if 'daily_leads' in charts_data and not charts_data['daily_leads'].empty:
-        ax = fig.add_subplot(gs[0, 0])
-        daily_data = charts_data['daily_leads']
-        ax.plot(daily_data['date'], daily_data['count'], marker='o')
-        ax.set_title('Daily Leads Trend')
-        ax.set_xlabel('Date')
-        ax.set_ylabel('Leads')
-        ax.grid(True, alpha=0.3)
-
-    if 'agent_breakdown' in charts_data and not charts_data['agent_breakdown'].empty:
-        ax = fig.add_subplot(gs[0, 1])
-        agent_data = charts_data['agent_breakdown']
-        ax.bar(agent_data['sales_agent'], agent_data['count'])
-        ax.set_title('Agent Performance')
-        ax.set_xlabel('Agent')
-        ax.set_ylabel('Leads')
-        plt.setp(ax.xaxis.get_majorticklabels(), rotation=45)
-
-    if 'status_breakdown' in charts_data and not charts_data['status_breakdown'].empty:
-        ax = fig.add_subplot(gs[1, 0])
-        status_data = charts_data['status_breakdown']
-        ax.pie(status_data['count'], labels=status_data['status'], autopct='%1.1f%%', startangle=90)
-        ax.set_title('Status Distribution')
-
-    if 'contact_methods' in charts_data and not charts_data['contact_methods'].empty:
-        ax = fig.add_subplot(gs[1, 1])
-        contact_data = charts_data['contact_methods']
-        ax.bar(contact_data['contact'], contact_data['count'])
-        ax.set_title('Contact Methods')
-        ax.set_xlabel('Method')
-        ax.set_ylabel('Leads')
-        plt.setp(ax.xaxis.get_majorticklabels(), rotation=45)
-
-    save_fig(fig, '00_summary_dashboard.png')
-
-    # 1. Individual charts with clear headers
-    if 'daily_leads' in charts_data and not charts_data['daily_leads'].empty:
-        fig, ax = plt.subplots(figsize=(12, 8))
-        daily_data = charts_data['daily_leads']
-        ax.plot(daily_data['date'], daily_data['count'], marker='o')
-        ax.set_title(f'{title_prefix} — Daily Leads Trend ({date_str})', fontsize=16, fontweight='bold')
-        ax.set_xlabel('Date')
-        ax.set_ylabel('Number of Leads')
-        ax.grid(True, alpha=0.3)
-        save_fig(fig, '01_daily_leads_trend.png')
-
-    if 'agent_breakdown' in charts_data and not charts_data['agent_breakdown'].empty:
-        fig, ax = plt.subplots(figsize=(12, 8))
-        agent_data = charts_data['agent_breakdown']
-        bars = ax.bar(agent_data['sales_agent'], agent_data['count'], color=plt.cm.Set3(np.linspace(0, 1, len(agent_data))))
-        ax.set_title(f'{title_prefix} — Agent Performance Breakdown ({date_str})', fontsize=16, fontweight='bold')
-        ax.set_xlabel('Sales Agent')
-        ax.set_ylabel('Number of Leads')
-        ax.grid(True, alpha=0.3, axis='y')
-        for bar in bars:
-            h = bar.get_height()
-            ax.text(bar.get_x() + bar.get_width()/2, h + 0.01, f'{int(h)}', ha='center', va='bottom')
-        plt.setp(ax.xaxis.get_majorticklabels(), rotation=45)
-        save_fig(fig, '02_agent_performance.png')
-
-    if 'status_breakdown' in charts_data and not charts_data['status_breakdown'].empty:
-        fig, ax = plt.subplots(figsize=(10, 10))
-        status_data = charts_data['status_breakdown']
-        ax.pie(status_data['count'], labels=status_data['status'], autopct='%1.1f%%', startangle=90)
-        ax.set_title(f'{title_prefix} — Lead Status Distribution ({date_str})', fontsize=16, fontweight='bold')
-        save_fig(fig, '03_status_distribution.png')
-
-    if 'sales_funnel' in charts_data and not charts_data['sales_funnel'].empty:
-        fig, ax = plt.subplots(figsize=(12, 8))
-        funnel_data = charts_data['sales_funnel']
-        stage_col = 'stage' if 'stage' in funnel_data.columns else ('status' if 'status' in funnel_data.columns else None)
-        if stage_col is not None and 'count' in funnel_data.columns:
-            stages = funnel_data[stage_col]
-            counts = funnel_data['count']
-            y_pos = np.arange(len(stages))
-            bars = ax.barh(y_pos, counts, color=plt.cm.viridis(np.linspace(0, 1, len(stages))))
-            ax.set_yticks(y_pos)
-            ax.set_yticklabels(stages)
-            ax.set_xlabel('Number of Leads')
-            ax.set_title(f'{title_prefix} — Sales Funnel ({date_str})', fontsize=16, fontweight='bold')
-            ax.grid(True, alpha=0.3, axis='x')
-            for bar, count in zip(bars, counts):
-                ax.text(bar.get_width() + 0.01, bar.get_y() + bar.get_height()/2, f'{int(count)}', va='center')
+Contents:
+- CRM_Analytics_{date_str}.xlsx: Complete leads analysis with all charts data
+- graphs_png/ folder: Static PNG graphs with headers (open on any device)
+- graphs/ folder: Interactive HTML graphs (open in browser)
+  * daily_leads_trend.html: Daily leads trend analysis
+  * agent_performance.html: Agent performance breakdown
+  * status_distribution.html: Lead status distribution
+  * sales_funnel.html: Sales funnel visualization
+  * contact_methods.html: Contact methods analysis
+  * activity_heatmap.html: Activity heatmap
+  * interactive_dashboard.html: Combined interactive dashboard
+- Deals_Report_{date_str}.xlsx: Deals tracking and performance data
+
+Chart Data Included:
+- Daily leads trends
+- Agent performance breakdown
+- Lead status distribution
+- Sales funnel analysis
+- Contact method analysis
+- Activity heatmaps
+- Rolling averages and trends
+
+Graphs Available:
+- Static PNG graphs with headers for simple sharing
+- Interactive HTML graphs for detailed analysis
+- Combined dashboard view for executive overview
+
+Executive Summary:
+- Total Leads: {total_leads}
+- Unique Contacts: {unique_contacts}
+- Top Performing Agent: {top_agent}
+
+This package contains comprehensive analytics for strategic decision making.
+"""
+        yield 'README.txt', readme_content
+
+    package = cached_package('ceo_analytics', {'date': date_str}, ('leads', 'deals'),
+                             lambda: write_zip(package_entries()))
+    return f"IQ_Stats_CRM_Analytics_{day_name}_{date_str}.zip", package, 'application/zip'
+
+def _archived_lead_rows(leads):
+    """Short export rows shared by the archived-leads quick exports and analytics report."""
+    return [{
+        'Lead ID': lead.id,
+        'Customer Name': lead.name,
+        'Sales Agent': lead.sales_agent,
+        'Status': lead.status,
+        'Archived By': lead.archived_by,
+        'Archive Date': lead.archived_at.strftime('%Y-%m-%d %H:%M') if lead.archived_at else '',
+        'Archive Reason': lead.archive_reason
+    } for lead in leads]
+
+@job_handler('archived_leads_report', 'Archived leads report')
+def archived_leads_report_job(job, start, end, reason='All', archived_by='All', file_format='Excel',
+                              include_analytics=True, generated_by=None):
+    """Leads archived between start and end (optionally for one reason / archiver) as Excel or CSV."""
+    with get_session() as db:
+        start_datetime = datetime.combine(start, datetime.min.time())
+        end_datetime = datetime.combine(end, datetime.max.time())
+
+        # Build enhanced query with filters
+        q = db.query(Lead).filter(
+            LEAD_IS_ARCHIVED,
+            Lead.archived_at >= start_datetime,
+            Lead.archived_at <= end_datetime
+        )
+        if reason != 'All':
+            q = q.filter(Lead.archive_reason == reason)
+        if archived_by != 'All':
+            q = q.filter(Lead.archived_by == archived_by)
+
+        export_data = []
+        for lead in q.all():
+            export_data.append({
+                'Lead ID': lead.id,
+                'Lead Number': lead.number,
+                'Customer Name': lead.name,
+                'Sales Agent': lead.sales_agent,
+                'Contact Method': lead.contact,
+                'Case Description': lead.case_desc,
+                'Feedback': lead.feedback,
+                'Status': lead.status,
+                'Assigned To': lead.assigned_to,
+                'Original Upload Date': lead.uploaded_at.strftime('%Y-%m-%d %H:%M') if lead.uploaded_at else '',
+                'Archived By': lead.archived_by,
+                'Archive Date': lead.archived_at.strftime('%Y-%m-%d %H:%M') if lead.archived_at else '',
+                'Archive Reason': lead.archive_reason,
+                'Scheduled Archive Date': lead.archive_date.strftime('%Y-%m-%d %H:%M') if lead.archive_date else '',
+                'Days Since Archive': (datetime.utcnow() - lead.archived_at).days if lead.archived_at else 0
+            })
+    if not export_data:
+        job.progress(1.0, 'No archived leads found matching the criteria.')
+        return None
+    df_export = pd.DataFrame(export_data)
+    job.progress(0.5, f'Writing {len(df_export)} leads')
+
+    if file_format != 'Excel':
+        job.progress(1.0, f'{len(df_export)} leads included')
+        return f"Archived_Leads_{start}_{end}.csv", df_export.to_csv(index=False), 'text/csv'
+
+    buffer = io.BytesIO()
+    with pd.ExcelWriter(buffer, engine='openpyxl') as writer:
+        df_export.to_excel(writer, sheet_name='Archived_Leads', index=False)
+
+        if include_analytics:
+            # Analytics summary sheet
+            analytics_data = {
+                'Metric': [
+                    'Total Archived Leads',
+                    'Date Range',
+                    'Filtered By Reason',
+                    'Filtered By Agent',
+                    'Average Days Since Archive',
+                    'Most Common Archive Reason',
+                    'Most Active Archiver',
+                    'Export Generated By',
+                    'Export Generated On'
+                ],
+                'Value': [
+                    len(df_export),
+                    f"{start} to {end}",
+                    reason,
+                    archived_by,
+                    f"{df_export['Days Since Archive'].mean():.1f} days",
+                    df_export['Archive Reason'].mode().iloc[0] if not df_export['Archive Reason'].mode().empty else 'N/A',
+                    df_export['Archived By'].mode().iloc[0] if not df_export['Archived By'].mode().empty else 'N/A',
+                    generated_by,
+                    datetime.now().strftime('%Y-%m-%d %H:%M')
+                ]
+            }
+            pd.DataFrame(analytics_data).to_excel(writer, sheet_name='Analytics_Summary', index=False)
+
+            # Archive reasons breakdown
+            reason_counts = df_export['Archive Reason'].value_counts().reset_index()
+            reason_counts.columns = ['Archive Reason', 'Count']
+            reason_counts.to_excel(writer, sheet_name='Archive_Reasons', index=False)
+
+    job.progress(1.0, f'{len(df_export)} leads included')
+    return (f"Archived_Leads_{start}_{end}.xlsx", buffer.getvalue(),
+            'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet')
+
+@job_handler('archived_leads_export', 'Archived leads export')
+def archived_leads_export_job(job, recent_days=None, reason=None):
+    """All archived leads, those archived in the last recent_days, or those archived for one reason."""
+    with get_session() as db:
+        q = db.query(Lead).filter(LEAD_IS_ARCHIVED)
+        if recent_days:
+            q = q.filter(Lead.archived_at >= datetime.utcnow() - pd.Timedelta(days=recent_days))
+            sheet_name = f'Recent_Archives_{recent_days}d'
+            filename = f"Recent_Archives_{recent_days}days_{datetime.now().strftime('%Y%m%d')}.xlsx"
+            empty = f'No archives found in the last {recent_days} days.'
+        elif reason is not None:
+            q = q.filter(Lead.archive_reason == reason)
+            sheet_name = f'Reason_{reason[:20]}'
+            filename = f"Archives_Reason_{reason[:20]}_{datetime.now().strftime('%Y%m%d')}.xlsx"
+            empty = f'No archives found for reason: {reason}'
         else:
-            ax.text(0.5, 0.5, 'No funnel data', ha='center', va='center')
-        save_fig(fig, '04_sales_funnel.png')
-
-    if 'contact_methods' in charts_data and not charts_data['contact_methods'].empty:
-        fig, ax = plt.subplots(figsize=(12, 8))
-        contact_data = charts_data['contact_methods']
-        bars = ax.bar(contact_data['contact'], contact_data['count'], color=plt.cm.Pastel1(np.linspace(0, 1, len(contact_data))))
-        ax.set_title(f'{title_prefix} — Contact Methods Analysis ({date_str})', fontsize=16, fontweight='bold')
-        ax.set_xlabel('Contact Method')
-        ax.set_ylabel('Number of Leads')
-        ax.grid(True, alpha=0.3, axis='y')
-        for bar in bars:
-            h = bar.get_height()
-            ax.text(bar.get_x() + bar.get_width()/2, h + 0.01, f'{int(h)}', ha='center', va='bottom')
-        plt.setp(ax.xaxis.get_majorticklabels(), rotation=45)
-        save_fig(fig, '05_contact_methods.png')
-
-    if 'activity_heatmap' in charts_data and not charts_data['activity_heatmap'].empty:
-        fig, ax = plt.subplots(figsize=(12, 8))
-        heat_data = charts_data['activity_heatmap'].copy()
-        # Normalize columns
-        if 'day_of_week' not in heat_data.columns or 'hour' not in heat_data.columns:
-            dt_col = None
-            for candidate in ['timestamp', 'created_at', 'uploaded_at', 'archived_at', 'date']:
-                if candidate in heat_data.columns:
-                    dt_col = candidate
-                    break
-            if dt_col is not None:
-                heat_data[dt_col] = pd.to_datetime(heat_data[dt_col], errors='coerce')
-                heat_data['day_of_week'] = heat_data[dt_col].dt.day_name()
-                heat_data['hour'] = heat_data[dt_col].dt.hour
-            else:
-                heat_data['day_of_week'] = 'Unknown'
-                heat_data['hour'] = 0
-        if 'count' not in heat_data.columns:
-            heat_data['count'] = 1
-        pivot = heat_data.pivot_table(index='hour', columns='day_of_week', values='count', fill_value=0)
-        sns.heatmap(pivot, annot=True, fmt='.0f', cmap='YlOrRd', ax=ax)
-        ax.set_title(f'{title_prefix} — Activity Heatmap ({date_str})', fontsize=16, fontweight='bold')
-        ax.set_xlabel('Day of Week')
-        ax.set_ylabel('Hour of Day')
-        save_fig(fig, '06_activity_heatmap.png')
-
-    if 'trends' in charts_data and not charts_data['trends'].empty:
-        fig, ax = plt.subplots(figsize=(12, 8))
-        t = charts_data['trends']
-        ax.plot(t['date'], t['count'], label='Daily Count', marker='o')
-        if 'rolling_avg' in t.columns:
-            ax.plot(t['date'], t['rolling_avg'], label='7-Day Rolling Average', color='red')
-        ax.legend()
-        ax.set_title(f'{title_prefix} — Trends Analysis ({date_str})', fontsize=16, fontweight='bold')
-        ax.set_xlabel('Date')
-        ax.set_ylabel('Number of Leads')
-        ax.grid(True, alpha=0.3)
-        save_fig(fig, '07_trends.png')
-
-    return pngs
+            sheet_name = 'All_Archived_Leads'
+            filename = f"All_Archived_Leads_{datetime.now().strftime('%Y%m%d')}.xlsx"
+            empty = 'No archived leads found.'
+        export_data = _archived_lead_rows(q.all())
+    if not export_data:
+        job.progress(1.0, empty)
+        return None
+    job.progress(1.0, f'{len(export_data)} archived leads exported')
+    return (filename, excel_bytes({sheet_name: pd.DataFrame(export_data)}),
+            'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet')
+
+@job_handler('archived_analytics_report', 'Archive analytics report')
+def archived_analytics_report_job(job, start, end, include_charts=True, include_summary=True, generated_by=None):
+    """Archived data for [start, end] with an executive summary and reason / archiver / daily breakdowns."""
+    with get_session() as db:
+        start_datetime = datetime.combine(start, datetime.min.time())
+        end_datetime = datetime.combine(end, datetime.max.time())
+        archived_in_period = db.query(Lead).filter(
+            LEAD_IS_ARCHIVED,
+            Lead.archived_at >= start_datetime,
+            Lead.archived_at <= end_datetime
+        ).all()
+        df_analytics = pd.DataFrame(_archived_lead_rows(archived_in_period))
+    if df_analytics.empty:
+        job.progress(1.0, 'No archived data found for the selected period.')
+        return None
+
+    # Create comprehensive analytics report
+    buffer = io.BytesIO()
+    with pd.ExcelWriter(buffer, engine='openpyxl') as writer:
+        df_analytics.to_excel(writer, sheet_name='Archived_Data', index=False)
+
+        if include_summary:
+            # Executive summary
+            summary_data = {
+                'Metric': [
+                    'Total Archives in Period',
+                    'Period Start',
+                    'Period End',
+                    'Most Common Archive Reason',
+                    'Most Active Archiver',
+                    'Average Archives per Day',
+                    'Peak Archive Day',
+                    'Report Generated By',
+                    'Report Generated On'
+                ],
+                'Value': [
+                    len(df_analytics),
+                    start,
+                    end,
+                    df_analytics['Archive Reason'].mode().iloc[0] if not df_analytics['Archive Reason'].mode().empty else 'N/A',
+                    df_analytics['Archived By'].mode().iloc[0] if not df_analytics['Archived By'].mode().empty else 'N/A',
+                    f"{len(df_analytics) / ((end_datetime - start_datetime).days + 1):.1f}",
+                    df_analytics['Archive Date'].mode().iloc[0] if not df_analytics['Archive Date'].mode().empty else 'N/A',
+                    generated_by,
+                    datetime.now().strftime('%Y-%m-%d %H:%M')
+                ]
+            }
+            pd.DataFrame(summary_data).to_excel(writer, sheet_name='Executive_Summary', index=False)
+
+        if include_charts:
+            # Archive reasons breakdown
+            reason_counts = df_analytics['Archive Reason'].value_counts().reset_index()
+            reason_counts.columns = ['Archive Reason', 'Count']
+            reason_counts.to_excel(writer, sheet_name='Archive_Reasons', index=False)
+
+            # Archive by agent
+            agent_counts = df_analytics['Archived By'].value_counts().reset_index()
+            agent_counts.columns = ['Archived By', 'Count']
+            agent_counts.to_excel(writer, sheet_name='Archive_by_Agent', index=False)
+
+            # Daily archive trends
+            df_analytics['Archive Date Only'] = pd.to_datetime(df_analytics['Archive Date']).dt.date
+            daily_counts = df_analytics['Archive Date Only'].value_counts().reset_index()
+            daily_counts.columns = ['Date', 'Archives']
+            daily_counts = daily_counts.sort_values('Date')
+            daily_counts.to_excel(writer, sheet_name='Daily_Trends', index=False)
+
+    job.progress(1.0, f'Analytics report generated with {len(df_analytics)} records')
+    return (f"Analytics_Report_{start}_{end}.xlsx", buffer.getvalue(),
+            'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet')
 
 # Layout by role
 if role == 'salesman':
@@ -1512,77 +3661,55 @@ if role == 'salesman':
             st.download_button('Download template.xlsx', data=buf.getvalue(), file_name='crm_leads_template.xlsx', mime='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet')
         if uploaded_file is not None:
             try:
-                if uploaded_file.name.endswith('.csv'):
-                    df = pd.read_csv(uploaded_file)
-                else:
-                    df = pd.read_excel(uploaded_file)
+                preview_df = read_lead_file_preview(uploaded_file)
             except Exception as e:
                 st.error(f'Failed to read file: {e}')
                 st.stop()
 
             st.subheader('Preview')
-            st.dataframe(df.head())
+            st.dataframe(preview_df)
 
         if not uploads_locked and st.button('Save to CRM'):
-            # map columns
-            col_map = {c.lower().strip(): c for c in df.columns}
-            mapping = {}
-            expected = ['number','name','sales agent','contact','case','feed back']
-            for k in expected:
-                if k in col_map:
-                    mapping[col_map[k]] = k
-            alt_map = {
-                'sales_agent':'sales agent','salesagent':'sales agent',
-                'feedback':'feed back','case_desc':'case',
-                'contact_number':'contact','phone':'contact',
-                'how to contact':'contact','how_to_contact':'contact','contact method':'contact'
-            }
-            for k,v in alt_map.items():
-                if k in col_map and v not in mapping.values():
-                    mapping[col_map[k]] = v
-            df_ren = df.rename(columns=mapping)
-            for tgt in ['number','name','sales agent','contact','case','feed back']:
-                if tgt not in df_ren.columns:
-                    df_ren[tgt] = None
-            leads = []
-            db = get_session()
-            for _, row in df_ren.iterrows():
-                lead = Lead(number=str(row['number']) if row['number'] is not None else None,
-                            name=str(row['name']) if row['name'] is not None else None,
-                            sales_agent=str(row['sales agent']) if row['sales agent'] is not None else current_user.username,
-                            contact=str(row['contact']) if row['contact'] is not None else None,
-                            case_desc=str(row['case']) if row['case'] is not None else None,
-                            feedback=str(row['feed back']) if row['feed back'] is not None else None,
-                            uploaded_by=current_user.username,
-                            uploaded_by_id=current_user.id,
-                            uploaded_at=datetime.utcnow())
-                db.add(lead)
-                db.flush()
-                log_activity(db, lead.id, current_user.username, 'upload', detail='Bulk upload')
-                leads.append(lead)
-            db.commit()
-            db.close()
-            st.success(f'Saved {len(leads)} leads')
+            if uploaded_file is None:
+                st.warning('Upload a file first')
+            else:
+                progress = st.empty()
+                try:
+                    with get_session() as db:
+                        saved = import_lead_file(db, uploaded_file, current_user.username, uploaded_by_id=current_user.id,
+                                                 default_agent=current_user.username, detail='Bulk upload',
+                                                 on_progress=lambda n: progress.write(f'Saved {n} leads so far...'))
+                except LeadImportError as e:
+                    progress.empty()
+                    st.error(str(e))
+                else:
+                    progress.empty()
+                    st.success(f'Saved {saved} leads')
 
         st.markdown('---')
         st.subheader('My Leads')
-        page = st.number_input('Page', min_value=1, value=1, key='leads_page')
         page_size = st.selectbox('Page size', [10,25,50], index=0, key='leads_page_size')
-        offset = (page-1)*page_size
-        df, total = read_leads_df(filters={'sales_agent': current_user.username}, limit=page_size, offset=offset)
+        my_filters = {'sales_agent': current_user.username}
+        cursor = page_cursor('my_leads', (current_user.username, page_size))
+        df, total = read_leads_df(filters=my_filters, limit=page_size, cursor=cursor, count='cached', columns='list')
         st.write(f'Total: {total}')
+        page_controls('my_leads', df)
         if not df.empty:
             # Prepare editable table
             contact_options = ['call', 'call and whatsapp', "didn't reach"]
             status_options = ['new','contacted','qualified','lost','won']
             case_options = ['general', 'pricing', 'technical', 'support', 'complaint', 'other']
             feedback_options = ['positive', 'neutral', 'negative', 'not interested', 'call later', 'wrong number', 'closed won', 'closed lost', 'other']
-            # pull sales users for dropdowns
-            with get_session() as _db:
-                sales_users = [u.username for u in _db.query(User).filter(User.role=='salesman').all()]
-            editable_cols = ['number','name','sales_agent','contact','case_desc','feedback','status','assigned_to','comment_text']
-            base_cols = ['id','number','name','sales_agent','contact','case_desc','feedback','status','assigned_to']
+            sales_users = usernames('salesman')
+            base_cols = ['id'] + LEAD_EDIT_COLUMNS
             present_cols = [c for c in base_cols if c in df.columns]
+            # The page as first shown, kept across reruns: saving only applies where the
+            # database still holds these values, so a colleague's edit in between isn't lost
+            page_ids = tuple(df['id'].tolist())
+            snapshot = st.session_state.get('my_leads_snapshot')
+            if snapshot is None or snapshot[0] != page_ids:
+                snapshot = (page_ids, df[present_cols].copy())
+                st.session_state['my_leads_snapshot'] = snapshot
             df_edit = df[present_cols].copy()
             # Ensure all expected columns exist in editor
             for c in base_cols:
@@ -1608,74 +3735,23 @@ if role == 'salesman':
                 key='leads_editor'
             )
             if st.button('Save table changes', key='save_table_changes'):
-                import pandas as _pd
-                db = get_session()
-                try:
-                    orig = df_edit.set_index('id')
-                    cur = edited.set_index('id', drop=False)
-                    # Updates for existing ids
-                    intersect_ids = [i for i in cur.index if _pd.notna(i)]
-                    for lead_id in intersect_ids:
-                        if lead_id not in orig.index:
-                            continue
-                        row_orig = orig.loc[lead_id]
-                        row_new = cur.loc[lead_id]
-                        changed = False
-                        lead = db.query(Lead).get(int(lead_id))
-                        for col in editable_cols:
-                            if col == 'comment_text':
-                                continue
-                            new_val = row_new[col]
-                            old_val = row_orig[col]
-                            if (isinstance(new_val, float) and _pd.isna(new_val)) or new_val == '':
-                                new_val = None
-                            if (isinstance(old_val, float) and _pd.isna(old_val)) or old_val == '':
-                                old_val = None
-                            if new_val != old_val:
-                                # Apply text normalization for text fields
-                                if col in ['name', 'number', 'contact', 'case_desc', 'feedback', 'status', 'assigned_to']:
-                                    new_val = normalize_arabic_text(new_val) if new_val else None
-                                setattr(lead, col if col != 'case_desc' else 'case_desc', new_val)
-                                changed = True
-                        if changed:
-                            db.add(lead)
-                            db.commit()
-                            log_activity(db, lead.id, current_user.username, 'edit', detail='Edited via table')
-                        # Add a comment if provided
-                        comment_text = (row_new.get('comment_text') or '').strip()
-                        if comment_text:
-                            com = Comment(lead_id=lead.id, author=current_user.username, text=normalize_arabic_text(comment_text))
-                            db.add(com)
-                            db.commit()
-                            log_activity(db, lead.id, current_user.username, 'comment', detail=comment_text)
-                    # Inserts for new rows (id is NaN)
-                    new_rows = edited[_pd.isna(edited['id'])]
-                    for _, r in new_rows.iterrows():
-                        lead = Lead(
-                            number=normalize_arabic_text(r.get('number')) if r.get('number') else None,
-                            name=normalize_arabic_text(r.get('name')) if r.get('name') else None,
-                            sales_agent=normalize_arabic_text(r.get('sales_agent')) if r.get('sales_agent') else current_user.username,
-                            contact=normalize_arabic_text(r.get('contact')) if r.get('contact') else None,
-                            case_desc=normalize_arabic_text(r.get('case_desc')) if r.get('case_desc') else None,
-                            feedback=normalize_arabic_text(r.get('feedback')) if r.get('feedback') else None,
-                            status=normalize_arabic_text(r.get('status')) if r.get('status') else 'new',
-                            assigned_to=normalize_arabic_text(r.get('assigned_to')) if r.get('assigned_to') else None,
-                            uploaded_by=current_user.username,
-                            uploaded_by_id=current_user.id,
-                            uploaded_at=datetime.utcnow()
-                        )
-                        db.add(lead)
-                        db.commit()
-                        log_activity(db, lead.id, current_user.username, 'create', detail='Added via table')
-                        comment_text = (r.get('comment_text') or '').strip()
-                        if comment_text:
-                            com = Comment(lead_id=lead.id, author=current_user.username, text=normalize_arabic_text(comment_text))
-                            db.add(com)
-                            db.commit()
-                            log_activity(db, lead.id, current_user.username, 'comment', detail=comment_text)
-                finally:
-                    db.close()
-                st.success('Changes saved')
+                with get_session() as db:
+                    saved = save_lead_edits(db, df_edit, edited, current_user.username, actor_id=current_user.id,
+                                            stored=snapshot[1])
+                # The next run snapshots the page again, so saving once more overwrites any conflicts
+                st.session_state.pop('my_leads_snapshot', None)
+                summary = f"{saved['updated']} edited, {saved['created']} added, {saved['comments']} comments"
+                if saved['conflicts']:
+                    st.warning(f"Saved {summary}. {len(saved['conflicts'])} leads were not saved: someone else "
+                               'changed them after you opened this page. Their current values are below; '
+                               'save again to overwrite them with your edits.')
+                    leads = Lead.__table__
+                    st.dataframe(pd.read_sql(
+                        sa.select(*[leads.c[c] for c in present_cols]).where(leads.c.id.in_(saved['conflicts'])),
+                        engine
+                    ), use_container_width=True)
+                else:
+                    st.success(f'Changes saved: {summary}')
         else:
             st.info('No leads yet')
 
@@ -1692,11 +3768,14 @@ if role == 'salesman':
                 else:
                     try:
                         screenshot_bytes = screenshot_file.read()
+                        store = get_blob_store()
+                        thumb = make_thumbnail(screenshot_bytes)
                         db = get_session()
                         deal = Deal(
                             customer_name=normalize_arabic_text(customer_name),
                             phone=normalize_arabic_text(phone),
-                            payment_screenshot=screenshot_bytes,
+                            screenshot_ref=store.put(screenshot_bytes),
+                            thumbnail_ref=store.put(thumb) if thumb else None,
                             uploaded_by=current_user.username,
                             uploaded_by_id=current_user.id,
                         )
@@ -1708,50 +3787,60 @@ if role == 'salesman':
                         st.error(f'Failed to save deal: {e}')
 
         st.subheader('My Deals')
-        # Simple list with preview and download
-        try:
-            db = get_session()
-            # Load only metadata first
-            deals = db.query(Deal).filter(Deal.uploaded_by==current_user.username).order_by(Deal.created_at.desc()).all()
-            for d in deals:
-                with st.expander(f"{d.created_at:%Y-%m-%d %H:%M} — {d.customer_name} ({d.phone})"):
+        # One page of metadata and small previews; full screenshots load on request
+        cursor = page_cursor('my_deals', current_user.username)
+        my_deals, my_deals_total = read_deals_df(filters={'uploaded_by': current_user.username},
+                                                 limit=DEALS_PAGE_SIZE, cursor=cursor, count='cached')
+        if my_deals.empty:
+            st.info('No deals yet')
+        else:
+            st.caption(f'{my_deals_total} deal(s)')
+            thumbs = deal_thumbnails(my_deals['id'])
+            for d in my_deals.itertuples():
+                created = f"{d.created_at:%Y-%m-%d %H:%M}" if pd.notna(d.created_at) else '—'
+                with st.expander(f"{created} — {d.customer_name} ({d.phone})"):
                     st.write(f"Salesman: {d.uploaded_by}")
-                    # Display image if possible
-                    try:
-                        st.image(d.payment_screenshot, caption='Payment screenshot', use_container_width=True)
-                    except Exception:
-                        st.download_button('Download screenshot', data=d.payment_screenshot, file_name=f'deal_{d.id}_payment.png')
-
-            # Downloads: Excel with embedded images (if supported) and ZIP of images
-            if deals:
-                excel_bytes = build_deals_excel_with_images(deals)
-                if excel_bytes:
-                    st.download_button('Download my deals (Excel with images)', data=excel_bytes, file_name='my_deals_with_images.xlsx', mime='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet')
-                zip_bytes = build_deals_images_zip(deals)
-                st.download_button('Download my deal screenshots (ZIP)', data=zip_bytes, file_name='my_deal_screenshots.zip', mime='application/zip')
-        finally:
-            try:
-                db.close()
-            except Exception:
-                pass
+                    if d.id in thumbs:
+                        st.image(thumbs[d.id], caption='Payment screenshot (preview)')
+                    show_key = f'deal_full_{d.id}'
+                    if not st.session_state.get(show_key):
+                        if st.button('🔍 Load full screenshot', key=f'{show_key}_btn'):
+                            st.session_state[show_key] = True
+                            st.rerun()
+                    else:
+                        screenshot = load_deal_screenshot(d.id)
+                        if screenshot:
+                            try:
+                                st.image(screenshot, caption='Payment screenshot', use_container_width=True)
+                            except Exception:
+                                pass
+                            st.download_button('Download screenshot', data=screenshot, file_name=f'deal_{d.id}_payment.png',
+                                               key=f'deal_dl_{d.id}')
+                        else:
+                            st.warning('Screenshot not available')
+            page_controls('my_deals', my_deals)
+
+            # Downloads: Excel with embedded images (if supported) and ZIP of images, built as background jobs
+            if st.button('📦 Prepare my deals downloads'):
+                start_job('deals_excel_images', current_user.username, file_name='my_deals_with_images.xlsx', uploaded_by=current_user.username)
+                start_job('deals_images_zip', current_user.username, file_name='my_deal_screenshots.zip', uploaded_by=current_user.username)
 
 elif role == 'head_of_sales':
     st.header('Head of Sales — Overview')
-    db = get_session()
-    agents = [r[0] for r in db.query(Lead.sales_agent).distinct().all() if r[0]]
-    db.close()
+    agents = [a for a in lead_filter_options()['agents'] if a]
     sel_agent = st.selectbox('Filter by agent', options=['All'] + agents)
     sel_status = st.selectbox('Filter by status', options=['All','new','contacted','qualified','lost','won'])
-    search = st.text_input('Search (name, number, contact)')
-    page = st.number_input('Page', min_value=1, value=1)
+    search = st.text_input('Search (name, number, contact, case, feedback)')
     page_size = st.selectbox('Page size', [10,25,50], index=1)
-    offset = (page-1)*page_size
     filters = {}
     if sel_agent: filters['sales_agent'] = sel_agent
     if sel_status: filters['status'] = sel_status
-    df, total = read_leads_df(filters=filters, search=search, limit=page_size, offset=offset)
+    cursor = page_cursor('hos_leads', (sel_agent, sel_status, search, page_size))
+    df, total = read_leads_df(filters=filters, search=search, order_by='relevance', limit=page_size,
+                              cursor=cursor, count='cached', columns='list')
     st.write(f'Total matches: {total}')
     st.dataframe(df)
+    page_controls('hos_leads', df)
     if not df.empty:
         # quick KPIs
         st.subheader('KPIs')
@@ -1792,8 +3881,7 @@ elif role == 'cto':
     # --- CTO uploader (centralized uploads) ---
     with st.expander('Upload Leads (CTO)'):
         # Salesmen list for default assignment
-        with get_session() as _db_cto_sales:
-            cto_salesmen = [u.username for u in _db_cto_sales.query(User).filter(User.role=='salesman').order_by(User.username.asc()).all()]
+        cto_salesmen = usernames('salesman')
         default_agent_opt = ['(keep from file)'] + cto_salesmen
         default_agent = st.selectbox('Default sales agent (optional)', options=default_agent_opt)
         cto_uploaded = st.file_uploader('XLSX/CSV with headers: number, name, sales agent, CONTACT, CASE, FEED BACK', type=['xlsx','xls','csv'], key='cto_uploader')
@@ -1815,61 +3903,29 @@ elif role == 'cto':
                 st.download_button('Download CTO template.xlsx', data=buf_t.getvalue(), file_name='crm_leads_template_cto.xlsx', mime='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet')
         if cto_uploaded is not None:
             try:
-                if cto_uploaded.name.endswith('.csv'):
-                    cto_df = pd.read_csv(cto_uploaded)
-                else:
-                    cto_df = pd.read_excel(cto_uploaded)
+                cto_preview = read_lead_file_preview(cto_uploaded)
             except Exception as e:
                 st.error(f'Failed to read file: {e}')
-                cto_df = None
-            if cto_df is not None:
-                st.dataframe(cto_df.head())
+                cto_preview = None
+            if cto_preview is not None:
+                st.dataframe(cto_preview)
                 if st.button('Save uploaded leads (CTO)'):
-                    col_map = {c.lower().strip(): c for c in cto_df.columns}
-                    mapping = {}
-                    expected = ['number','name','sales agent','contact','case','feed back']
-                    for k in expected:
-                        if k in col_map:
-                            mapping[col_map[k]] = k
-                    alt_map = {
-                        'sales_agent':'sales agent','salesagent':'sales agent',
-                        'feedback':'feed back','case_desc':'case',
-                        'contact_number':'contact','phone':'contact',
-                        'how to contact':'contact','how_to_contact':'contact','contact method':'contact'
-                    }
-                    for k,v in alt_map.items():
-                        if k in col_map and v not in mapping.values():
-                            mapping[col_map[k]] = v
-                    df_ren = cto_df.rename(columns=mapping)
-                    for tgt in ['number','name','sales agent','contact','case','feed back']:
-                        if tgt not in df_ren.columns:
-                            df_ren[tgt] = None
-                    saved = 0
-                    with get_session() as db:
-                        for _, row in df_ren.iterrows():
-                            agent_from_file = str(row['sales agent']) if row['sales agent'] is not None else None
-                            final_agent = agent_from_file
-                            if (not final_agent or final_agent.strip()=='') and default_agent != '(keep from file)':
-                                final_agent = default_agent
-                            lead = Lead(
-                                number=str(row['number']) if row['number'] is not None else None,
-                                name=str(row['name']) if row['name'] is not None else None,
-                                sales_agent=str(final_agent) if final_agent else None,
-                                contact=str(row['contact']) if row['contact'] is not None else None,
-                                case_desc=str(row['case']) if row['case'] is not None else None,
-                                feedback=str(row['feed back']) if row['feed back'] is not None else None,
-                                uploaded_by=current_user.username,
+                    progress = st.empty()
+                    try:
+                        with get_session() as db:
+                            saved = import_lead_file(
+                                db, cto_uploaded, current_user.username,
                                 uploaded_by_id=getattr(current_user, 'id', None),
-                                uploaded_at=datetime.utcnow(),
-                                assigned_to=str(final_agent) if final_agent else None,
+                                default_agent=None if default_agent == '(keep from file)' else default_agent,
+                                assign=True, detail='CTO upload',
+                                on_progress=lambda n: progress.write(f'Saved {n} leads so far...')
                             )
-                            db.add(lead)
-                            db.flush()
-                            log_activity(db, lead.id, current_user.username, 'upload', detail='CTO upload')
-                            saved += 1
-                        db.commit()
-                    st.success(f'Saved {saved} leads')
-                    st.rerun()
+                    except LeadImportError as e:
+                        progress.empty()
+                        st.error(str(e))
+                    else:
+                        st.success(f'Saved {saved} leads')
+                        st.rerun()
 
     # --- CTO Add New Leads Manually ---
     with st.expander('Add New Leads Manually (CTO)'):
@@ -1884,11 +3940,11 @@ elif role == 'cto':
                 new_lead_case = st.text_area('Case Description', placeholder='Describe the case or inquiry')
             with col2:
                 new_lead_agent = st.selectbox('Sales Agent', 
-                                            options=[''] + [u.username for u in get_session().query(User).filter(User.role=='salesman').order_by(User.username.asc()).all()])
+                                            options=[''] + usernames('salesman'))
                 new_lead_status = st.selectbox('Status', options=['new', 'contacted', 'qualified', 'lost', 'won'])
                 new_lead_feedback = st.text_area('Feedback', placeholder='Any feedback or notes')
                 new_lead_assigned = st.selectbox('Assigned To', 
-                                               options=[''] + [u.username for u in get_session().query(User).filter(User.role=='salesman').order_by(User.username.asc()).all()])
+                                               options=[''] + usernames('salesman'))
             
             if st.form_submit_button('➕ Add New Lead'):
                 if new_lead_name and new_lead_agent:
@@ -1907,22 +3963,23 @@ elif role == 'cto':
                             uploaded_at=datetime.utcnow()
                         )
                         db.add(new_lead)
-                        db.commit()
+                        db.flush()
                         log_activity(db, new_lead.id, current_user.username, 'create', detail='CTO manual lead creation')
+                        db.commit()
                         st.success(f'✅ Lead "{new_lead_name}" added successfully!')
                         st.rerun()
                 else:
                     st.error('❌ Please provide at least Lead Name and Sales Agent')
 
-    df_all, total = read_leads_df(limit=10000, offset=0)
-    if df_all.empty:
+    lead_options = lead_filter_options()
+    if lead_options['first_date'] is None:
         st.info('No data yet. Upload leads (Sales tab) or generate demo leads below.')
         with st.expander('Demo tools (dev)'):
             n = st.number_input('How many demo leads to generate?', min_value=10, max_value=2000, value=200, step=10)
             if st.button('Generate demo leads'):
                 try:
                     with get_session() as db:
-                        sales_users = [u.username for u in db.query(User).filter(User.role=='salesman').all()]
+                        sales_users = usernames('salesman')
                         if not sales_users:
                             u = create_user(db, 'sales_auto', 'pass', role='salesman', name='Sales Auto')
                             sales_users = [u.username]
@@ -1952,58 +4009,26 @@ elif role == 'cto':
                 except Exception as e:
                     st.error(f'Failed to generate demo leads: {e}')
     else:
-        # Helpers for categorical charts
-        def _normalize_text(value: str):
-            if value is None:
-                return None
-            try:
-                text = str(value).strip().lower()
-            except Exception:
-                return None
-            if text in {'', 'na', 'n/a', 'none', 'null', '-'}:
-                return None
-            return text
-
-        def _plot_top_categories(df: pd.DataFrame, column: str, title: str, top_n: int = 20):
-            series = df[column].dropna().astype(str).map(_normalize_text).dropna()
-            if series.empty:
-                st.info(f'No values in {column} to plot.')
-                return
-            counts = series.value_counts().head(top_n).reset_index()
-            counts.columns = [column, 'count']
-            fig_local = px.bar(counts, x=column, y='count', title=title)
-            st.plotly_chart(fig_local, use_container_width=True)
-
-        df_all['uploaded_at'] = pd.to_datetime(df_all['uploaded_at'])
-        df_all['date'] = df_all['uploaded_at'].dt.date
-
         # Filters
-        min_date = df_all['date'].min()
-        max_date = df_all['date'].max()
+        min_date = lead_options['first_date']
+        max_date = lead_options['last_date']
         c_f1, c_f2, c_f3 = st.columns([2,2,3])
         with c_f1:
             date_range = st.date_input('Date range', value=(min_date, max_date))
         with c_f2:
-            agents_all = sorted([a for a in df_all['sales_agent'].dropna().unique().tolist()])
+            agents_all = lead_options['agents']
             sel_agents = st.multiselect('Agents', options=agents_all, default=agents_all)
         with c_f3:
-            status_all = ['new','contacted','qualified','won','lost']
+            status_all = FUNNEL_STATUSES
             sel_statuses = st.multiselect('Statuses', options=status_all, default=status_all)
 
-        # Apply filters
-        df_f = df_all.copy()
+        # Charts are aggregated in SQL; full rows are only loaded by the exports below
+        dash_filters = {'agents': sel_agents, 'statuses': sel_statuses}
         if isinstance(date_range, (list, tuple)) and len(date_range) == 2:
-            start_d, end_d = pd.to_datetime(date_range[0]), pd.to_datetime(date_range[1])
-            df_f = df_f[(df_f['uploaded_at'] >= start_d) & (df_f['uploaded_at'] <= (end_d + pd.Timedelta(days=1)))]
-        if sel_agents:
-            df_f = df_f[df_f['sales_agent'].isin(sel_agents)]
-        if sel_statuses:
-            df_f = df_f[df_f['status'].isin(sel_statuses)]
-
-        st.subheader('Leads over time')
-        daily = df_f.groupby('date').size().reset_index(name='count')
-        fig = px.line(daily, x='date', y='count', title='Leads per day')
-        st.plotly_chart(fig, use_container_width=True)
+            dash_filters['start'], dash_filters['end'] = date_range
+        frames = lead_dashboard_frames(dash_filters)
+
+        show_lead_chart(frames, 'daily_leads')
 
         # Lead Assignment (CTO)
         st.markdown('---')
@@ -2024,59 +4049,39 @@ elif role == 'cto':
                 _db_lock2.commit()
             st.success('Upload lock setting updated')
         with get_session() as _db_assign:
-            # consider unassigned as sales_agent is null/empty/'unassigned' OR assigned_to is null
-            unassigned = (
-                _db_assign.query(Lead)
-                .filter(
-                    sa.or_(
-                        Lead.sales_agent.is_(None),
-                        func.trim(Lead.sales_agent) == '',
-                        func.lower(func.trim(Lead.sales_agent)) == 'unassigned',
-                        Lead.assigned_to.is_(None)
-                    )
-                )
-                .order_by(Lead.uploaded_at.desc())
-                .all()
-            )
-            st.write(f"Unassigned leads: {len(unassigned)}")
-        with get_session() as _db_users:
-            salesman_users = [u.username for u in _db_users.query(User).filter(User.role == 'salesman').order_by(User.username.asc()).all()]
+            unassigned_count = _db_assign.query(func.count(Lead.id)).filter(LEAD_IS_UNASSIGNED).scalar()
+            st.write(f"Unassigned leads: {unassigned_count}")
+        salesman_users = usernames('salesman')
         target_agents = st.multiselect('Select salesmen to distribute to', options=salesman_users, default=salesman_users)
         max_to_assign = st.number_input('Max leads to distribute (0 = all)', min_value=0, value=0, step=1)
-        if st.button('Distribute unassigned leads equally'):
+        dist_strategy = st.selectbox('Distribution strategy', options=list(DISTRIBUTION_STRATEGIES),
+                                     format_func=DISTRIBUTION_STRATEGIES.get, key='dist_strategy')
+        dist_weights, dist_capacity = None, None
+        if dist_strategy == 'weighted' and target_agents:
+            weight_cols = st.columns(min(len(target_agents), 4))
+            dist_weights = {
+                a: weight_cols[i % len(weight_cols)].number_input(f'Weight: {a}', min_value=0.0, value=1.0, step=0.5, key=f'dist_weight_{a}')
+                for i, a in enumerate(target_agents)
+            }
+        elif dist_strategy == 'capacity':
+            dist_capacity = st.number_input('Max open leads per salesman', min_value=1, value=200, step=10, key='dist_capacity')
+        if dist_strategy in ('capacity', 'least_loaded') and target_agents:
+            with get_session() as _db_loads:
+                st.caption('Open leads now: ' + ', '.join(f'{a}: {n}' for a, n in agent_open_loads(_db_loads, target_agents).items()))
+        if st.button('Distribute unassigned leads'):
             if not target_agents:
                 st.warning('Select at least one salesman.')
+            elif not unassigned_count:
+                st.info('No unassigned leads to distribute.')
             else:
-                with get_session() as db:
-                    leads = (
-                        db.query(Lead)
-                        .filter(
-                            sa.or_(
-                                Lead.sales_agent.is_(None),
-                                func.trim(Lead.sales_agent) == '',
-                                func.lower(func.trim(Lead.sales_agent)) == 'unassigned',
-                                Lead.assigned_to.is_(None)
-                            )
-                        )
-                        .order_by(Lead.uploaded_at.asc())
-                        .all()
-                    )
-                    if max_to_assign and max_to_assign > 0:
-                        leads = leads[:max_to_assign]
-                    if not leads:
-                        st.info('No unassigned leads to distribute.')
-                    else:
-                        random.shuffle(leads)
-                        assigned_count = {a: 0 for a in target_agents}
-                        for idx, lead in enumerate(leads):
-                            agent = target_agents[idx % len(target_agents)]
-                            lead.sales_agent = agent
-                            lead.assigned_to = agent
-                            db.add(lead)
-                            db.flush()
-                            log_activity(db, lead.id, current_user.username, 'assign', detail=f'Assigned to {agent} by CTO')
-                            assigned_count[agent] += 1
-                        db.commit()
+                try:
+                    assigned_count = run_distribution(target_agents, current_user.username, expected=unassigned_count,
+                                                      limit=max_to_assign, strategy=dist_strategy,
+                                                      weights=dist_weights, capacity=dist_capacity)
+                except ValueError as e:
+                    st.error(str(e))
+                else:
+                    if assigned_count is not None:
                         st.success('Distribution completed: ' + ', '.join([f"{a}: {n}" for a, n in assigned_count.items()]))
                         st.rerun()
 
@@ -2091,11 +4096,7 @@ elif role == 'cto':
                     db.commit()
                 st.success('Statuses randomized. Refresh charts above.')
 
-        st.subheader('Leads by agent')
-        agent_counts = df_f['sales_agent'].value_counts().reset_index()
-        agent_counts.columns = ['sales_agent','count']
-        fig2 = px.bar(agent_counts, x='sales_agent', y='count', title='Leads by Agent')
-        st.plotly_chart(fig2, use_container_width=True)
+        show_lead_chart(frames, 'agent_breakdown')
 
         # Login events (visibility for CTO)
         st.markdown('---')
@@ -2109,122 +4110,36 @@ elif role == 'cto':
                         {
                             'username': e.username,
                             'role': e.role,
-                            'logged_in_at': e.logged_in_at
-                        } for e in logins
-                    ])
-                    st.dataframe(df_login)
-                    agg = df_login.groupby('username').size().reset_index(name='logins')
-                    fig_login = px.bar(agg, x='username', y='logins', title='Logins per user (7 days)')
-                    st.plotly_chart(fig_login, use_container_width=True)
-                else:
-                    st.info('No login events yet.')
-        except Exception:
-            st.info('Login activity not available yet.')
-
-        st.subheader('Status breakdown')
-        status_counts = df_f['status'].value_counts().reset_index()
-        status_counts.columns = ['status','count']
-        fig3 = px.pie(status_counts, names='status', values='count', title='Leads by Status')
-        st.plotly_chart(fig3, use_container_width=True)
-
-        # Leads by status per salesman (stacked)
-        st.subheader('Leads by Status per Salesman')
-        status_per_sales = (
-            df_f.dropna(subset=['sales_agent','status'])
-                  .groupby(['sales_agent','status'])
-                  .size()
-                  .reset_index(name='count')
-        )
-        if not status_per_sales.empty:
-            fig_status_sales = px.bar(
-                status_per_sales,
-                x='sales_agent', y='count', color='status',
-                barmode='stack', title='Leads by Status per Salesman'
-            )
-            st.plotly_chart(fig_status_sales, use_container_width=True)
-        else:
-            st.info('No data for status per salesman yet.')
-
-        st.subheader('Feedback word cloud-ish (top words)')
-        feedbacks = df_f['feedback'].dropna().astype(str)
-        if not feedbacks.empty:
-            all_text = ' '.join(feedbacks.tolist()).lower()
-            words = [w.strip('.,!?:;()"\'') for w in all_text.split() if len(w) > 3]
-            if words:
-                wc = pd.Series(words).value_counts().head(30).reset_index()
-                wc.columns = ['word','count']
-                fig4 = px.bar(wc, x='word', y='count', title='Top feedback words')
-                st.plotly_chart(fig4, use_container_width=True)
-            else:
-                st.info('No keywords found in feedback yet.')
-        else:
-            st.info('No feedback text yet to analyze.')
-
-        st.subheader('HOW TO CONTACT — top categories')
-        try:
-            _plot_top_categories(df_f, 'contact', 'Contact method — top categories')
-        except Exception:
-            st.info('No values in contact to plot.')
-
-        st.subheader('CASE — top categories')
-        try:
-            _plot_top_categories(df_f, 'case_desc', 'Case — top categories')
-        except Exception:
-            st.info('No values in case_desc to plot.')
-
-        st.subheader('FEED BACK — top categories')
-        try:
-            _plot_top_categories(df_f, 'feedback', 'Feedback — top categories')
-        except Exception:
-            st.info('No values in feedback to plot.')
-
-        # Additional charts
-        st.subheader('Sales Pipeline — Funnel')
-        try:
-            ordered_status = ['new','contacted','qualified','won','lost']
-            counts_map = {s: int((df_f['status'] == s).sum()) for s in ordered_status}
-            funnel_df = pd.DataFrame({'status': list(counts_map.keys()), 'count': list(counts_map.values())})
-            fig_funnel = px.funnel(funnel_df, x='count', y='status', title='Lead Funnel')
-            st.plotly_chart(fig_funnel, use_container_width=True)
+                            'logged_in_at': e.logged_in_at
+                        } for e in logins
+                    ])
+                    st.dataframe(df_login)
+                    agg = df_login.groupby('username').size().reset_index(name='logins')
+                    fig_login = px.bar(agg, x='username', y='logins', title='Logins per user (7 days)')
+                    st.plotly_chart(fig_login, use_container_width=True)
+                else:
+                    st.info('No login events yet.')
         except Exception:
-            pass
+            st.info('Login activity not available yet.')
 
-        st.subheader('Contact method by agent')
-        cm = df_f.dropna(subset=['sales_agent','contact'])
-        if not cm.empty:
-            cm_counts = cm.groupby(['sales_agent','contact']).size().reset_index(name='count')
-            fig_cm = px.bar(cm_counts, x='sales_agent', y='count', color='contact', barmode='stack', title='Contact methods by agent')
-            st.plotly_chart(fig_cm, use_container_width=True)
-
-        st.subheader('Lead uploads heatmap (weekday x hour)')
-        if not df_f.empty:
-            tmp = df_f.copy()
-            tmp['weekday'] = tmp['uploaded_at'].dt.day_name()
-            tmp['hour'] = tmp['uploaded_at'].dt.hour
-            heat = tmp.groupby(['weekday','hour']).size().reset_index(name='count')
-            if not heat.empty:
-                fig_heat = px.density_heatmap(heat, x='hour', y='weekday', z='count', histfunc='avg', title='Uploads heatmap')
-                st.plotly_chart(fig_heat, use_container_width=True)
-
-        st.subheader('Leads per day (7-day rolling avg)')
-        if not daily.empty:
-            daily_ra = daily.sort_values('date').copy()
-            daily_ra['rolling_7d'] = daily_ra['count'].rolling(window=7, min_periods=1).mean()
-            fig_ra = px.line(daily_ra, x='date', y=['count','rolling_7d'], labels={'value':'leads','variable':'series'}, title='Daily leads and 7d avg')
-            st.plotly_chart(fig_ra, use_container_width=True)
+        for chart in ['status_breakdown', 'status_per_agent', 'feedback_words', 'top_contact', 'top_case_desc',
+                      'top_feedback', 'sales_funnel', 'contact_methods', 'activity_heatmap', 'trends']:
+            show_lead_chart(frames, chart)
 
         st.subheader('Export filtered leads')
         
         # Basic exports (without comments)
-        col1, col2 = st.columns(2)
-        with col1:
-            csv_bytes = df_f.to_csv(index=False).encode('utf-8')
-            st.download_button('Download CSV (filtered)', data=csv_bytes, file_name='leads_filtered.csv', mime='text/csv')
-        with col2:
-            xls_buf = io.BytesIO()
-            with pd.ExcelWriter(xls_buf, engine='openpyxl') as writer:
-                df_f.to_excel(writer, index=False, sheet_name='leads_filtered')
-            st.download_button('Download Excel (filtered)', data=xls_buf.getvalue(), file_name='leads_filtered.xlsx', mime='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet')
+        if st.button('📄 Prepare CSV / Excel (filtered)'):
+            df_f = read_dashboard_leads_df(dash_filters)
+            col1, col2 = st.columns(2)
+            with col1:
+                csv_bytes = df_f.to_csv(index=False).encode('utf-8')
+                st.download_button('Download CSV (filtered)', data=csv_bytes, file_name='leads_filtered.csv', mime='text/csv')
+            with col2:
+                xls_buf = io.BytesIO()
+                with pd.ExcelWriter(xls_buf, engine='openpyxl') as writer:
+                    df_f.to_excel(writer, index=False, sheet_name='leads_filtered')
+                st.download_button('Download Excel (filtered)', data=xls_buf.getvalue(), file_name='leads_filtered.xlsx', mime='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet')
         
         # Enhanced export with comments
         st.markdown('---')
@@ -2232,6 +4147,7 @@ elif role == 'cto':
         
         if st.button('📊 Generate Enhanced Export Package'):
             try:
+                df_f = read_dashboard_leads_df(dash_filters)
                 # Get comments and activities for filtered leads
                 with get_session() as db:
                     lead_ids = df_f['id'].tolist()
@@ -2250,21 +4166,13 @@ elif role == 'cto':
                         })
                     activities_df = pd.DataFrame(activities_data)
                 
-                # Create enhanced Excel with multiple sheets
-                enhanced_buffer = io.BytesIO()
-                with pd.ExcelWriter(enhanced_buffer, engine='openpyxl') as writer:
-                    # Main leads data
-                    df_f.to_excel(writer, sheet_name='Filtered_Leads', index=False)
-                    
-                    # Comments data
+                def export_entries():
+                    # Enhanced Excel with multiple sheets: leads, comments, activities, summary
+                    sheets = {'Filtered_Leads': df_f}
                     if not comments_df.empty:
-                        comments_df.to_excel(writer, sheet_name='Lead_Comments', index=False)
-                    
-                    # Activities data
+                        sheets['Lead_Comments'] = comments_df
                     if not activities_df.empty:
-                        activities_df.to_excel(writer, sheet_name='Lead_Activities', index=False)
-                    
-                    # Summary sheet
+                        sheets['Lead_Activities'] = activities_df
                     summary_data = {
                         'Metric': ['Total Filtered Leads', 'Leads with Comments', 'Leads with Activities', 'Total Comments', 'Total Activities', 'Export Date'],
                         'Value': [
@@ -2276,20 +4184,15 @@ elif role == 'cto':
                             datetime.now().strftime('%Y-%m-%d %H:%M')
                         ]
                     }
-                    pd.DataFrame(summary_data).to_excel(writer, sheet_name='Export_Summary', index=False)
-                
-                # Create ZIP file with enhanced data
-                zip_buffer = io.BytesIO()
-                with zipfile.ZipFile(zip_buffer, 'w', zipfile.ZIP_DEFLATED) as zip_file:
-                    # Add enhanced Excel file
-                    zip_file.writestr('Enhanced_Leads_Export.xlsx', enhanced_buffer.getvalue())
+                    sheets['Export_Summary'] = pd.DataFrame(summary_data)
+                    yield 'Enhanced_Leads_Export.xlsx', excel_bytes(sheets)
                     
                     # Add individual CSV files
-                    zip_file.writestr('leads_filtered.csv', df_f.to_csv(index=False))
+                    yield 'leads_filtered.csv', df_f.to_csv(index=False)
                     if not comments_df.empty:
-                        zip_file.writestr('lead_comments.csv', comments_df.to_csv(index=False))
+                        yield 'lead_comments.csv', comments_df.to_csv(index=False)
                     if not activities_df.empty:
-                        zip_file.writestr('lead_activities.csv', activities_df.to_csv(index=False))
+                        yield 'lead_activities.csv', activities_df.to_csv(index=False)
                     
                     # Add README
                     readme_content = f"""Enhanced Leads Export Package
@@ -2317,15 +4220,16 @@ Export Summary:a
 
 This package provides complete visibility into leads, including all associated comments and activity history.
 """
-                    zip_file.writestr('README.txt', readme_content)
+                    yield 'README.txt', readme_content
                 
                 # Download button for enhanced package
-                st.download_button(
-                    label='📥 Download Enhanced Export Package (ZIP)',
-                    data=zip_buffer.getvalue(),
-                    file_name=f'Enhanced_Leads_Export_{datetime.now().strftime("%Y%m%d_%H%M")}.zip',
-                    mime='application/zip'
-                )
+                with write_zip(export_entries()) as archive:
+                    st.download_button(
+                        label='📥 Download Enhanced Export Package (ZIP)',
+                        data=archive.read(),
+                        file_name=f'Enhanced_Leads_Export_{datetime.now().strftime("%Y%m%d_%H%M")}.zip',
+                        mime='application/zip'
+                    )
                 st.success('✅ Enhanced export package ready! Includes comments and activities.')
                 
             except Exception as e:
@@ -2335,207 +4239,24 @@ This package provides complete visibility into leads, including all associated c
         st.markdown('---')
         st.subheader('📦 Download Complete Analytics Package')
         
-        from datetime import datetime
-        import zipfile
-        
-        # Generate filename with current day and date
-        now = datetime.now()
-        day_name = now.strftime('%A')  # Full day name (e.g., 'Monday')
-        date_str = now.strftime('%Y-%m-%d')  # Date format (e.g., '2024-08-09')
-        zip_filename = f"CTO_Analytics_{day_name}_{date_str}.zip"
-        
         if st.button('📊 Generate & Download CTO Analytics Package'):
-            try:
-                # Create ZIP file in memory
-                zip_buffer = io.BytesIO()
-                
-                with zipfile.ZipFile(zip_buffer, 'w', zipfile.ZIP_DEFLATED) as zip_file:
-                    # Add all chart data as Excel sheets
-                    excel_buffer = io.BytesIO()
-                    with pd.ExcelWriter(excel_buffer, engine='openpyxl') as writer:
-                        # Main filtered data
-                        df_f.to_excel(writer, sheet_name='Filtered_Leads', index=False)
-                        
-                        # Get comments and activities for filtered leads
-                        with get_session() as db:
-                            lead_ids = df_f['id'].tolist()
-                            comments_df = get_comments_for_leads(db, lead_ids)
-                            
-                            # Get activities for filtered leads
-                            activities = db.query(Activity).filter(Activity.lead_id.in_(lead_ids)).all()
-                            activities_data = []
-                            for activity in activities:
-                                activities_data.append({
-                                    'lead_id': activity.lead_id,
-                                    'activity_actor': activity.actor,
-                                    'activity_action': activity.action,
-                                    'activity_detail': activity.detail,
-                                    'activity_timestamp': activity.timestamp
-                                })
-                            activities_df = pd.DataFrame(activities_data)
-                        
-                        # Comments and Activities data
-                        if not comments_df.empty:
-                            comments_df.to_excel(writer, sheet_name='Lead_Comments', index=False)
-                        if not activities_df.empty:
-                            activities_df.to_excel(writer, sheet_name='Lead_Activities', index=False)
-                        
-                        # Chart data from all the charts above
-                        charts_data = {}
-                        
-                        # Daily leads
-                        if not daily.empty:
-                            daily.to_excel(writer, sheet_name='Daily_Leads', index=False)
-                            charts_data['daily_leads'] = daily
-                        
-                        # Agent breakdown
-                        if not agent_counts.empty:
-                            agent_counts.to_excel(writer, sheet_name='Agent_Breakdown', index=False)
-                            charts_data['agent_breakdown'] = agent_counts
-                        
-                        # Status breakdown
-                        if not status_counts.empty:
-                            status_counts.to_excel(writer, sheet_name='Status_Breakdown', index=False)
-                            charts_data['status_breakdown'] = status_counts
-                        
-                        # Sales funnel
-                        if 'funnel_df' in locals():
-                            funnel_df.to_excel(writer, sheet_name='Sales_Funnel', index=False)
-                            charts_data['sales_funnel'] = funnel_df
-                        
-                        # Contact methods
-                        if 'cm_counts' in locals() and not cm_counts.empty:
-                            cm_counts.to_excel(writer, sheet_name='Contact_Methods', index=False)
-                            charts_data['contact_methods'] = cm_counts
-                        
-                        # Activity heatmap
-                        if 'heat' in locals() and not heat.empty:
-                            heat.to_excel(writer, sheet_name='Activity_Heatmap', index=False)
-                            charts_data['activity_heatmap'] = heat
-                        
-                        # Trends analysis
-                        if 'daily_ra' in locals():
-                            daily_ra.to_excel(writer, sheet_name='Trends_Analysis', index=False)
-                            charts_data['trends'] = daily_ra
-                        
-                        # Enhanced CTO Summary statistics
-                        summary_data = {
-                            'Metric': ['Total Leads', 'Filtered Leads', 'Active Agents', 'Date Range', 'Leads with Comments', 'Leads with Activities', 'Total Comments', 'Total Activities', 'Generated By'],
-                            'Value': [
-                                len(df_all),
-                                len(df_f),
-                                len(agent_counts) if 'agent_breakdown' in charts_data else 0,
-                                f"{date_range[0] if isinstance(date_range, (list, tuple)) else 'All'} to {date_range[1] if isinstance(date_range, (list, tuple)) else 'All'}",
-                                len(comments_df['lead_id'].unique()) if not comments_df.empty else 0,
-                                len(activities_df['lead_id'].unique()) if not activities_df.empty else 0,
-                                len(comments_df) if not comments_df.empty else 0,
-                                len(activities_df) if not activities_df.empty else 0,
-                                'CTO Dashboard'
-                            ]
-                        }
-                        pd.DataFrame(summary_data).to_excel(writer, sheet_name='CTO_Summary', index=False)
-                    
-                    # Add Excel file to ZIP
-                    zip_file.writestr(f'CTO_Analytics_{date_str}.xlsx', excel_buffer.getvalue())
-                    
-                    # Generate and add PNG graphs (instead of PDF)
-                    png_graphs = generate_analytics_pngs(df_f, charts_data, date_str, "CTO Analytics")
-                    for filename, content in png_graphs.items():
-                        zip_file.writestr(f'graphs_png/{filename}', content)
-                    
-                    # Generate and add interactive HTML graphs
-                    html_graphs = generate_plotly_graphs(df_f, charts_data, date_str, "CTO Analytics")
-                    for filename, html_content in html_graphs.items():
-                        zip_file.writestr(f'graphs/{filename}', html_content)
-                    
-                    # Add deals data if available
-                    deals_df, _ = read_deals_df(limit=100000)
-                    if not deals_df.empty:
-                        deals_buffer = io.BytesIO()
-                        with pd.ExcelWriter(deals_buffer, engine='openpyxl') as deals_writer:
-                            deals_df.to_excel(deals_writer, sheet_name='All_Deals', index=False)
-                            
-                            # Deals summary
-                            deals_summary = deals_df.groupby('uploaded_by').size().reset_index(name='deals_count')
-                            deals_summary.to_excel(deals_writer, sheet_name='Deals_by_Agent', index=False)
-                        
-                        zip_file.writestr(f'CTO_Deals_Report_{date_str}.xlsx', deals_buffer.getvalue())
-                    
-                    # Add a README file
-                    readme_content = f"""CTO Analytics Package
-Generated on: {now.strftime('%A, %B %d, %Y at %H:%M')}
-Generated for: CTO Dashboard
-
-Contents:
-- CTO_Analytics_{date_str}.xlsx: Complete analytics with all charts data
-- graphs_png/ folder: Static PNG graphs with headers (open on any device)
-- graphs/ folder: Interactive HTML graphs (open in browser)
-  * daily_leads_trend.html: Daily leads trend analysis
-  * agent_performance.html: Agent performance breakdown
-  * status_distribution.html: Lead status distribution
-  * sales_funnel.html: Sales funnel visualization
-  * contact_methods.html: Contact methods analysis
-  * activity_heatmap.html: Activity heatmap
-  * interactive_dashboard.html: Combined interactive dashboard
-- CTO_Deals_Report_{date_str}.xlsx: Deals tracking and performance data
-
-Chart Data Included:
-- Daily leads trends
-- Agent performance breakdown
-- Lead status distribution
-- Sales funnel analysis
-- Contact method analysis
-- Activity heatmaps
-- Rolling averages and trends
-- Filtered data based on current selections
-
-Graphs Available:
-- Static PNG graphs for printing and sharing
-- Interactive HTML graphs for detailed analysis
-- Combined dashboard view for executive overview
-
-CTO Summary:
-- Total Leads: {len(df_all)}
-- Filtered Leads: {len(df_f)}
-- Active Agents: {len(agent_counts) if 'agent_breakdown' in charts_data else 0}
-
-This package contains comprehensive technical analytics for system management.
-"""
-                    zip_file.writestr('README.txt', readme_content)
-                
-                # Offer download
-                st.download_button(
-                    label=f'📥 Download {zip_filename}',
-                    data=zip_buffer.getvalue(),
-                    file_name=zip_filename,
-                    mime='application/zip',
-                    help=f'Download complete CTO analytics package for {day_name}, {date_str}'
-                )
-                
-                st.success(f'✅ CTO Analytics package ready! Contains all dashboard charts and technical reports for {day_name}, {date_str}')
-                
-            except Exception as e:
-                st.error(f'Error creating CTO analytics package: {str(e)}')
+            start_job('cto_analytics_package', current_user.username, filters=dash_filters)
 
         # Done deals charts (handles empty safely)
         st.markdown('---')
         st.subheader('Done Deals — Analytics')
-        deals_df, _ = read_deals_df(limit=100000)
-        if deals_df.empty:
+        deal_frames = deal_dashboard_frames()
+        if not deal_frames['total']:
             st.info('No deals yet')
         else:
-            deals_df['created_at'] = pd.to_datetime(deals_df['created_at'])
-            deals_df['date'] = deals_df['created_at'].dt.date
-            if not deals_df.empty:
-                dd_daily = deals_df.groupby('date').size().reset_index(name='deals')
-                if not dd_daily.empty:
-                    dd_fig = px.line(dd_daily, x='date', y='deals', title='Deals per day')
-                    st.plotly_chart(dd_fig, use_container_width=True)
-                dd_sales = deals_df['uploaded_by'].value_counts().reset_index()
-                dd_sales.columns = ['salesman','deals']
-                if not dd_sales.empty:
-                    dd_fig2 = px.bar(dd_sales, x='salesman', y='deals', title='Deals by salesman')
-                    st.plotly_chart(dd_fig2, use_container_width=True)
+            dd_daily = deal_frames['by_day']
+            if not dd_daily.empty:
+                dd_fig = px.line(dd_daily, x='date', y='deals', title='Deals per day')
+                st.plotly_chart(dd_fig, use_container_width=True)
+            dd_sales = deal_frames['by_salesman']
+            if not dd_sales.empty:
+                dd_fig2 = px.bar(dd_sales, x='salesman', y='deals', title='Deals by salesman')
+                st.plotly_chart(dd_fig2, use_container_width=True)
 
     # CTO Lead Archiving Section
     st.markdown('---')
@@ -2548,7 +4269,7 @@ This package contains comprehensive technical analytics for system management.
         st.write('**Archive Individual Leads**')
         
         # Get active leads for archiving
-        active_leads_df, active_total = read_leads_df(limit=1000, offset=0, include_archived=False)
+        active_leads_df, active_total = read_leads_df(limit=1000, offset=0, include_archived=False, columns='summary')
         
         if not active_leads_df.empty:
             # Filter options
@@ -2608,16 +4329,12 @@ This package contains comprehensive technical analytics for system management.
                         
                         if st.form_submit_button('🗄️ Archive Selected Leads'):
                             if lead_ids:
-                                with get_session() as db:
-                                    final_reason = f"{archive_reason}"
-                                    if custom_reason.strip():
-                                        final_reason += f" - {custom_reason.strip()}"
-                                    
-                                    archived_count = bulk_archive_leads(
-                                        db, lead_ids, current_user.username, 
-                                        final_reason, datetime.combine(archive_date, datetime.min.time())
-                                    )
+                                final_reason = f"{archive_reason}"
+                                if custom_reason.strip():
+                                    final_reason += f" - {custom_reason.strip()}"
                                     
+                                archived_count = run_bulk_leads('archive', lead_ids, current_user.username, final_reason, datetime.combine(archive_date, datetime.min.time()))
+                                if archived_count is not None:
                                     if archived_count > 0:
                                         st.success(f'✅ Successfully archived {archived_count} leads')
                                         st.rerun()
@@ -2634,7 +4351,8 @@ This package contains comprehensive technical analytics for system management.
             filters={'is_archived': 'yes'}, 
             limit=1000, 
             offset=0, 
-            include_archived=True
+            include_archived=True,
+            columns='archived'
         )
         
         if not archived_leads_df.empty:
@@ -2661,12 +4379,8 @@ This package contains comprehensive technical analytics for system management.
                     lead_id = int(selection.split(' - ')[0].replace('ID: ', ''))
                     unarchive_ids.append(lead_id)
                 
-                with get_session() as db:
-                    unarchived_count = 0
-                    for lead_id in unarchive_ids:
-                        if unarchive_lead(db, lead_id, current_user.username):
-                            unarchived_count += 1
-                    
+                unarchived_count = run_bulk_leads('unarchive', unarchive_ids, current_user.username)
+                if unarchived_count is not None:
                     if unarchived_count > 0:
                         st.success(f'✅ Successfully unarchived {unarchived_count} leads')
                         st.rerun()
@@ -2689,7 +4403,7 @@ This package contains comprehensive technical analytics for system management.
             
             if st.button('🔄 Bulk Unarchive by Criteria'):
                 with get_session() as db:
-                    q = db.query(Lead).filter(Lead.is_archived == 'yes')
+                    q = db.query(Lead).filter(LEAD_IS_ARCHIVED)
                     
                     if bulk_unarchive_reason != 'All':
                         q = q.filter(Lead.archive_reason == bulk_unarchive_reason)
@@ -2703,16 +4417,13 @@ This package contains comprehensive technical analytics for system management.
                     if bulk_unarchive_limit > 0:
                         q = q.limit(bulk_unarchive_limit)
                     
-                    leads_to_unarchive = q.all()
+                    leads_to_unarchive = q.with_entities(Lead.id).all()
                     
                     if leads_to_unarchive:
-                        unarchived_count = 0
-                        for lead in leads_to_unarchive:
-                            if unarchive_lead(db, lead.id, current_user.username):
-                                unarchived_count += 1
-                        
-                        st.success(f'✅ Successfully unarchived {unarchived_count} leads')
-                        st.rerun()
+                        unarchived_count = run_bulk_leads('unarchive', [lead.id for lead in leads_to_unarchive], current_user.username)
+                        if unarchived_count is not None:
+                            st.success(f'✅ Successfully unarchived {unarchived_count} leads')
+                            st.rerun()
                     else:
                         st.info('No leads match the unarchive criteria')
             
@@ -2741,9 +4452,8 @@ This package contains comprehensive technical analytics for system management.
                             lead_id = int(selection.split(' - ')[0].replace('ID: ', ''))
                             delete_ids.append(lead_id)
                         
-                        with get_session() as db:
-                            deleted_count = bulk_delete_leads_from_db(db, delete_ids, current_user.username, delete_reason.strip())
-                            
+                        deleted_count = run_bulk_leads('delete', delete_ids, current_user.username, delete_reason.strip())
+                        if deleted_count is not None:
                             if deleted_count > 0:
                                 st.success(f'✅ Successfully deleted {deleted_count} leads from database')
                                 st.rerun()
@@ -2773,7 +4483,7 @@ This package contains comprehensive technical analytics for system management.
             if st.button('🗑️ Bulk Delete by Criteria', type='secondary', key='bulk_delete_criteria'):
                 if bulk_delete_reason_text.strip():
                     with get_session() as db:
-                        q = db.query(Lead).filter(Lead.is_archived == 'yes')
+                        q = db.query(Lead).filter(LEAD_IS_ARCHIVED)
                         
                         if bulk_delete_reason != 'All':
                             q = q.filter(Lead.archive_reason == bulk_delete_reason)
@@ -2787,17 +4497,17 @@ This package contains comprehensive technical analytics for system management.
                         if bulk_delete_limit > 0:
                             q = q.limit(bulk_delete_limit)
                         
-                        leads_to_delete = q.all()
+                        leads_to_delete = q.with_entities(Lead.id).all()
                         
                         if leads_to_delete:
                             lead_ids = [lead.id for lead in leads_to_delete]
-                            deleted_count = bulk_delete_leads_from_db(db, lead_ids, current_user.username, bulk_delete_reason_text.strip())
-                            
-                            if deleted_count > 0:
-                                st.success(f'✅ Successfully deleted {deleted_count} leads from database')
-                                st.rerun()
-                            else:
-                                st.error('❌ Failed to delete leads')
+                            deleted_count = run_bulk_leads('delete', lead_ids, current_user.username, bulk_delete_reason_text.strip())
+                            if deleted_count is not None:
+                                if deleted_count > 0:
+                                    st.success(f'✅ Successfully deleted {deleted_count} leads from database')
+                                    st.rerun()
+                                else:
+                                    st.error('❌ Failed to delete leads')
                         else:
                             st.info('No leads match the deletion criteria')
                 else:
@@ -2820,12 +4530,13 @@ This package contains comprehensive technical analytics for system management.
                         if st.button('🗑️ Confirm Delete All', type='primary', key='confirm_delete_all_btn'):
                             if delete_all_reason.strip():
                                 with get_session() as db:
-                                    all_archived = db.query(Lead).filter(Lead.is_archived == 'yes').all()
+                                    all_archived = db.query(Lead.id).filter(LEAD_IS_ARCHIVED).all()
                                     if all_archived:
                                         lead_ids = [lead.id for lead in all_archived]
-                                        deleted_count = bulk_delete_leads_from_db(db, lead_ids, current_user.username, delete_all_reason.strip())
-                                        st.success(f'✅ Successfully deleted {deleted_count} leads from database')
-                                        st.rerun()
+                                        deleted_count = run_bulk_leads('delete', lead_ids, current_user.username, delete_all_reason.strip())
+                                        if deleted_count is not None:
+                                            st.success(f'✅ Successfully deleted {deleted_count} leads from database')
+                                            st.rerun()
                                     else:
                                         st.info('No archived leads found')
                             else:
@@ -2837,16 +4548,17 @@ This package contains comprehensive technical analytics for system management.
                     cutoff_date = datetime.utcnow() - pd.Timedelta(days=quick_delete_days)
                     
                     with get_session() as db:
-                        old_archived = db.query(Lead).filter(
-                            Lead.is_archived == 'yes',
+                        old_archived = db.query(Lead.id).filter(
+                            LEAD_IS_ARCHIVED,
                             Lead.archived_at <= cutoff_date
                         ).all()
                         
                         if old_archived:
                             lead_ids = [lead.id for lead in old_archived]
-                            deleted_count = bulk_delete_leads_from_db(db, lead_ids, current_user.username, f'Automatic cleanup - archives older than {quick_delete_days} days')
-                            st.success(f'✅ Successfully deleted {deleted_count} old archived leads')
-                            st.rerun()
+                            deleted_count = run_bulk_leads('delete', lead_ids, current_user.username, f'Automatic cleanup - archives older than {quick_delete_days} days')
+                            if deleted_count is not None:
+                                st.success(f'✅ Successfully deleted {deleted_count} old archived leads')
+                                st.rerun()
                         else:
                             st.info(f'No archived leads older than {quick_delete_days} days found')
             
@@ -2872,106 +4584,10 @@ This package contains comprehensive technical analytics for system management.
                                                      options=['All'] + sorted(archived_leads_df['archived_by'].dropna().unique().tolist()) if not archived_leads_df.empty else ['All'], key='export_filter_agent')
                 
                 if st.button('📊 Export Archived Leads Report', key='export_date_range'):
-                    with get_session() as db:
-                        start_datetime = datetime.combine(export_start_date, datetime.min.time())
-                        end_datetime = datetime.combine(export_end_date, datetime.max.time())
-                        
-                        # Build enhanced query with filters
-                        q = db.query(Lead).filter(
-                            Lead.is_archived == 'yes',
-                            Lead.archived_at >= start_datetime,
-                            Lead.archived_at <= end_datetime
-                        )
-                        
-                        if export_filter_reason != 'All':
-                            q = q.filter(Lead.archive_reason == export_filter_reason)
-                        if export_filter_agent != 'All':
-                            q = q.filter(Lead.archived_by == export_filter_agent)
-                        
-                        filtered_leads = q.all()
-                        
-                        if filtered_leads:
-                            # Create enhanced export data
-                            export_data = []
-                            for lead in filtered_leads:
-                                export_data.append({
-                                    'Lead ID': lead.id,
-                                    'Lead Number': lead.number,
-                                    'Customer Name': lead.name,
-                                    'Sales Agent': lead.sales_agent,
-                                    'Contact Method': lead.contact,
-                                    'Case Description': lead.case_desc,
-                                    'Feedback': lead.feedback,
-                                    'Status': lead.status,
-                                    'Assigned To': lead.assigned_to,
-                                    'Original Upload Date': lead.uploaded_at.strftime('%Y-%m-%d %H:%M') if lead.uploaded_at else '',
-                                    'Archived By': lead.archived_by,
-                                    'Archive Date': lead.archived_at.strftime('%Y-%m-%d %H:%M') if lead.archived_at else '',
-                                    'Archive Reason': lead.archive_reason,
-                                    'Scheduled Archive Date': lead.archive_date.strftime('%Y-%m-%d %H:%M') if lead.archive_date else '',
-                                    'Days Since Archive': (datetime.utcnow() - lead.archived_at).days if lead.archived_at else 0
-                                })
-                            
-                            df_export = pd.DataFrame(export_data)
-                            
-                            if export_format == 'Excel':
-                                buffer = io.BytesIO()
-                                with pd.ExcelWriter(buffer, engine='openpyxl') as writer:
-                                    df_export.to_excel(writer, sheet_name='Archived_Leads', index=False)
-                                    
-                                    if export_include_analytics:
-                                        # Analytics summary sheet
-                                        analytics_data = {
-                                            'Metric': [
-                                                'Total Archived Leads',
-                                                'Date Range',
-                                                'Filtered By Reason',
-                                                'Filtered By Agent',
-                                                'Average Days Since Archive',
-                                                'Most Common Archive Reason',
-                                                'Most Active Archiver',
-                                                'Export Generated By',
-                                                'Export Generated On'
-                                            ],
-                                            'Value': [
-                                                len(filtered_leads),
-                                                f"{export_start_date} to {export_end_date}",
-                                                export_filter_reason,
-                                                export_filter_agent,
-                                                f"{df_export['Days Since Archive'].mean():.1f} days",
-                                                df_export['Archive Reason'].mode().iloc[0] if not df_export['Archive Reason'].mode().empty else 'N/A',
-                                                df_export['Archived By'].mode().iloc[0] if not df_export['Archived By'].mode().empty else 'N/A',
-                                                current_user.username,
-                                                datetime.now().strftime('%Y-%m-%d %H:%M')
-                                            ]
-                                        }
-                                        pd.DataFrame(analytics_data).to_excel(writer, sheet_name='Analytics_Summary', index=False)
-                                        
-                                        # Archive reasons breakdown
-                                        reason_counts = df_export['Archive Reason'].value_counts().reset_index()
-                                        reason_counts.columns = ['Archive Reason', 'Count']
-                                        reason_counts.to_excel(writer, sheet_name='Archive_Reasons', index=False)
-                                
-                                filename = f"Archived_Leads_{export_start_date}_{export_end_date}.xlsx"
-                                st.download_button(
-                                    label=f'📥 Download {filename}',
-                                    data=buffer.getvalue(),
-                                    file_name=filename,
-                                    mime='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
-                                )
-                            else:
-                                csv_data = df_export.to_csv(index=False)
-                                filename = f"Archived_Leads_{export_start_date}_{export_end_date}.csv"
-                                st.download_button(
-                                    label=f'📥 Download {filename}',
-                                    data=csv_data,
-                                    file_name=filename,
-                                    mime='text/csv'
-                                )
-                            
-                            st.success(f'✅ Export ready! {len(filtered_leads)} leads included.')
-                        else:
-                            st.info('No archived leads found matching the criteria.')
+                    start_job('archived_leads_report', current_user.username,
+                              start=export_start_date, end=export_end_date, reason=export_filter_reason,
+                              archived_by=export_filter_agent, file_format=export_format,
+                              include_analytics=export_include_analytics, generated_by=current_user.username)
             
             with export_tab2:
                 st.write('**Quick Export Options**')
@@ -2980,115 +4596,19 @@ This package contains comprehensive technical analytics for system management.
                 with col1:
                     st.write('**Export All Archived:**')
                     if st.button('📊 Export All Archived Leads', key='export_all'):
-                        with get_session() as db:
-                            all_archived = db.query(Lead).filter(Lead.is_archived == 'yes').all()
-                            if all_archived:
-                                export_data = []
-                                for lead in all_archived:
-                                    export_data.append({
-                                        'Lead ID': lead.id,
-                                        'Customer Name': lead.name,
-                                        'Sales Agent': lead.sales_agent,
-                                        'Status': lead.status,
-                                        'Archived By': lead.archived_by,
-                                        'Archive Date': lead.archived_at.strftime('%Y-%m-%d %H:%M') if lead.archived_at else '',
-                                        'Archive Reason': lead.archive_reason
-                                    })
-                                
-                                df_all = pd.DataFrame(export_data)
-                                buffer = io.BytesIO()
-                                with pd.ExcelWriter(buffer, engine='openpyxl') as writer:
-                                    df_all.to_excel(writer, sheet_name='All_Archived_Leads', index=False)
-                                
-                                filename = f"All_Archived_Leads_{datetime.now().strftime('%Y%m%d')}.xlsx"
-                                st.download_button(
-                                    label=f'📥 Download {filename}',
-                                    data=buffer.getvalue(),
-                                    file_name=filename,
-                                    mime='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
-                                )
-                                st.success(f'✅ All {len(all_archived)} archived leads exported!')
-                            else:
-                                st.info('No archived leads found.')
+                        start_job('archived_leads_export', current_user.username)
                     
                     st.write('**Export Recent Archives:**')
                     recent_days = st.selectbox('Export archives from last', [7, 14, 30, 60, 90], key='recent_days')
                     if st.button('📊 Export Recent Archives', key='export_recent'):
-                        with get_session() as db:
-                            cutoff_date = datetime.utcnow() - pd.Timedelta(days=recent_days)
-                            recent_archived = db.query(Lead).filter(
-                                Lead.is_archived == 'yes',
-                                Lead.archived_at >= cutoff_date
-                            ).all()
-                            
-                            if recent_archived:
-                                export_data = []
-                                for lead in recent_archived:
-                                    export_data.append({
-                                        'Lead ID': lead.id,
-                                        'Customer Name': lead.name,
-                                        'Sales Agent': lead.sales_agent,
-                                        'Status': lead.status,
-                                        'Archived By': lead.archived_by,
-                                        'Archive Date': lead.archived_at.strftime('%Y-%m-%d %H:%M') if lead.archived_at else '',
-                                        'Archive Reason': lead.archive_reason
-                                    })
-                                
-                                df_recent = pd.DataFrame(export_data)
-                                buffer = io.BytesIO()
-                                with pd.ExcelWriter(buffer, engine='openpyxl') as writer:
-                                    df_recent.to_excel(writer, sheet_name=f'Recent_Archives_{recent_days}d', index=False)
-                                
-                                filename = f"Recent_Archives_{recent_days}days_{datetime.now().strftime('%Y%m%d')}.xlsx"
-                                st.download_button(
-                                    label=f'📥 Download {filename}',
-                                    data=buffer.getvalue(),
-                                    file_name=filename,
-                                    mime='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
-                                )
-                                st.success(f'✅ {len(recent_archived)} recent archives exported!')
-                            else:
-                                st.info(f'No archives found in the last {recent_days} days.')
+                        start_job('archived_leads_export', current_user.username, recent_days=recent_days)
                 
                 with col2:
                     st.write('**Export by Archive Reason:**')
                     quick_reason = st.selectbox('Select archive reason', 
                                               options=sorted(archived_leads_df['archive_reason'].dropna().unique().tolist()) if not archived_leads_df.empty else [], key='quick_reason')
                     if st.button('📊 Export by Reason', key='export_by_reason'):
-                        with get_session() as db:
-                            reason_archived = db.query(Lead).filter(
-                                Lead.is_archived == 'yes',
-                                Lead.archive_reason == quick_reason
-                            ).all()
-                            
-                            if reason_archived:
-                                export_data = []
-                                for lead in reason_archived:
-                                    export_data.append({
-                                        'Lead ID': lead.id,
-                                        'Customer Name': lead.name,
-                                        'Sales Agent': lead.sales_agent,
-                                        'Status': lead.status,
-                                        'Archived By': lead.archived_by,
-                                        'Archive Date': lead.archived_at.strftime('%Y-%m-%d %H:%M') if lead.archived_at else '',
-                                        'Archive Reason': lead.archive_reason
-                                    })
-                                
-                                df_reason = pd.DataFrame(export_data)
-                                buffer = io.BytesIO()
-                                with pd.ExcelWriter(buffer, engine='openpyxl') as writer:
-                                    df_reason.to_excel(writer, sheet_name=f'Reason_{quick_reason[:20]}', index=False)
-                                
-                                filename = f"Archives_Reason_{quick_reason[:20]}_{datetime.now().strftime('%Y%m%d')}.xlsx"
-                                st.download_button(
-                                    label=f'📥 Download {filename}',
-                                    data=buffer.getvalue(),
-                                    file_name=filename,
-                                    mime='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
-                                )
-                                st.success(f'✅ {len(reason_archived)} leads exported for reason: {quick_reason}')
-                            else:
-                                st.info(f'No archives found for reason: {quick_reason}')
+                        start_job('archived_leads_export', current_user.username, reason=quick_reason)
             
             with export_tab3:
                 st.write('**Analytics Export**')
@@ -3103,92 +4623,9 @@ This package contains comprehensive technical analytics for system management.
                     include_summary = st.checkbox('Include executive summary', value=True, key='include_summary')
                 
                 if st.button('📊 Generate Analytics Report', key='generate_analytics'):
-                    with get_session() as db:
-                        start_datetime = datetime.combine(analytics_start, datetime.min.time())
-                        end_datetime = datetime.combine(analytics_end, datetime.max.time())
-                        
-                        archived_in_period = db.query(Lead).filter(
-                            Lead.is_archived == 'yes',
-                            Lead.archived_at >= start_datetime,
-                            Lead.archived_at <= end_datetime
-                        ).all()
-                        
-                        if archived_in_period:
-                            # Create comprehensive analytics report
-                            buffer = io.BytesIO()
-                            with pd.ExcelWriter(buffer, engine='openpyxl') as writer:
-                                # Main data
-                                export_data = []
-                                for lead in archived_in_period:
-                                    export_data.append({
-                                        'Lead ID': lead.id,
-                                        'Customer Name': lead.name,
-                                        'Sales Agent': lead.sales_agent,
-                                        'Status': lead.status,
-                                        'Archived By': lead.archived_by,
-                                        'Archive Date': lead.archived_at.strftime('%Y-%m-%d %H:%M') if lead.archived_at else '',
-                                        'Archive Reason': lead.archive_reason
-                                    })
-                                
-                                df_analytics = pd.DataFrame(export_data)
-                                df_analytics.to_excel(writer, sheet_name='Archived_Data', index=False)
-                                
-                                if include_summary:
-                                    # Executive summary
-                                    summary_data = {
-                                        'Metric': [
-                                            'Total Archives in Period',
-                                            'Period Start',
-                                            'Period End',
-                                            'Most Common Archive Reason',
-                                            'Most Active Archiver',
-                                            'Average Archives per Day',
-                                            'Peak Archive Day',
-                                            'Report Generated By',
-                                            'Report Generated On'
-                                        ],
-                                        'Value': [
-                                            len(archived_in_period),
-                                            analytics_start,
-                                            analytics_end,
-                                            df_analytics['Archive Reason'].mode().iloc[0] if not df_analytics['Archive Reason'].mode().empty else 'N/A',
-                                            df_analytics['Archived By'].mode().iloc[0] if not df_analytics['Archived By'].mode().empty else 'N/A',
-                                            f"{len(archived_in_period) / ((end_datetime - start_datetime).days + 1):.1f}",
-                                            df_analytics['Archive Date'].mode().iloc[0] if not df_analytics['Archive Date'].mode().empty else 'N/A',
-                                            current_user.username,
-                                            datetime.now().strftime('%Y-%m-%d %H:%M')
-                                        ]
-                                    }
-                                    pd.DataFrame(summary_data).to_excel(writer, sheet_name='Executive_Summary', index=False)
-                                
-                                if include_charts:
-                                    # Archive reasons breakdown
-                                    reason_counts = df_analytics['Archive Reason'].value_counts().reset_index()
-                                    reason_counts.columns = ['Archive Reason', 'Count']
-                                    reason_counts.to_excel(writer, sheet_name='Archive_Reasons', index=False)
-                                    
-                                    # Archive by agent
-                                    agent_counts = df_analytics['Archived By'].value_counts().reset_index()
-                                    agent_counts.columns = ['Archived By', 'Count']
-                                    agent_counts.to_excel(writer, sheet_name='Archive_by_Agent', index=False)
-                                    
-                                    # Daily archive trends
-                                    df_analytics['Archive Date Only'] = pd.to_datetime(df_analytics['Archive Date']).dt.date
-                                    daily_counts = df_analytics['Archive Date Only'].value_counts().reset_index()
-                                    daily_counts.columns = ['Date', 'Archives']
-                                    daily_counts = daily_counts.sort_values('Date')
-                                    daily_counts.to_excel(writer, sheet_name='Daily_Trends', index=False)
-                            
-                            filename = f"Analytics_Report_{analytics_start}_{analytics_end}.xlsx"
-                            st.download_button(
-                                label=f'📥 Download Analytics Report',
-                                data=buffer.getvalue(),
-                                file_name=filename,
-                                mime='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
-                            )
-                            st.success(f'✅ Analytics report generated with {len(archived_in_period)} records!')
-                        else:
-                            st.info('No archived data found for the selected period.')
+                    start_job('archived_analytics_report', current_user.username,
+                              start=analytics_start, end=analytics_end, include_charts=include_charts,
+                              include_summary=include_summary, generated_by=current_user.username)
         else:
             st.info('No archived leads found')
     
@@ -3233,7 +4670,7 @@ This package contains comprehensive technical analytics for system management.
             # Preview functionality
             if st.button('🔍 Preview Leads to Archive'):
                 with get_session() as db:
-                    q = db.query(Lead).filter(sa.or_(Lead.is_archived.is_(None), Lead.is_archived == 'no'))
+                    q = db.query(Lead).filter(LEAD_IS_ACTIVE)
                     
                     if smart_agents:
                         q = q.filter(Lead.sales_agent.in_(smart_agents))
@@ -3273,7 +4710,7 @@ This package contains comprehensive technical analytics for system management.
             # Execute bulk archive
             if st.button('🗄️ Execute Smart Bulk Archive'):
                 with get_session() as db:
-                    q = db.query(Lead).filter(sa.or_(Lead.is_archived.is_(None), Lead.is_archived == 'no'))
+                    q = db.query(Lead).filter(LEAD_IS_ACTIVE)
                     
                     if smart_agents:
                         q = q.filter(Lead.sales_agent.in_(smart_agents))
@@ -3289,7 +4726,7 @@ This package contains comprehensive technical analytics for system management.
                     if smart_max_leads > 0:
                         q = q.limit(smart_max_leads)
                     
-                    leads_to_archive = q.all()
+                    leads_to_archive = q.with_entities(Lead.id).all()
                     
                     if leads_to_archive:
                         lead_ids = [lead.id for lead in leads_to_archive]
@@ -3297,14 +4734,11 @@ This package contains comprehensive technical analytics for system management.
                         if custom_reason.strip():
                             final_reason += f" - {custom_reason.strip()}"
                         
-                        archived_count = bulk_archive_leads(
-                            db, lead_ids, current_user.username, 
-                            final_reason, datetime.utcnow()
-                        )
-                        
-                        st.success(f'✅ Successfully archived {archived_count} leads!')
-                        st.info(f'📋 Archive reason: {final_reason}')
-                        st.rerun()
+                        archived_count = run_bulk_leads('archive', lead_ids, current_user.username, final_reason, datetime.utcnow())
+                        if archived_count is not None:
+                            st.success(f'✅ Successfully archived {archived_count} leads!')
+                            st.info(f'📋 Archive reason: {final_reason}')
+                            st.rerun()
                     else:
                         st.info('No leads match the selected criteria')
         
@@ -3337,7 +4771,7 @@ This package contains comprehensive technical analytics for system management.
                     end_datetime = datetime.combine(date_archive_end, datetime.max.time())
                     
                     q = db.query(Lead).filter(
-                        sa.or_(Lead.is_archived.is_(None), Lead.is_archived == 'no'),
+                        LEAD_IS_ACTIVE,
                         Lead.uploaded_at >= start_datetime,
                         Lead.uploaded_at <= end_datetime
                     )
@@ -3373,7 +4807,7 @@ This package contains comprehensive technical analytics for system management.
                     end_datetime = datetime.combine(date_archive_end, datetime.max.time())
                     
                     q = db.query(Lead).filter(
-                        sa.or_(Lead.is_archived.is_(None), Lead.is_archived == 'no'),
+                        LEAD_IS_ACTIVE,
                         Lead.uploaded_at >= start_datetime,
                         Lead.uploaded_at <= end_datetime
                     )
@@ -3383,17 +4817,14 @@ This package contains comprehensive technical analytics for system management.
                     if date_archive_statuses:
                         q = q.filter(Lead.status.in_(date_archive_statuses))
                     
-                    leads_in_range = q.all()
+                    leads_in_range = q.with_entities(Lead.id).all()
                     
                     if leads_in_range:
                         lead_ids = [lead.id for lead in leads_in_range]
-                        archived_count = bulk_archive_leads(
-                            db, lead_ids, current_user.username, 
-                            f"{date_archive_reason} ({date_archive_start} to {date_archive_end})", 
-                            datetime.utcnow()
-                        )
-                        st.success(f'✅ Successfully archived {archived_count} leads from {date_archive_start} to {date_archive_end}')
-                        st.rerun()
+                        archived_count = run_bulk_leads('archive', lead_ids, current_user.username, f"{date_archive_reason} ({date_archive_start} to {date_archive_end})", datetime.utcnow())
+                        if archived_count is not None:
+                            st.success(f'✅ Successfully archived {archived_count} leads from {date_archive_start} to {date_archive_end}')
+                            st.rerun()
                     else:
                         st.info(f'No leads found in date range {date_archive_start} to {date_archive_end}')
         
@@ -3401,8 +4832,7 @@ This package contains comprehensive technical analytics for system management.
             st.write('**Agent-Based Bulk Archiving**')
             
             # Get all sales agents
-            with get_session() as db:
-                all_agents = [u.username for u in db.query(User).filter(User.role=='salesman').order_by(User.username.asc()).all()]
+            all_agents = usernames('salesman')
             
             col1, col2 = st.columns(2)
             with col1:
@@ -3434,7 +4864,7 @@ This package contains comprehensive technical analytics for system management.
                         agent_summary = []
                         for agent in agent_bulk_selection:
                             q = db.query(Lead).filter(
-                                sa.or_(Lead.is_archived.is_(None), Lead.is_archived == 'no'),
+                                LEAD_IS_ACTIVE,
                                 Lead.sales_agent == agent,
                                 Lead.status.in_(agent_bulk_statuses),
                                 Lead.uploaded_at <= cutoff_date
@@ -3456,10 +4886,11 @@ This package contains comprehensive technical analytics for system management.
                     with get_session() as db:
                         cutoff_date = datetime.utcnow() - pd.Timedelta(days=agent_bulk_days)
                         total_archived = 0
+                        queued_agents = 0
                         
                         for agent in agent_bulk_selection:
                             q = db.query(Lead).filter(
-                                sa.or_(Lead.is_archived.is_(None), Lead.is_archived == 'no'),
+                                LEAD_IS_ACTIVE,
                                 Lead.sales_agent == agent,
                                 Lead.status.in_(agent_bulk_statuses),
                                 Lead.uploaded_at <= cutoff_date
@@ -3468,19 +4899,19 @@ This package contains comprehensive technical analytics for system management.
                             if agent_bulk_limit > 0:
                                 q = q.limit(agent_bulk_limit)
                             
-                            leads_to_archive = q.all()
+                            leads_to_archive = q.with_entities(Lead.id).all()
                             
                             if leads_to_archive:
                                 lead_ids = [lead.id for lead in leads_to_archive]
-                                archived_count = bulk_archive_leads(
-                                    db, lead_ids, current_user.username, 
-                                    f"{agent_bulk_reason} - Agent: {agent}", 
-                                    datetime.utcnow()
-                                )
-                                total_archived += archived_count
+                                archived_count = run_bulk_leads('archive', lead_ids, current_user.username, f"{agent_bulk_reason} - Agent: {agent}", datetime.utcnow())
+                                if archived_count is None:
+                                    queued_agents += 1
+                                else:
+                                    total_archived += archived_count
                         
-                        st.success(f'✅ Successfully archived {total_archived} leads from {len(agent_bulk_selection)} agents')
-                        st.rerun()
+                        st.success(f'✅ Successfully archived {total_archived} leads from {len(agent_bulk_selection) - queued_agents} agents')
+                        if not queued_agents:
+                            st.rerun()
         
         with bulk_tab4:
             st.write('**Quick Bulk Actions**')
@@ -3495,40 +4926,34 @@ This package contains comprehensive technical analytics for system management.
                     with get_session() as db:
                         cutoff_date = datetime.utcnow() - pd.Timedelta(days=60)
                         q = db.query(Lead).filter(
-                            sa.or_(Lead.is_archived.is_(None), Lead.is_archived == 'no'),
+                            LEAD_IS_ACTIVE,
                             Lead.uploaded_at <= cutoff_date
                         )
-                        leads_to_archive = q.all()
+                        leads_to_archive = q.with_entities(Lead.id).all()
                         
                         if leads_to_archive:
                             lead_ids = [lead.id for lead in leads_to_archive]
-                            archived_count = bulk_archive_leads(
-                                db, lead_ids, current_user.username, 
-                                'Quick action - Old leads (60+ days)', 
-                                datetime.utcnow()
-                            )
-                            st.success(f'✅ Archived {archived_count} old leads')
-                            st.rerun()
+                            archived_count = run_bulk_leads('archive', lead_ids, current_user.username, 'Quick action - Old leads (60+ days)', datetime.utcnow())
+                            if archived_count is not None:
+                                st.success(f'✅ Archived {archived_count} old leads')
+                                st.rerun()
                         else:
                             st.info('No old leads found')
                 
                 if st.button('🗄️ Archive All "Lost" Status'):
                     with get_session() as db:
                         q = db.query(Lead).filter(
-                            sa.or_(Lead.is_archived.is_(None), Lead.is_archived == 'no'),
+                            LEAD_IS_ACTIVE,
                             Lead.status == 'lost'
                         )
-                        leads_to_archive = q.all()
+                        leads_to_archive = q.with_entities(Lead.id).all()
                         
                         if leads_to_archive:
                             lead_ids = [lead.id for lead in leads_to_archive]
-                            archived_count = bulk_archive_leads(
-                                db, lead_ids, current_user.username, 
-                                'Quick action - All lost leads', 
-                                datetime.utcnow()
-                            )
-                            st.success(f'✅ Archived {archived_count} lost leads')
-                            st.rerun()
+                            archived_count = run_bulk_leads('archive', lead_ids, current_user.username, 'Quick action - All lost leads', datetime.utcnow())
+                            if archived_count is not None:
+                                st.success(f'✅ Archived {archived_count} lost leads')
+                                st.rerun()
                         else:
                             st.info('No lost leads found')
             
@@ -3540,20 +4965,17 @@ This package contains comprehensive technical analytics for system management.
                 if st.button(f'🗄️ Archive All "{quick_status}" Status'):
                     with get_session() as db:
                         q = db.query(Lead).filter(
-                            sa.or_(Lead.is_archived.is_(None), Lead.is_archived == 'no'),
+                            LEAD_IS_ACTIVE,
                             Lead.status == quick_status
                         )
-                        leads_to_archive = q.all()
+                        leads_to_archive = q.with_entities(Lead.id).all()
                         
                         if leads_to_archive:
                             lead_ids = [lead.id for lead in leads_to_archive]
-                            archived_count = bulk_archive_leads(
-                                db, lead_ids, current_user.username, 
-                                f'Quick action - All {quick_status} leads', 
-                                datetime.utcnow()
-                            )
-                            st.success(f'✅ Archived {archived_count} {quick_status} leads')
-                            st.rerun()
+                            archived_count = run_bulk_leads('archive', lead_ids, current_user.username, f'Quick action - All {quick_status} leads', datetime.utcnow())
+                            if archived_count is not None:
+                                st.success(f'✅ Archived {archived_count} {quick_status} leads')
+                                st.rerun()
                         else:
                             st.info(f'No {quick_status} leads found')
                 
@@ -3571,20 +4993,17 @@ This package contains comprehensive technical analytics for system management.
                         with get_session() as db:
                             cutoff_date = datetime.utcnow() - pd.Timedelta(days=age_days)
                             q = db.query(Lead).filter(
-                                sa.or_(Lead.is_archived.is_(None), Lead.is_archived == 'no'),
+                                LEAD_IS_ACTIVE,
                                 Lead.uploaded_at <= cutoff_date
                             )
-                            leads_to_archive = q.all()
+                            leads_to_archive = q.with_entities(Lead.id).all()
                             
                             if leads_to_archive:
                                 lead_ids = [lead.id for lead in leads_to_archive]
-                                archived_count = bulk_archive_leads(
-                                    db, lead_ids, current_user.username, 
-                                    f'Quick action - {age_label} old leads', 
-                                    datetime.utcnow()
-                                )
-                                st.success(f'✅ Archived {archived_count} leads ({age_label})')
-                                st.rerun()
+                                archived_count = run_bulk_leads('archive', lead_ids, current_user.username, f'Quick action - {age_label} old leads', datetime.utcnow())
+                                if archived_count is not None:
+                                    st.success(f'✅ Archived {archived_count} leads ({age_label})')
+                                    st.rerun()
                             else:
                                 st.info(f'No leads {age_label} old found')
             
@@ -3607,16 +5026,17 @@ This package contains comprehensive technical analytics for system management.
                         if delete_status_reason.strip():
                             with get_session() as db:
                                 q = db.query(Lead).filter(
-                                    sa.or_(Lead.is_archived.is_(None), Lead.is_archived == 'no'),
+                                    LEAD_IS_ACTIVE,
                                     Lead.status == delete_status
                                 )
-                                leads_to_delete = q.all()
+                                leads_to_delete = q.with_entities(Lead.id).all()
                                 
                                 if leads_to_delete:
                                     lead_ids = [lead.id for lead in leads_to_delete]
-                                    deleted_count = bulk_delete_leads_from_db(db, lead_ids, current_user.username, delete_status_reason.strip())
-                                    st.success(f'✅ Successfully deleted {deleted_count} {delete_status} leads')
-                                    st.rerun()
+                                    deleted_count = run_bulk_leads('delete', lead_ids, current_user.username, delete_status_reason.strip())
+                                    if deleted_count is not None:
+                                        st.success(f'✅ Successfully deleted {deleted_count} {delete_status} leads')
+                                        st.rerun()
                                 else:
                                     st.info(f'No {delete_status} leads found')
                         else:
@@ -3630,16 +5050,17 @@ This package contains comprehensive technical analytics for system management.
                     cutoff_date = datetime.utcnow() - pd.Timedelta(days=delete_age_days)
                     
                     with get_session() as db:
-                        old_leads = db.query(Lead).filter(
-                            sa.or_(Lead.is_archived.is_(None), Lead.is_archived == 'no'),
+                        old_leads = db.query(Lead.id).filter(
+                            LEAD_IS_ACTIVE,
                             Lead.uploaded_at <= cutoff_date
                         ).all()
                         
                         if old_leads:
                             lead_ids = [lead.id for lead in old_leads]
-                            deleted_count = bulk_delete_leads_from_db(db, lead_ids, current_user.username, f'Automatic cleanup - leads older than {delete_age_days} days')
-                            st.success(f'✅ Successfully deleted {deleted_count} old leads')
-                            st.rerun()
+                            deleted_count = run_bulk_leads('delete', lead_ids, current_user.username, f'Automatic cleanup - leads older than {delete_age_days} days')
+                            if deleted_count is not None:
+                                st.success(f'✅ Successfully deleted {deleted_count} old leads')
+                                st.rerun()
                         else:
                             st.info(f'No leads older than {delete_age_days} days found')
     
@@ -3666,22 +5087,19 @@ This package contains comprehensive technical analytics for system management.
                 
                 # Get leads in date range
                 q = db.query(Lead).filter(
-                    sa.or_(Lead.is_archived.is_(None), Lead.is_archived == 'no'),
+                    LEAD_IS_ACTIVE,
                     Lead.uploaded_at >= start_datetime,
                     Lead.uploaded_at <= end_datetime
                 )
                 
-                leads_in_range = q.all()
+                leads_in_range = q.with_entities(Lead.id).all()
                 
                 if leads_in_range:
                     lead_ids = [lead.id for lead in leads_in_range]
-                    archived_count = bulk_archive_leads(
-                        db, lead_ids, current_user.username, 
-                        f"{date_archive_reason} ({archive_start_date} to {archive_end_date})", 
-                        datetime.utcnow()
-                    )
-                    st.success(f'✅ Archived {archived_count} leads from {archive_start_date} to {archive_end_date}')
-                    st.rerun()
+                    archived_count = run_bulk_leads('archive', lead_ids, current_user.username, f"{date_archive_reason} ({archive_start_date} to {archive_end_date})", datetime.utcnow())
+                    if archived_count is not None:
+                        st.success(f'✅ Archived {archived_count} leads from {archive_start_date} to {archive_end_date}')
+                        st.rerun()
                 else:
                     st.info(f'No leads found in date range {archive_start_date} to {archive_end_date}')
         
@@ -3715,24 +5133,24 @@ This package contains comprehensive technical analytics for system management.
     
     with get_session() as db:
         # Get archive statistics
-        total_archived = db.query(Lead).filter(Lead.is_archived == 'yes').count()
-        total_active = db.query(Lead).filter(sa.or_(Lead.is_archived.is_(None), Lead.is_archived == 'no')).count()
+        total_archived = db.query(Lead).filter(LEAD_IS_ARCHIVED).count()
+        total_active = db.query(Lead).filter(LEAD_IS_ACTIVE).count()
         
         # Archive by reason
         archive_reasons = db.query(Lead.archive_reason, func.count(Lead.id)).filter(
-            Lead.is_archived == 'yes'
+            LEAD_IS_ARCHIVED
         ).group_by(Lead.archive_reason).all()
         
         # Archive by date (last 30 days)
         thirty_days_ago = datetime.utcnow() - pd.Timedelta(days=30)
         recent_archives = db.query(func.date(Lead.archived_at), func.count(Lead.id)).filter(
-            Lead.is_archived == 'yes',
+            LEAD_IS_ARCHIVED,
             Lead.archived_at >= thirty_days_ago
         ).group_by(func.date(Lead.archived_at)).order_by(func.date(Lead.archived_at)).all()
         
         # Archive by agent
         archive_by_agent = db.query(Lead.archived_by, func.count(Lead.id)).filter(
-            Lead.is_archived == 'yes'
+            LEAD_IS_ARCHIVED
         ).group_by(Lead.archived_by).all()
     
     # Display summary metrics
@@ -3778,15 +5196,14 @@ This package contains comprehensive technical analytics for system management.
 
 elif role == 'ceo':
     st.header('CEO — Executive Dashboard & Reports')
-    df_all, total = read_leads_df(limit=10000, offset=0)
-    if df_all.empty:
+    kpis = lead_kpis()
+    if not kpis['total']:
         st.info('No data yet')
     else:
         st.subheader('Executive KPIs')
-        total_leads = total
-        unique_contacts = int(df_all['contact'].nunique())
-        vc_all = df_all['sales_agent'].value_counts()
-        top_agent = (vc_all.idxmax() if not vc_all.empty else '—')
+        total_leads = kpis['total']
+        unique_contacts = kpis['unique_contacts']
+        top_agent = kpis['top_agent']
         c1, c2, c3 = st.columns(3)
         c1.metric('Total Leads', total_leads)
         c2.metric('Unique Contacts', unique_contacts)
@@ -3796,76 +5213,13 @@ elif role == 'ceo':
         st.markdown('---')
         st.subheader('📊 CTO Analytics Dashboard')
         
-        # Create all the charts that CTO sees
-        df_f = df_all.copy()
-        charts_data = {}
+        # Same charts the CTO sees, aggregated in SQL over all active leads
+        frames = lead_dashboard_frames()
+        charts_data = {key: frames[key] for key in PACKAGE_CHARTS if not frames[key].empty}
         
         try:
-            # 1. Time series chart
-            if not df_f.empty:
-                df_f['uploaded_at'] = pd.to_datetime(df_f['uploaded_at'])
-                daily = df_f.groupby(df_f['uploaded_at'].dt.date).size().reset_index(name='count')
-                daily.columns = ['date', 'count']
-                if not daily.empty:
-                    fig_time = px.line(daily, x='date', y='count', title='Leads per day')
-                    st.plotly_chart(fig_time, use_container_width=True)
-                    charts_data['daily_leads'] = daily
-            
-            # 2. Agent breakdown
-            agent_counts = df_f['sales_agent'].value_counts().reset_index()
-            agent_counts.columns = ['agent', 'leads']
-            if not agent_counts.empty:
-                fig_agents = px.bar(agent_counts, x='agent', y='leads', title='Leads by agent')
-                st.plotly_chart(fig_agents, use_container_width=True)
-                charts_data['agent_breakdown'] = agent_counts
-            
-            # 3. Status breakdown
-            status_counts = df_f['status'].value_counts().reset_index()
-            status_counts.columns = ['status', 'count']
-            if not status_counts.empty:
-                fig_status = px.pie(status_counts, values='count', names='status', title='Lead status distribution')
-                st.plotly_chart(fig_status, use_container_width=True)
-                charts_data['status_breakdown'] = status_counts
-            
-            # 4. Sales Pipeline Funnel
-            st.subheader('Sales Pipeline — Funnel Analysis')
-            ordered_status = ['new','contacted','qualified','won','lost']
-            counts_map = {s: int((df_f['status'] == s).sum()) for s in ordered_status}
-            funnel_df = pd.DataFrame({'status': list(counts_map.keys()), 'count': list(counts_map.values())})
-            fig_funnel = px.funnel(funnel_df, x='count', y='status', title='Lead Conversion Funnel')
-            st.plotly_chart(fig_funnel, use_container_width=True)
-            charts_data['sales_funnel'] = funnel_df
-            
-            # 5. Contact method analysis
-            st.subheader('Contact Methods by Agent')
-            cm = df_f.dropna(subset=['sales_agent','contact'])
-            if not cm.empty:
-                cm_counts = cm.groupby(['sales_agent','contact']).size().reset_index(name='count')
-                fig_cm = px.bar(cm_counts, x='sales_agent', y='count', color='contact', barmode='stack', title='Contact methods by agent')
-                st.plotly_chart(fig_cm, use_container_width=True)
-                charts_data['contact_methods'] = cm_counts
-            
-            # 6. Heatmap analysis
-            st.subheader('Lead Activity Heatmap')
-            if not df_f.empty:
-                tmp = df_f.copy()
-                tmp['weekday'] = tmp['uploaded_at'].dt.day_name()
-                tmp['hour'] = tmp['uploaded_at'].dt.hour
-                heat = tmp.groupby(['weekday','hour']).size().reset_index(name='count')
-                if not heat.empty:
-                    fig_heat = px.density_heatmap(heat, x='hour', y='weekday', z='count', histfunc='avg', title='Lead uploads by time')
-                    st.plotly_chart(fig_heat, use_container_width=True)
-                    charts_data['activity_heatmap'] = heat
-            
-            # 7. Rolling average
-            st.subheader('Trends Analysis')
-            if not daily.empty:
-                daily_ra = daily.sort_values('date').copy()
-                daily_ra['rolling_7d'] = daily_ra['count'].rolling(window=7, min_periods=1).mean()
-                fig_ra = px.line(daily_ra, x='date', y=['count','rolling_7d'], labels={'value':'leads','variable':'series'}, title='Daily leads with 7-day trend')
-                st.plotly_chart(fig_ra, use_container_width=True)
-                charts_data['trends'] = daily_ra
-            
+            for chart in PACKAGE_CHARTS:
+                show_lead_chart(frames, chart)
         except Exception as e:
             st.error(f'Error generating charts: {str(e)}')
         
@@ -3873,180 +5227,47 @@ elif role == 'ceo':
         st.markdown('---')
         st.subheader('📦 Download Complete Analytics Package')
         
-        from datetime import datetime
-        import zipfile
-        
-        # Generate filename with current day and date
-        now = datetime.now()
-        day_name = now.strftime('%A')  # Full day name (e.g., 'Monday')
-        date_str = now.strftime('%Y-%m-%d')  # Date format (e.g., '2024-08-09')
-        zip_filename = f"IQ_Stats_CRM_Analytics_{day_name}_{date_str}.zip"
-        
         if st.button('📊 Generate & Download Analytics Package'):
-            try:
-                # Create ZIP file in memory
-                zip_buffer = io.BytesIO()
-                
-                with zipfile.ZipFile(zip_buffer, 'w', zipfile.ZIP_DEFLATED) as zip_file:
-                    # Add all chart data as Excel sheets
-                    excel_buffer = io.BytesIO()
-                    with pd.ExcelWriter(excel_buffer, engine='openpyxl') as writer:
-                        # Main data
-                        df_all.to_excel(writer, sheet_name='All_Leads', index=False)
-                        
-                        # Chart data
-                        for chart_name, chart_df in charts_data.items():
-                            if isinstance(chart_df, pd.DataFrame) and not chart_df.empty:
-                                chart_df.to_excel(writer, sheet_name=chart_name.replace('_', ' ').title()[:31], index=False)
-                        
-                        # Summary statistics
-                        summary_data = {
-                            'Metric': ['Total Leads', 'Unique Contacts', 'Top Agent', 'Active Salesmen', 'Conversion Rate'],
-                            'Value': [
-                                total_leads,
-                                unique_contacts,
-                                top_agent,
-                                len(agent_counts) if 'agent_breakdown' in charts_data else 0,
-                                f"{(df_f['status'] == 'won').sum() / len(df_f) * 100:.1f}%" if not df_f.empty else "0%"
-                            ]
-                        }
-                        pd.DataFrame(summary_data).to_excel(writer, sheet_name='Executive_Summary', index=False)
-                    
-                    # Add Excel file to ZIP
-                    zip_file.writestr(f'CRM_Analytics_{date_str}.xlsx', excel_buffer.getvalue())
-                    
-                    # Generate and add PNG graphs (instead of PDF)
-                    png_graphs = generate_analytics_pngs(df_f, charts_data, date_str, "CEO Analytics")
-                    for filename, content in png_graphs.items():
-                        zip_file.writestr(f'graphs_png/{filename}', content)
-                    
-                    # Generate and add interactive HTML graphs
-                    html_graphs = generate_plotly_graphs(df_f, charts_data, date_str, "CEO Analytics")
-                    for filename, html_content in html_graphs.items():
-                        zip_file.writestr(f'graphs/{filename}', html_content)
-                    
-                    # Add deals data if available
-                    deals_df, _ = read_deals_df(limit=100000)
-                    if not deals_df.empty:
-                        deals_buffer = io.BytesIO()
-                        with pd.ExcelWriter(deals_buffer, engine='openpyxl') as deals_writer:
-                            deals_df.to_excel(deals_writer, sheet_name='All_Deals', index=False)
-                            
-                            # Deals summary
-                            deals_summary = deals_df.groupby('uploaded_by').size().reset_index(name='deals_count')
-                            deals_summary.to_excel(deals_writer, sheet_name='Deals_by_Agent', index=False)
-                        
-                        zip_file.writestr(f'Deals_Report_{date_str}.xlsx', deals_buffer.getvalue())
-                    
-                    # Add a README file
-                    readme_content = f"""IQ Stats CRM Analytics Package
-Generated on: {now.strftime('%A, %B %d, %Y at %H:%M')}
-Generated for: CEO Dashboard
-
-Contents:
-- CRM_Analytics_{date_str}.xlsx: Complete leads analysis with all charts data
-- graphs_png/ folder: Static PNG graphs with headers (open on any device)
-- graphs/ folder: Interactive HTML graphs (open in browser)
-  * daily_leads_trend.html: Daily leads trend analysis
-  * agent_performance.html: Agent performance breakdown
-  * status_distribution.html: Lead status distribution
-  * sales_funnel.html: Sales funnel visualization
-  * contact_methods.html: Contact methods analysis
-  * activity_heatmap.html: Activity heatmap
-  * interactive_dashboard.html: Combined interactive dashboard
-- Deals_Report_{date_str}.xlsx: Deals tracking and performance data
-
-Chart Data Included:
-- Daily leads trends
-- Agent performance breakdown
-- Lead status distribution
-- Sales funnel analysis
-- Contact method analysis
-- Activity heatmaps
-- Rolling averages and trends
-
-Graphs Available:
-- Static PNG graphs with headers for simple sharing
-- Interactive HTML graphs for detailed analysis
-- Combined dashboard view for executive overview
-
-Executive Summary:
-- Total Leads: {total_leads}
-- Unique Contacts: {unique_contacts}
-- Top Performing Agent: {top_agent}
-
-This package contains comprehensive analytics for strategic decision making.
-"""
-                    zip_file.writestr('README.txt', readme_content)
-                
-                # Offer download
-                st.download_button(
-                    label=f'📥 Download {zip_filename}',
-                    data=zip_buffer.getvalue(),
-                    file_name=zip_filename,
-                    mime='application/zip',
-                    help=f'Download complete analytics package for {day_name}, {date_str}'
-                )
-                
-                st.success(f'✅ Analytics package ready! Contains all CTO dashboard charts and executive reports for {day_name}, {date_str}')
-                
-            except Exception as e:
-                st.error(f'Error creating analytics package: {str(e)}')
+            start_job('ceo_analytics_package', current_user.username)
 
         st.markdown('---')
         st.subheader('Download reports')
-        buf = io.BytesIO()
-        with pd.ExcelWriter(buf, engine='openpyxl') as writer:
-            df_all.to_excel(writer, index=False, sheet_name='leads')
-        st.download_button('Download Excel report', data=buf.getvalue(), file_name='crm_report.xlsx', mime='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet')
+        if st.button('📄 Prepare Excel report'):
+            buf = io.BytesIO()
+            with pd.ExcelWriter(buf, engine='openpyxl') as writer:
+                read_dashboard_leads_df().to_excel(writer, index=False, sheet_name='leads')
+            st.download_button('Download Excel report', data=buf.getvalue(), file_name='crm_report.xlsx', mime='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet')
 
         st.subheader('Summary by agent')
-        summary = df_all.groupby('sales_agent').agg(leads=('id','count'), unique_contacts=('contact','nunique')).reset_index()
-        st.dataframe(summary)
+        st.dataframe(lead_agent_summary())
 
         # Done Deals Reports
         st.markdown('---')
         st.subheader('Done Deals — Reports & Export')
-        deals_df, deals_total = read_deals_df(limit=100000, offset=0)
-        if deals_df.empty:
+        deal_frames = deal_dashboard_frames()
+        if not deal_frames['total']:
             st.info('No deals submitted yet')
         else:
-            deals_df['created_at'] = pd.to_datetime(deals_df['created_at'])
             c1, c2, c3 = st.columns(3)
-            c1.metric('Total Deals', deals_total)
-            c2.metric('Unique Customers', int(deals_df['customer_name'].nunique()))
-            c3.metric('Salesmen Submitting', int(deals_df['uploaded_by'].nunique()))
+            c1.metric('Total Deals', deal_frames['total'])
+            c2.metric('Unique Customers', deal_frames['unique_customers'])
+            c3.metric('Salesmen Submitting', deal_frames['salesmen'])
 
             # Summaries
-            by_salesman = deals_df.groupby('uploaded_by').size().reset_index(name='deals')
-            by_day = deals_df.groupby(deals_df['created_at'].dt.date).size().reset_index(name='deals')
+            by_salesman = deal_frames['by_salesman']
+            by_day = deal_frames['by_day']
             st.write('Deals by Salesman')
             st.dataframe(by_salesman)
             st.write('Deals per Day')
             st.dataframe(by_day)
 
-            # Export comprehensive Excel for advanced analysis
-            deals_buf = io.BytesIO()
-            with pd.ExcelWriter(deals_buf, engine='openpyxl') as writer:
-                deals_df.to_excel(writer, index=False, sheet_name='deals')
-                by_salesman.to_excel(writer, index=False, sheet_name='by_salesman')
-                by_day.to_excel(writer, index=False, sheet_name='by_day')
-            st.download_button('Download Done Deals Excel', data=deals_buf.getvalue(), file_name='done_deals_report.xlsx', mime='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet')
+            # Export comprehensive Excel for advanced analysis (rebuilt only when deals change)
+            st.download_button('Download Done Deals Excel', data=done_deals_report_excel(), file_name='done_deals_report.xlsx', mime='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet')
 
-            # Optional: Excel with embedded images for CEO (may be large)
-            try:
-                db = get_session()
-                all_deals = db.query(Deal).order_by(Deal.created_at.desc()).all()
-                excel_with_images = build_deals_excel_with_images(all_deals)
-                if excel_with_images:
-                    st.download_button('Download Done Deals (Excel with images)', data=excel_with_images, file_name='done_deals_with_images.xlsx', mime='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet')
-                zip_all = build_deals_images_zip(all_deals)
-                st.download_button('Download all deal screenshots (ZIP)', data=zip_all, file_name='done_deals_screenshots.zip', mime='application/zip')
-            finally:
-                try:
-                    db.close()
-                except Exception:
-                    pass
+            # Optional: Excel with embedded images for CEO (may be large), built as background jobs
+            if st.button('🖼️ Prepare Done Deals image exports'):
+                start_job('deals_excel_images', current_user.username, file_name='done_deals_with_images.xlsx')
+                start_job('deals_images_zip', current_user.username, file_name='done_deals_screenshots.zip')
 
         # Login activity (visibility for CEO)
         st.markdown('---')